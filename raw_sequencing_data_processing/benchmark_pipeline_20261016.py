@@ -0,0 +1,272 @@
+"""
+This script benchmarks the pipeline's own code: a synthetic cohort of paired fqs is generated, stand-ins of
+trim_galore, kneaddata, kraken2 and humann (benchmark_stub_tools.py) are put on PATH, and every step script is timed end
+to end, together with sample discovery and the combining of Kraken2 and HUMAnN3 reports. As the tools are stubs, the
+times are the overhead of the pipeline itself and can be compared between versions on a laptop
+
+command line example:
+python benchmark_pipeline_20261016.py bench_dir --samples 50 --read-pairs 20000 --repeat 3
+python benchmark_pipeline_20261016.py bench_dir --samples 500 --read-pairs 2000 --total-cores 8
+compare with the results of another version (exit code 1 if a benchmark is slower by more than --tolerance):
+python benchmark_pipeline_20261016.py bench_dir --compare old_bench_dir/benchmark_results.json
+outputs: bench_dir/benchmark_results.json
+"""
+
+
+import argparse
+import gzip
+import json
+import numpy as np
+import os
+import pandas as pd
+import pipeline_metagenomic as pipe_meta
+import platform
+import sample_manifest
+import shutil
+import subprocess
+import sys
+import time
+
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+STUB_TOOL_LIST = ["trim_galore", "kneaddata", "kraken2", "humann"]
+
+
+def write_synthetic_fastq_pairs(raw_dir, sample_number, read_pairs, read_length=150, seed=1):
+    """
+    Random paired reads of a cohort, named as the sequencing core does (S_0001_combined_R1.fastq.gz)
+    :param raw_dir: output directory
+    :param sample_number: number of samples
+    :param read_pairs: read pairs per sample
+    :param read_length: bases per read
+    :param seed: the same seed gives the same cohort
+    :return: {"S_0001": ["raw_dir/S_0001_combined_R1.fastq.gz", "raw_dir/S_0001_combined_R2.fastq.gz"]}
+    """
+    os.makedirs(raw_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    base_array = np.frombuffer(b"ACGT", dtype=np.uint8)
+    quality_line = b"I" * read_length
+    sample_fq_dict = {}
+    for sample_index in range(1, sample_number + 1):
+        sample_id = f"S_{sample_index:04d}"
+        sample_fq_dict[sample_id] = [os.path.join(raw_dir, f"{sample_id}_combined_R{i}.fastq.gz") for i in (1, 2)]
+        for mate, fq_path in enumerate(sample_fq_dict[sample_id], 1):
+            sequence_array = base_array[rng.integers(0, 4, size=(read_pairs, read_length))]
+            with gzip.open(fq_path, "wb", compresslevel=1) as fq_f:
+                for read_index in range(read_pairs):
+                    fq_f.write(b"@%s.%d %d\n%s\n+\n%s\n" % (sample_id.encode(), read_index, mate,
+                                                           sequence_array[read_index].tobytes(), quality_line))
+    return sample_fq_dict
+
+
+def write_stub_tools(bin_dir):
+    """
+    :param bin_dir: directory to put in front of PATH
+    :return: bin_dir, with one executable per tool of STUB_TOOL_LIST calling benchmark_stub_tools.py
+    """
+    os.makedirs(bin_dir, exist_ok=True)
+    stub_script_path = os.path.join(SCRIPT_DIR, "benchmark_stub_tools.py")
+    for tool_name in STUB_TOOL_LIST:
+        tool_path = os.path.join(bin_dir, tool_name)
+        with open(tool_path, "w") as tool_f:
+            tool_f.write(f'#!/bin/sh\nexec "{sys.executable}" "{stub_script_path}" {tool_name} "$@"\n')
+        os.chmod(tool_path, 0o755)
+    return bin_dir
+
+
+def run_step_script(script_name, argument_list, env, log_path):
+    """
+    :param script_name: "step1_trim_galore_20240715.py"
+    :param argument_list: command line arguments of the script
+    :param env: environment with the stub tools on PATH
+    :param log_path: stdout and stderr of the script
+    :return: (wall seconds, return code)
+    """
+    with open(log_path, "w") as log_f:
+        start_time = time.perf_counter()
+        returncode = subprocess.call([sys.executable, os.path.join(SCRIPT_DIR, script_name)] + argument_list,
+                                     stdout=log_f, stderr=subprocess.STDOUT, env=env, cwd=SCRIPT_DIR)
+        wall_seconds = time.perf_counter() - start_time
+    if returncode != 0:
+        print(f"Error! {script_name} exited with {returncode}, see {log_path}")
+    return wall_seconds, returncode
+
+
+def time_function(function, *args, **kwargs):
+    """
+    :return: wall seconds of function(*args, **kwargs)
+    """
+    start_time = time.perf_counter()
+    function(*args, **kwargs)
+    return time.perf_counter() - start_time
+
+
+def benchmark_cohort(bench_dir, total_cores=None, repeat=1, tool_seconds=0.0, taxa_number=500, pathway_number=400,
+                     combine_format="tsv"):
+    """
+    Run all steps on the cohort under bench_dir/raw_data, outputs of the steps are removed before every repeat so
+    each repeat is a fresh run
+    :param bench_dir: contains raw_data (write_synthetic_fastq_pairs) and bin (write_stub_tools)
+    :param total_cores: passed to the step scripts as --total-cores, None runs samples one by one
+    :param repeat: number of runs
+    :param tool_seconds: seconds every stub tool call sleeps, 0 measures the overhead of the pipeline alone
+    :param taxa_number: species in each Kraken2 report
+    :param pathway_number: pathways in each HUMAnN3 report
+    :param combine_format: "tsv" or "parquet" (needs pyarrow), format of the combined reports
+    :return: [{"name": "step1_trim_galore", "repeat": 0, "seconds": 1.2, "returncode": 0}]
+    """
+    raw_dir, db_dir, log_dir = [os.path.join(bench_dir, i) for i in ["raw_data", "stub_db", "logs"]]
+    step_dir_list = [os.path.join(bench_dir, i) for i in ["trim_galore", "kneaddata", "kraken2", "humann3"]]
+    trim_galore_dir, kneaddata_dir, kraken2_dir, humann3_dir = step_dir_list
+    os.makedirs(db_dir, exist_ok=True)
+    os.makedirs(log_dir, exist_ok=True)
+    # tiny stand-ins of the Kraken2 database files, so that --kraken-batch can stage them
+    for db_file_name in pipe_meta.KRAKEN_DATABASE_FILES:
+        with open(os.path.join(db_dir, db_file_name), "wb") as db_f:
+            db_f.write(b"\0" * 1024)
+    env = dict(os.environ, PATH=f"{os.path.join(bench_dir, 'bin')}{os.pathsep}{os.environ['PATH']}",
+               BENCH_TOOL_SECONDS=str(tool_seconds), BENCH_TAXA=str(taxa_number),
+               BENCH_PATHWAYS=str(pathway_number))
+    option_list = [] if total_cores is None else ["--total-cores", str(total_cores)]
+    processes = total_cores or 4
+    step_script_list = [("step1_trim_galore", "step1_trim_galore_20240715.py", [raw_dir, trim_galore_dir]),
+                        ("step3_kneaddata", "step3_kneaddata_20240715.py",
+                         [trim_galore_dir, kneaddata_dir, os.path.join(db_dir, "host")]),
+                        ("step4_kraken2", "step4_kraken2_20240715.py",
+                         [kneaddata_dir, kraken2_dir, db_dir, "--combine-format", combine_format]),
+                        ("step5_humann3", "step5_humann3_20240715.py",
+                         [kneaddata_dir, humann3_dir, db_dir, "mpa_stub", db_dir, db_dir, "--combine-format", combine_format])]
+    result_list = []
+    for repeat_index in range(repeat):
+        for step_dir in step_dir_list:
+            shutil.rmtree(step_dir, ignore_errors=True)
+        manifest_path = os.path.join(raw_dir, sample_manifest.MANIFEST_FILE_NAME)
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+        result_list.append({"name": "sample_discovery_cold", "repeat": repeat_index, "returncode": 0,
+                            "seconds": time_function(sample_manifest.build_sample_fq_dict, raw_dir, "raw")})
+        result_list.append({"name": "sample_discovery_cached", "repeat": repeat_index, "returncode": 0,
+                            "seconds": time_function(sample_manifest.build_sample_fq_dict, raw_dir, "raw")})
+        for step_name, script_name, argument_list in step_script_list:
+            wall_seconds, returncode = run_step_script(script_name, argument_list + option_list, env,
+                                                       os.path.join(log_dir, f"{step_name}_{repeat_index}.log"))
+            result_list.append({"name": step_name, "repeat": repeat_index, "seconds": wall_seconds,
+                                "returncode": returncode})
+            print(f"{step_name} (repeat {repeat_index}) took {wall_seconds:.2f} seconds")
+        # the combining of reports alone, also part of step4 and step5 above
+        sample_id_list = sorted(i[:-len("_report.txt")] for i in os.listdir(kraken2_dir) if i.endswith("_report.txt"))
+        if sample_id_list:
+            result_list.append({"name": "kraken_report_combine", "repeat": repeat_index, "returncode": 0,
+                                "seconds": time_function(pipe_meta.kraken_report_combine,
+                                                         [os.path.join(kraken2_dir, f"{i}_report.txt") for i in sample_id_list],
+                                                         sample_id_list, os.path.join(log_dir, "combined_counts"),
+                                                         combine_format, processes)})
+        pathway_report_path_list = [os.path.join(humann3_dir, i, f"{i}_pathabundance.tsv")
+                                    for i in sorted(os.listdir(humann3_dir)) if os.path.isdir(os.path.join(humann3_dir, i))] \
+            if os.path.isdir(humann3_dir) else []
+        pathway_report_path_list = [i for i in pathway_report_path_list if os.path.exists(i)]
+        if pathway_report_path_list:
+            result_list.append({"name": "humann_pathway_report_combine", "repeat": repeat_index, "returncode": 0,
+                                "seconds": time_function(pipe_meta.humann_pathway_report_combine,
+                                                         pathway_report_path_list,
+                                                         os.path.join(log_dir, f"combined_pathabundance.{combine_format}"),
+                                                         combine_format, processes)})
+    return result_list
+
+
+def get_code_version():
+    """
+    :return: git commit of the pipeline (with "-dirty" if it has local changes), None outside a git repository
+    """
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd=SCRIPT_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summarize_benchmark(result_list):
+    """
+    :return: {"step1_trim_galore": {"min_seconds": 1.1, "median_seconds": 1.2, "failed_runs": 0}}
+    """
+    result_df = pd.DataFrame(result_list)
+    summary_dict = {}
+    for name, name_df in result_df.groupby("name", sort=False):
+        summary_dict[name] = {"min_seconds": round(float(name_df["seconds"].min()), 4),
+                              "median_seconds": round(float(name_df["seconds"].median()), 4),
+                              "failed_runs": int((name_df["returncode"] != 0).sum())}
+    return summary_dict
+
+
+def compare_benchmark_results(baseline_path, result_path, tolerance=0.1, noise_seconds=0.05):
+    """
+    :param baseline_path: benchmark_results.json of the old version
+    :param result_path: benchmark_results.json of the new version
+    :param tolerance: a benchmark is a regression if its median time grew by more than this fraction
+    :param noise_seconds: and by more than this many seconds, so that timer noise of very short benchmarks is ignored
+    :return: DataFrame of benchmark, baseline and new median seconds, their ratio and whether it is a regression
+    """
+    summary_list = []
+    for json_path in [baseline_path, result_path]:
+        with open(json_path) as json_f:
+            summary_list.append(json.load(json_f))
+    if summary_list[0]["cohort"] != summary_list[1]["cohort"]:
+        print(f"Warning! The cohorts differ: {summary_list[0]['cohort']} vs {summary_list[1]['cohort']}")
+    compare_df = pd.DataFrame({"baseline_seconds": {i: j["median_seconds"] for i, j in summary_list[0]["summary"].items()},
+                               "new_seconds": {i: j["median_seconds"] for i, j in summary_list[1]["summary"].items()}})
+    compare_df["ratio"] = (compare_df["new_seconds"] / compare_df["baseline_seconds"]).round(3)
+    compare_df["regression"] = (compare_df["ratio"] > 1 + tolerance) & \
+                               (compare_df["new_seconds"] - compare_df["baseline_seconds"] > noise_seconds)
+    print(f"{summary_list[0]['version']} -> {summary_list[1]['version']}")
+    print(compare_df.to_string())
+    return compare_df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("bench_dir", help="working directory, the cohort is reused if it matches the options")
+    parser.add_argument("--samples", type=int, default=20)
+    parser.add_argument("--read-pairs", type=int, default=10000, help="read pairs per sample")
+    parser.add_argument("--read-length", type=int, default=150)
+    parser.add_argument("--taxa", type=int, default=500, help="species in each Kraken2 report")
+    parser.add_argument("--pathways", type=int, default=400, help="pathways in each HUMAnN3 report")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--total-cores", type=int, default=None, help="passed to the step scripts")
+    parser.add_argument("--tool-seconds", type=float, default=0.0, help="seconds every stub tool call sleeps")
+    parser.add_argument("--combine-format", choices=["tsv", "parquet"], default="tsv")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--compare", default=None, help="benchmark_results.json of another version")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+
+    result_path = os.path.join(args.bench_dir, "benchmark_results.json")
+    cohort_dict = {"samples": args.samples, "read_pairs": args.read_pairs, "read_length": args.read_length,
+                   "taxa": args.taxa, "pathways": args.pathways, "total_cores": args.total_cores,
+                   "tool_seconds": args.tool_seconds, "combine_format": args.combine_format, "seed": args.seed}
+    cohort_path = os.path.join(args.bench_dir, "cohort.json")
+    data_cohort_dict = {i: cohort_dict[i] for i in ["samples", "read_pairs", "read_length", "seed"]}
+    saved_cohort_dict = None
+    if os.path.exists(cohort_path):
+        with open(cohort_path) as cohort_f:
+            saved_cohort_dict = json.load(cohort_f)
+    if saved_cohort_dict != data_cohort_dict:
+        print(f"Generate {args.samples} samples of {args.read_pairs} read pairs under {args.bench_dir}/raw_data")
+        shutil.rmtree(os.path.join(args.bench_dir, "raw_data"), ignore_errors=True)
+        write_synthetic_fastq_pairs(os.path.join(args.bench_dir, "raw_data"), args.samples, args.read_pairs,
+                                    args.read_length, args.seed)
+        with open(cohort_path, "w") as cohort_f:
+            json.dump(data_cohort_dict, cohort_f)
+    write_stub_tools(os.path.join(args.bench_dir, "bin"))
+
+    result_list = benchmark_cohort(args.bench_dir, args.total_cores, args.repeat, args.tool_seconds, args.taxa,
+                                   args.pathways, args.combine_format)
+    benchmark_dict = {"version": get_code_version(), "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+                      "python": platform.python_version(), "numpy": np.__version__, "pandas": pd.__version__,
+                      "platform": platform.platform(), "cpu_count": os.cpu_count(), "cohort": cohort_dict,
+                      "summary": summarize_benchmark(result_list), "results": result_list}
+    with open(result_path, "w") as result_f:
+        json.dump(benchmark_dict, result_f, indent=2)
+    print(f"Benchmark results are written to {result_path}")
+    if args.compare is not None:
+        compare_df = compare_benchmark_results(args.compare, result_path, args.tolerance)
+        sys.exit(1 if compare_df["regression"].any() else 0)
@@ -0,0 +1,141 @@
+"""
+Lightweight stand-ins of trim_galore, kneaddata, kraken2 and humann for benchmarking the pipeline's own code
+They accept the command lines built by pipeline_metagenomic.py and write outputs with the same names and formats, but
+only copy reads and make up reports, so a whole cohort runs in seconds on a laptop. Only the standard library is
+imported, so a stub call costs about as much as starting Python
+
+usage (wrapper scripts put on PATH by benchmark_pipeline_20261016.py): python benchmark_stub_tools.py kraken2 --db ...
+environment:
+BENCH_TOOL_SECONDS: seconds every stub call sleeps, default 0
+BENCH_TAXA: number of species in the made-up Kraken2 reports, default 500
+BENCH_PATHWAYS: number of pathways in the made-up HUMAnN reports, default 400 (gene families are 10 times as many)
+"""
+
+
+import gzip
+import os
+import random
+import shutil
+import sys
+import time
+import zlib
+
+
+def get_option_value_list(argument_list, option_name):
+    return [argument_list[i + 1] for i in range(len(argument_list) - 1) if argument_list[i] == option_name]
+
+
+def get_fq_argument_list(argument_list):
+    return [i for i in argument_list if i.endswith((".fq", ".fastq", ".fq.gz", ".fastq.gz")) and os.path.isfile(i)]
+
+
+def get_fq_prefix(fq_path):
+    fq_name = os.path.basename(fq_path)
+    return ".".join(fq_name.split(".")[:-2 if fq_name.endswith("gz") else -1])
+
+
+def open_fq(fq_path, mode="rb"):
+    return gzip.open(fq_path, mode, compresslevel=1) if fq_path.endswith(".gz") else open(fq_path, mode)
+
+
+def copy_fq(source_path, target_path):
+    with open_fq(source_path) as source_f, open_fq(target_path, "wb") as target_f:
+        shutil.copyfileobj(source_f, target_f, 16 * 1024 * 1024)
+
+
+def count_fq_reads(fq_path):
+    with open_fq(fq_path) as fq_f:
+        return sum(block.count(b"\n") for block in iter(lambda: fq_f.read(16 * 1024 * 1024), b"")) // 4
+
+
+def sample_random(seed_text):
+    # the same sample gets the same made-up report in every run
+    return random.Random(zlib.crc32(seed_text.encode()))
+
+
+def stub_trim_galore(argument_list):
+    output_dir = get_option_value_list(argument_list, "--output_dir")[0]
+    output_suffix = ".fq" if "--dont_gzip" in argument_list else ".fq.gz"
+    for i, fq_path in enumerate(get_fq_argument_list(argument_list)):
+        copy_fq(fq_path, os.path.join(output_dir, f"{get_fq_prefix(fq_path)}_val_{i + 1}{output_suffix}"))
+
+
+# intermediate files of kneaddata, removed by kneaddata_clean_step3()
+KNEADDATA_TEMP_SUFFIX_LIST = ["kneaddata.trimmed.{}.fastq", "kneaddata.repeats.removed.{}.fastq",
+                              "kneaddata_unmatched_{}.fastq", "kneaddata.trimmed.single.{}.fastq",
+                              "kneaddata_host_bowtie2_paired_contam_{}.fastq",
+                              "kneaddata_host_bowtie2_unmatched_{}_contam.fastq"]
+
+
+def stub_kneaddata(argument_list):
+    output_dir = get_option_value_list(argument_list, "--output")[0]
+    fq_path_list = get_option_value_list(argument_list, "--input")
+    prefix = get_fq_prefix(fq_path_list[0])
+    for i, fq_path in enumerate(fq_path_list):
+        copy_fq(fq_path, os.path.join(output_dir, f"{prefix}_kneaddata_paired_{i + 1}.fastq"))
+        for temp_suffix in KNEADDATA_TEMP_SUFFIX_LIST:
+            open(os.path.join(output_dir, f"{prefix}_{temp_suffix.format(i + 1)}"), "w").close()
+
+
+MPA_RANK_PREFIX_LIST = ["d", "p", "c", "o", "f", "g", "s"]
+
+
+def stub_kraken2(argument_list):
+    report_path = get_option_value_list(argument_list, "--report")[0]
+    output_path = get_option_value_list(argument_list, "--output")[0]
+    fq_path_list = get_fq_argument_list(argument_list)
+    taxa_number = int(os.environ.get("BENCH_TAXA", 500))
+    sample_rng = sample_random(report_path)
+    read_number = count_fq_reads(fq_path_list[0])
+    species_taxid_list = list(range(1000, 1000 + taxa_number))
+    with open(output_path, "w") as output_f:
+        for read_index in range(read_number):
+            taxid = sample_rng.choice(species_taxid_list) if sample_rng.random() < 0.8 else 0
+            output_f.write(f"{'C' if taxid else 'U'}\tread{read_index}\t{taxid}\t150|150\t{taxid}:116 |:| {taxid}:116\n")
+    # read counts of every clade, species of a sample follow a skewed distribution as in real cohorts
+    clade_count_dict = {}
+    species_weight_list = [sample_rng.paretovariate(1.2) for i in range(taxa_number)]
+    species_count_list = [int(read_number * 0.8 * i / sum(species_weight_list)) for i in species_weight_list]
+    for species_index, species_count in enumerate(species_count_list):
+        taxon_list = [f"{rank_prefix}__{rank_prefix.upper()}{species_index // 4 ** (6 - rank_index)}"
+                      for rank_index, rank_prefix in enumerate(MPA_RANK_PREFIX_LIST)]
+        taxon_list[0] = "d__Bacteria"
+        for rank_index in range(len(taxon_list)):
+            lineage = "|".join(taxon_list[:rank_index + 1])
+            clade_count_dict[lineage] = clade_count_dict.get(lineage, 0) + species_count
+    with open(report_path, "w") as report_f:
+        for lineage, clade_count in clade_count_dict.items():
+            report_f.write(f"{lineage}\t{clade_count}\n")
+
+
+def stub_humann(argument_list):
+    output_dir = get_option_value_list(argument_list, "--output")[0]
+    basename = get_option_value_list(argument_list, "--output-basename")[0]
+    pathway_number = int(os.environ.get("BENCH_PATHWAYS", 400))
+    sample_rng = sample_random(basename)
+    report_dict = {"genefamilies": ("# Gene Family", "Abundance-RPKs", "UniRef90_G", pathway_number * 10),
+                   "pathabundance": ("# Pathway", "Abundance", "PWY-", pathway_number),
+                   "pathcoverage": ("# Pathway", "Coverage", "PWY-", pathway_number)}
+    for report_type, (feature_header, value_name, feature_prefix, feature_number) in report_dict.items():
+        with open(os.path.join(output_dir, f"{basename}_{report_type}.tsv"), "w") as report_f:
+            report_f.write(f"{feature_header}\t{basename}_{value_name}\n")
+            report_f.write(f"UNMAPPED\t{sample_rng.random() * 1000:.4f}\n")
+            # each sample has about 70% of the features, each stratified by two of its species
+            for feature_index in range(feature_number):
+                if sample_rng.random() > 0.7:
+                    continue
+                feature_name = f"{feature_prefix}{feature_index:05d}"
+                report_f.write(f"{feature_name}\t{sample_rng.random() * 100:.4f}\n")
+                for species_index in sample_rng.sample(range(50), 2):
+                    report_f.write(f"{feature_name}|g__G{species_index}.s__G{species_index}_S{species_index}\t"
+                                   f"{sample_rng.random() * 50:.4f}\n")
+
+
+STUB_TOOL_DICT = {"trim_galore": stub_trim_galore, "kneaddata": stub_kneaddata, "kraken2": stub_kraken2,
+                  "humann": stub_humann}
+
+
+if __name__ == "__main__":
+    tool_name = sys.argv[1]
+    time.sleep(float(os.environ.get("BENCH_TOOL_SECONDS", 0)))
+    STUB_TOOL_DICT[tool_name](sys.argv[2:])
@@ -0,0 +1,159 @@
+"""
+Filtering, rarefaction and beta diversity of combined count matrices, the multi-core counterpart of
+filter_phyloseq_object() and phyloseq::distance() in the downstream notebook for large cohorts
+
+command line example:
+python downstream_metagenomic.py kraken2_dir/combined_counts_Species.parquet beta_dir/Species --metric jsd --threads 16
+outputs: beta_dir/Species_filtered_counts.tsv (read by load_kraken_count_matrix() in the notebook) and
+beta_dir/Species_jsd_distance.tsv (read by load_distance_matrix() in the notebook)
+"""
+
+
+import argparse
+import concurrent.futures
+import numpy as np
+import os
+import pandas as pd
+
+
+def load_count_matrix(count_path):
+    """
+    :param count_path: combined_counts_Species.parquet (long table taxon, sample, value) or .tsv (dense), written by
+    kraken_report_combine() in pipeline_metagenomic.py
+    :return: DataFrame of taxa (rows, MPA-style lineages) by samples
+    """
+    if count_path.endswith(".parquet"):
+        count_long_df = pd.read_parquet(count_path)
+        feature_column_name = count_long_df.columns[0]
+        return count_long_df.pivot_table(index=feature_column_name, columns="sample", values="value",
+                                         aggfunc="sum", fill_value=0, observed=True)
+    return pd.read_csv(count_path, sep="\t", index_col=0)
+
+
+def filter_count_matrix(count_df, mean_ra_threshold=0.001, prevalence_threshold=0.1, domain="Bacteria"):
+    """
+    Same filters as filter_phyloseq_object() of the notebook: taxa of the domain with mean relative abundance over
+    samples > mean_ra_threshold and present in > prevalence_threshold of samples
+    :param count_df: taxa by samples, result of load_count_matrix()
+    :param mean_ra_threshold: 0.001
+    :param prevalence_threshold: 0.1
+    :param domain: keep lineages starting with d__Bacteria (category of generate_phyloseq_object()), None keeps all
+    :return: filtered count_df
+    """
+    if domain is not None:
+        count_df = count_df[count_df.index.str.match(rf"d__{domain}(\||$)")]
+    count_array = count_df.values.astype(float)
+    sample_sum = count_array.sum(axis=0)
+    mean_ra = (count_array / np.where(sample_sum > 0, sample_sum, 1)).mean(axis=1)
+    prevalence = (count_array > 0).sum(axis=1)
+    taxon_mask = (mean_ra > mean_ra_threshold) & (prevalence > count_array.shape[1] * prevalence_threshold)
+    print(f"{taxon_mask.sum()} of {len(taxon_mask)} taxa pass the abundance and prevalence filters")
+    return count_df[taxon_mask]
+
+
+def rarefy_count_matrix(count_df, depth=None, depth_ratio=0.9, seed=123123):
+    """
+    Subsample the reads of every sample without replacement to the same depth, like rarefy_even_depth(replace=F)
+    Each sample draws from its own random stream spawned from seed, so the result does not depend on sample order;
+    the random streams differ from R, so rarefied counts match the notebook in distribution, not read for read
+    :param count_df: taxa by samples
+    :param depth: reads kept per sample, default depth_ratio * the smallest sample depth
+    :param depth_ratio: 0.9 as in filter_phyloseq_object()
+    :param seed: 123123 as in filter_phyloseq_object()
+    :return: rarefied count_df, samples below depth and taxa left without reads are removed
+    """
+    count_array = count_df.values.astype(np.int64)
+    sample_sum = count_array.sum(axis=0)
+    if depth is None:
+        depth = int(depth_ratio * sample_sum.min())
+    kept_sample = sample_sum >= depth
+    if not kept_sample.all():
+        print(f"{(~kept_sample).sum()} samples have fewer than {depth} reads and are removed")
+    random_generator_list = [np.random.default_rng(i) for i in np.random.SeedSequence(seed).spawn(len(sample_sum))]
+    rarefied_array = np.zeros_like(count_array)
+    for sample_index in np.flatnonzero(kept_sample):
+        rarefied_array[:, sample_index] = random_generator_list[sample_index].multivariate_hypergeometric(
+            count_array[:, sample_index], depth)
+    rarefied_df = pd.DataFrame(rarefied_array, index=count_df.index, columns=count_df.columns)
+    rarefied_df = rarefied_df.loc[rarefied_array.sum(axis=1) > 0, kept_sample]
+    print(f"Rarefied {rarefied_df.shape[1]} samples to {depth} reads, {rarefied_df.shape[0]} taxa remain")
+    return rarefied_df
+
+
+def _distance_block(abundance_array, row_slice, col_slice, metric, x_log_x):
+    row_array = abundance_array[row_slice][:, None, :]
+    col_array = abundance_array[col_slice][None, :, :]
+    if metric == "jsd":
+        # sum of (x log(x/m) + y log(y/m)) / 2 = (sum x log x + sum y log y) / 2 - sum m log m, with m = (x + y) / 2
+        mean_array = (row_array + col_array) / 2
+        m_log_m = (mean_array * np.log(np.where(mean_array > 0, mean_array, 1))).sum(axis=2)
+        block = (x_log_x[row_slice][:, None] + x_log_x[col_slice][None, :]) / 2 - m_log_m
+        return np.maximum(block, 0)
+    # bray: sum |x - y| / sum (x + y)
+    pair_sum = abundance_array[row_slice].sum(axis=1)[:, None] + abundance_array[col_slice].sum(axis=1)[None, :]
+    return np.abs(row_array - col_array).sum(axis=2) / np.where(pair_sum > 0, pair_sum, 1)
+
+
+def pairwise_distance(count_df, metric="jsd", thread=4, block_mb=64):
+    """
+    Distances between all pairs of samples, computed in blocks of sample pairs by a thread pool (NumPy releases the
+    GIL), memory is bounded by thread * block_mb besides the n x n result
+    jsd: Jensen-Shannon divergence of relative abundances as phyloseq::distance(method="jsd") (natural log, no sqrt)
+    bray: Bray-Curtis dissimilarity of counts as phyloseq::distance(method="bray")
+    :param count_df: taxa by samples
+    :param metric: "jsd" or "bray"
+    :param thread: number of blocks computed at the same time
+    :param block_mb: memory of the temporary arrays of one block
+    :return: DataFrame of samples by samples
+    """
+    abundance_array = count_df.values.T.astype(float)
+    if metric == "jsd":
+        abundance_array /= np.maximum(abundance_array.sum(axis=1, keepdims=True), 1e-300)
+        x_log_x = (abundance_array * np.log(np.where(abundance_array > 0, abundance_array, 1))).sum(axis=1)
+    elif metric == "bray":
+        x_log_x = None
+    else:
+        raise ValueError(f"Unknown metric {metric}, use jsd or bray")
+    sample_number, taxon_number = abundance_array.shape
+    block_size = max(1, int(np.sqrt(block_mb * 1024 ** 2 / (8 * max(taxon_number, 1)))))
+    block_start_list = list(range(0, sample_number, block_size))
+    distance_array = np.zeros((sample_number, sample_number))
+
+    def fill_block(block_pair):
+        row_slice = slice(block_pair[0], min(block_pair[0] + block_size, sample_number))
+        col_slice = slice(block_pair[1], min(block_pair[1] + block_size, sample_number))
+        block = _distance_block(abundance_array, row_slice, col_slice, metric, x_log_x)
+        distance_array[row_slice, col_slice] = block
+        distance_array[col_slice, row_slice] = block.T
+
+    block_pair_list = [(i, j) for i in block_start_list for j in block_start_list if j >= i]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=thread) as executor:
+        list(executor.map(fill_block, block_pair_list))
+    np.fill_diagonal(distance_array, 0)
+    return pd.DataFrame(distance_array, index=count_df.columns, columns=count_df.columns)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("count_path", help="combined_counts_Species.parquet or .tsv")
+    parser.add_argument("output_prefix", help="e.g. beta_dir/Species")
+    parser.add_argument("--metric", choices=["jsd", "bray"], default="jsd")
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--mean-ra-threshold", type=float, default=0.001)
+    parser.add_argument("--prevalence-threshold", type=float, default=0.1)
+    parser.add_argument("--domain", default="Bacteria", help="lineages of this domain are kept, 'all' keeps all")
+    parser.add_argument("--no-rarefy", action="store_true")
+    parser.add_argument("--seed", type=int, default=123123)
+    args = parser.parse_args()
+
+    count_df = load_count_matrix(args.count_path)
+    count_df = filter_count_matrix(count_df, args.mean_ra_threshold, args.prevalence_threshold,
+                                   None if args.domain == "all" else args.domain)
+    if not args.no_rarefy:
+        count_df = rarefy_count_matrix(count_df, seed=args.seed)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output_prefix)), exist_ok=True)
+    count_df.to_csv(f"{args.output_prefix}_filtered_counts.tsv", sep="\t", index_label="taxon")
+    distance_df = pairwise_distance(count_df, args.metric, args.threads)
+    distance_df.to_csv(f"{args.output_prefix}_{args.metric}_distance.tsv", sep="\t", float_format="%.10g")
+    print(f"{args.metric} distances of {len(distance_df)} samples are written to "
+          f"{args.output_prefix}_{args.metric}_distance.tsv")
@@ -0,0 +1,37 @@
+"""
+This script plans a SLURM job array for one step: samples are bin-packed into balanced tasks by the size of their fqs,
+and each task runs the step script on its own sample list with resources sized for the step
+Steps: trim_galore, kneaddata, kraken2, humann3 (see pipe_meta.STEP_SBATCH_DICT)
+
+command line example:
+python generate_sbatch_array_20261016.py step_name sbatch_path number_of_tasks arguments_of_the_step_script
+python generate_sbatch_array_20261016.py humann3 sbatch/humann3_array.sh 20 kneaddata_dir humann3_dir metaphlan_dir metaphlan_index chocophlan_dir uniref_dir
+sbatch sbatch/humann3_array.sh
+with --resource-history among the step arguments, memory and time of the tasks are planned from earlier runs:
+python generate_sbatch_array_20261016.py humann3 sbatch/humann3_array.sh 20 kneaddata_dir humann3_dir ... --resource-history project_dir/resource_history.jsonl
+"""
+
+
+import importlib
+import itertools
+import pipeline_metagenomic as pipe_meta
+import shlex
+import sys
+
+
+if __name__ == "__main__":
+    step_name, path_sbatch, number_of_tasks = sys.argv[1:4]
+    step_arguments = sys.argv[4:]   # the first argument of every step script is its input directory
+    positional_argument_number = len(list(itertools.takewhile(lambda x: not x.startswith("--"), step_arguments)))
+    step_options = pipe_meta.parse_step_options(step_arguments[positional_argument_number:])
+    if step_options.resource_history is not None:
+        pipe_meta.set_resource_history(step_options.resource_history)
+    step_setting = pipe_meta.STEP_SBATCH_DICT[step_name]
+    step_module = importlib.import_module(step_setting["script"][:-len(".py")])
+    if step_name == "kneaddata" and step_options.fused_qc:
+        # the input directory of fused QC holds raw reads
+        sample_fq_dict = getattr(step_module, step_setting["builder"])(step_arguments[0], fused_qc=True)
+    else:
+        sample_fq_dict = getattr(step_module, step_setting["builder"])(step_arguments[0])
+    pipe_meta.generate_whole_pipeline_sbatch(path_sbatch, step_name, sample_fq_dict,
+                                             " ".join(shlex.quote(i) for i in step_arguments), int(number_of_tasks))
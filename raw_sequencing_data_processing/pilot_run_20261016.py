@@ -0,0 +1,213 @@
+"""
+This script is a pilot run of the whole pipeline on a small draw of read pairs of each sample: trim_galore, kneaddata,
+Kraken2 and (optionally) HUMAnN3 run on the draw, then runtimes of the full data are projected and host-read shares
+are reported, so failing samples and the resources of the full run are known before it starts. The steps run a second
+time on a much smaller draw (1% of the pilot draw), which measures the fixed cost of each step (e.g. loading a database)
+that does not grow with the read number
+
+command line example:
+python pilot_run_20261016.py raw_data_dir pilot_dir host_bowtie_ref kraken2_db_dir --pilot-reads 100000 --total-cores 32
+with HUMAnN3:
+python pilot_run_20261016.py raw_data_dir pilot_dir host_bowtie_ref kraken2_db_dir metaphlan_dir metaphlan_index chocophlan_dir uniref_dir --pilot-fraction 0.01
+outputs: pilot_dir/pilot_report.tsv, one row per sample
+"""
+
+
+import glob
+import itertools
+import numpy as np
+import os
+import pandas as pd
+import pipeline_metagenomic as pipe_meta
+import step1_trim_galore_20240715 as step1
+import step5_humann3_20240715 as step5
+import sys
+
+
+# step of the pipeline and the name its tool calls are recorded under in the metrics log
+PILOT_STEP_LIST = ["trim_galore", "kneaddata", "kraken2", "humann3"]
+# share of the pilot draw that is run again to measure the fixed cost of each step
+FIXED_COST_DRAW_SHARE = 0.01
+
+
+def run_pilot_steps(sample_id, pilot_fq_path_list, pilot_dir, host_bowtie_ref, kraken2_db_dir, humann3_db_list,
+                    thread, pilot_row, metrics_name_dict):
+    """
+    Run all steps on the drawn read pairs of one sample, an exception of a step is raised
+    :param pilot_row: read counts and shares of each step are added to it
+    :param metrics_name_dict: {step: name its tool calls are recorded under in the metrics log} is added to it before
+    each step runs, so its last step is the one that failed
+    """
+    step_name = "trim_galore"
+    metrics_name_dict[step_name] = pipe_meta.get_fq_prefix(pilot_fq_path_list[0])
+    trimmed_fq_path_list = pipe_meta.trim_galore_process_step1(os.path.join(pilot_dir, "trim_galore"),
+                                                               pilot_fq_path_list, 25, thread)
+    pilot_row["trimmed_pairs"] = pipe_meta.count_fq_reads(trimmed_fq_path_list[0])
+
+    step_name = "kneaddata"
+    knead_dir = os.path.join(pilot_dir, "kneaddata")
+    knead_prefix = pipe_meta.get_fq_prefix(trimmed_fq_path_list[0])
+    metrics_name_dict[step_name] = knead_prefix
+    clean_fq_path_list = pipe_meta.kneaddata_clean_step3(knead_dir, trimmed_fq_path_list, host_bowtie_ref, thread,
+                                                         remove_temp_files=False)
+    pilot_row["clean_pairs"] = pipe_meta.count_fq_reads(clean_fq_path_list[0])
+    # pairs of which both mates hit the host genome
+    contam_path_list = glob.glob(os.path.join(knead_dir, f"{knead_prefix}_kneaddata_*paired_contam_1.fastq"))
+    host_pairs = sum(pipe_meta.count_fq_reads(i) for i in contam_path_list)
+    pilot_row["host_percent"] = round(100 * host_pairs / max(pilot_row["trimmed_pairs"], 1), 2)
+
+    step_name = "kraken2"
+    kraken2_dir = os.path.join(pilot_dir, "kraken2")
+    metrics_name_dict[step_name] = sample_id
+    pipe_meta.kraken_process_step4([sample_id], [clean_fq_path_list], [kraken2_dir], kraken2_db_dir,
+                                   whether_use_mpa_style=True, thread=thread)
+    with open(os.path.join(kraken2_dir, f"{sample_id}_output.txt")) as kraken_output_f:
+        classified_list = [line.startswith("C") for line in kraken_output_f]
+    pilot_row["kraken2_classified_percent"] = round(100 * np.mean(classified_list), 2) if classified_list else 0
+
+    if humann3_db_list is not None:
+        step_name = "humann3"
+        sample_dir = os.path.join(pilot_dir, "humann3", sample_id)
+        os.makedirs(sample_dir, exist_ok=True)
+        metrics_name_dict[step_name] = sample_id
+        step5.humann3_sample_process(sample_id, clean_fq_path_list, sample_dir, *humann3_db_list, thread=thread)
+
+
+def pilot_sample(sample_id, fq_path_list, pilot_dir, host_bowtie_ref, kraken2_db_dir, humann3_db_list=None,
+                 read_number=None, fraction=None, seed=1, thread=4):
+    """
+    Draw read pairs of one sample and run all steps on them, a failed step stops the sample
+    The steps then run on FIXED_COST_DRAW_SHARE of the draw under pilot_dir/fixed_cost, a failure there only leaves the
+    fixed costs of the sample unmeasured
+    :param humann3_db_list: [metaphlan_dir, metaphlan_index, chocophlan_dir, uniref_dir], None skips HUMAnN3
+    :return: {"sample": sample_id, "total_pairs": ..., "pilot_pairs": ..., "failed_step": None, "metrics_names": {},
+    "fixed_cost_pairs": ..., "fixed_cost_metrics_names": {}}
+    """
+    pilot_row = {"sample": sample_id, "failed_step": None, "error": None}
+    # names the tool calls of each step are recorded under in the metrics log
+    metrics_name_dict = {}
+    fixed_cost_metrics_name_dict = {}
+    try:
+        raw_dir = os.path.join(pilot_dir, "raw_data")
+        os.makedirs(raw_dir, exist_ok=True)
+        pilot_fq_path_list = [os.path.join(raw_dir, os.path.basename(i)) for i in fq_path_list]
+        pilot_row["total_pairs"], pilot_row["pilot_pairs"] = pipe_meta.subsample_read_pairs(
+            fq_path_list, pilot_fq_path_list, read_number, fraction, seed)
+        run_pilot_steps(sample_id, pilot_fq_path_list, pilot_dir, host_bowtie_ref, kraken2_db_dir, humann3_db_list,
+                        thread, pilot_row, metrics_name_dict)
+    except Exception as e:
+        step_name = list(metrics_name_dict)[-1] if metrics_name_dict else "subsample"
+        print(f"Error! Pilot of {sample_id} failed at {step_name}: {e}")
+        pilot_row["failed_step"] = step_name
+        pilot_row["error"] = str(e)
+    fixed_cost_pairs = int(pilot_row.get("pilot_pairs", 0) * FIXED_COST_DRAW_SHARE)
+    if pilot_row["failed_step"] is None and fixed_cost_pairs > 0:
+        # prefixed file and sample names keep the tool calls apart from the pilot draw in the metrics log
+        fixed_cost_dir = os.path.join(pilot_dir, "fixed_cost")
+        os.makedirs(os.path.join(fixed_cost_dir, "raw_data"), exist_ok=True)
+        fixed_cost_fq_path_list = [os.path.join(fixed_cost_dir, "raw_data", f"fixed_cost_{os.path.basename(i)}")
+                                   for i in pilot_fq_path_list]
+        try:
+            _, pilot_row["fixed_cost_pairs"] = pipe_meta.subsample_read_pairs(pilot_fq_path_list,
+                                                                              fixed_cost_fq_path_list,
+                                                                              fixed_cost_pairs, None, seed)
+            run_pilot_steps(f"fixed_cost_{sample_id}", fixed_cost_fq_path_list, fixed_cost_dir, host_bowtie_ref,
+                            kraken2_db_dir, humann3_db_list, thread, {}, fixed_cost_metrics_name_dict)
+        except Exception as e:
+            print(f"Warning! Fixed costs of {sample_id} are not measured, {list(fixed_cost_metrics_name_dict)[-1:]} "
+                  f"failed on {fixed_cost_pairs} read pairs: {e}")
+    pilot_row["metrics_names"] = metrics_name_dict
+    pilot_row["fixed_cost_metrics_names"] = fixed_cost_metrics_name_dict
+    return pilot_row
+
+
+def step_metrics(metrics_df, metrics_name_series, step_name):
+    """
+    :param metrics_df: metrics log indexed by step and sample
+    :param metrics_name_series: {step: name in the metrics log} of each sample
+    :return: wall seconds and peak RSS GB of the step for each sample, NaN if it did not succeed
+    """
+    wall_list, rss_list = [], []
+    for metrics_name_dict in metrics_name_series:
+        metrics_key = (step_name, metrics_name_dict.get(step_name))
+        if metrics_key in metrics_df.index and metrics_df.loc[metrics_key, "returncode"] == 0:
+            wall_list.append(metrics_df.loc[metrics_key, "wall_seconds"])
+            rss_list.append(metrics_df.loc[metrics_key, "peak_rss_mb"] / 1024)
+        else:
+            wall_list.append(np.nan)
+            rss_list.append(np.nan)
+    return np.array(wall_list, dtype=float), np.array(rss_list, dtype=float)
+
+
+def project_runtimes(pilot_df, metrics_path):
+    """
+    Project the wall time of each step on the full data of each sample from the pilot runs
+    Wall time is modelled as a fixed cost (e.g. loading a database) plus a cost per read pair, both are solved from the
+    pilot draw and the much smaller fixed cost draw of the sample; only the cost per read pair is scaled to the full
+    data. A sample without a fixed cost draw takes the median fixed cost of the other samples, or 0 if none has one
+    :param pilot_df: rows of pilot_sample()
+    :param metrics_path: metrics log of the pilot run
+    :return: pilot_df with pilot_{step}_minutes, {step}_fixed_minutes, projected_{step}_hours and
+    pilot_{step}_peak_rss_gb columns
+    """
+    if not os.path.exists(metrics_path):
+        return pilot_df
+    metrics_df = pd.read_json(metrics_path, lines=True)
+    # the last attempt of each tool call
+    metrics_df = metrics_df.drop_duplicates(["step", "sample"], keep="last").set_index(["step", "sample"])
+    for step_name in PILOT_STEP_LIST:
+        wall_array, rss_array = step_metrics(metrics_df, pilot_df["metrics_names"], step_name)
+        if np.isnan(wall_array).all():
+            continue
+        pilot_pairs = pilot_df["pilot_pairs"].values.astype(float)
+        fixed_cost_wall_array = step_metrics(metrics_df, pilot_df["fixed_cost_metrics_names"], step_name)[0]
+        fixed_cost_pairs = (pilot_df["fixed_cost_pairs"].values.astype(float) if "fixed_cost_pairs" in pilot_df
+                            else np.full(len(pilot_df), np.nan))
+        # wall = fixed + per pair * pairs on both draws; noise can make either part negative, it is clipped to 0
+        seconds_per_pair = (wall_array - fixed_cost_wall_array) / (pilot_pairs - fixed_cost_pairs)
+        seconds_per_pair = np.where(np.isfinite(seconds_per_pair), np.maximum(seconds_per_pair, 0), np.nan)
+        fixed_seconds = np.clip(wall_array - seconds_per_pair * pilot_pairs, 0, wall_array)
+        measured = ~np.isnan(fixed_seconds)
+        fixed_seconds[~measured] = np.nanmedian(fixed_seconds) if measured.any() else 0
+        fixed_seconds = np.minimum(fixed_seconds, wall_array)
+        seconds_per_pair = np.where(measured, seconds_per_pair,
+                                    (wall_array - fixed_seconds) / np.maximum(pilot_pairs, 1))
+        pilot_df[f"pilot_{step_name}_minutes"] = np.round(wall_array / 60, 2)
+        pilot_df[f"{step_name}_fixed_minutes"] = np.round(fixed_seconds / 60, 2)
+        pilot_df[f"projected_{step_name}_hours"] = np.round((fixed_seconds + seconds_per_pair *
+                                                             pilot_df["total_pairs"].values) / 3600, 3)
+        pilot_df[f"pilot_{step_name}_peak_rss_gb"] = np.round(rss_array, 2)
+    return pilot_df
+
+
+if __name__ == "__main__":
+    positional_argument_list = list(itertools.takewhile(lambda x: not x.startswith("--"), sys.argv[1:]))
+    raw_data_dir, pilot_dir, host_bowtie_ref, kraken2_db_dir = positional_argument_list[:4]
+    humann3_db_list = positional_argument_list[4:8] if len(positional_argument_list) >= 8 else None
+    step_options = pipe_meta.parse_step_options(sys.argv[1 + len(positional_argument_list):])
+    if step_options.pilot_reads is None and step_options.pilot_fraction is None:
+        step_options.pilot_reads = 100000
+    metrics_path = pipe_meta.setup_metrics_log(step_options, pilot_dir)
+    pipe_meta.setup_command_execution(step_options, pilot_dir)
+    sample_fq_dict = step1.build_sample_dict_under_dir(raw_data_dir)
+    sample_fq_dict = pipe_meta.select_samples(sample_fq_dict, step_options.sample_list)
+
+    concurrent_job_number, thread_per_job = pipe_meta.allocate_job_resources(
+        len(sample_fq_dict), step_options.total_cores or 4, step_options.total_mem_gb or pipe_meta.node_memory_gb(),
+        # each pilot runs kraken2, which loads its own copy of the database
+        step_options.mem_per_job_gb or max(pipe_meta.STEP_RESOURCE_DEFAULTS["kraken2"]["mem_gb"],
+                                           pipe_meta.kraken_database_memory_gb(kraken2_db_dir) or 0),
+        max_thread=step_options.max_thread_per_job or 4)
+    job_dict = {sample_id: (lambda i=sample_id: pilot_sample(i, sample_fq_dict[i], pilot_dir, host_bowtie_ref,
+                                                               kraken2_db_dir, humann3_db_list,
+                                                               step_options.pilot_reads, step_options.pilot_fraction,
+                                                               step_options.pilot_seed, thread_per_job))
+                for sample_id in sample_fq_dict}
+    pilot_row_dict, _ = pipe_meta.run_jobs_async(job_dict, concurrent_job_number)
+    pilot_df = pd.DataFrame([pilot_row_dict[i] for i in sample_fq_dict if i in pilot_row_dict])
+    pilot_df = project_runtimes(pilot_df, metrics_path)
+    pilot_report_path = os.path.join(pilot_dir, "pilot_report.tsv")
+    pilot_df.drop(columns=["metrics_names", "fixed_cost_metrics_names"]).to_csv(pilot_report_path, sep="\t",
+                                                                                 index=False)
+    print(f"{pilot_df['failed_step'].notna().sum()} of {len(pilot_df)} samples failed in the pilot, "
+          f"see {pilot_report_path}")
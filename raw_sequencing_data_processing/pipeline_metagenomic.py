@@ -1,12 +1,33 @@
 import os
 import subprocess
+import argparse
+import asyncio
+import csv
+import glob
+import gzip
+import functools
+import hashlib
+import itertools
+import heapq
+import json
+import math
+import random
+import re
+import shlex
+import signal
+import threading
+import concurrent.futures
+import shutil
+import tempfile
 import numpy as np
 import pandas as pd
+import sample_manifest
 import sys
 import time
 import logging
 import logging.handlers
 import datetime
+import fcntl
 
 
 """
@@ -44,16 +65,1085 @@ def sample_list_divide(sample_list, number_of_parts):
     return sample_divided_list
 
 
-def generate_whole_pipeline_sbatch(path_sbatch):
+# default thread count and memory (GB) of one job of each step, used when running samples concurrently; a kraken2 job
+# without --kraken-batch loads its own copy of the database and needs at least kraken_database_memory_gb()
+STEP_RESOURCE_DEFAULTS = {"trim_galore": {"thread": 8, "mem_gb": 4},
+                          "fastqc": {"thread": 2, "mem_gb": 2},
+                          "kneaddata": {"thread": 4, "mem_gb": 8},
+                          "dedup": {"thread": 4, "mem_gb": 8},
+                          "kraken2": {"thread": 8, "mem_gb": 64},
+                          "humann3": {"thread": 16, "mem_gb": 32}}
+
+
+def parse_step_options(argv):
+    """
+    Optional arguments shared by all step scripts, given after the positional arguments of each script
+    :param argv: e.g. ["--total-cores", "64", "--total-mem-gb", "256"]
+    :return: argparse.Namespace, total_cores is None when no budget is declared (samples run one by one)
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--total-cores", type=int, default=None,
+                        help="core budget of the whole run, samples are processed concurrently within it")
+    parser.add_argument("--total-mem-gb", type=float, default=None,
+                        help="memory budget (GB) of the whole run, default is unlimited")
+    parser.add_argument("--mem-per-job-gb", type=float, default=None,
+                        help="memory (GB) needed by one sample job, default depends on the step")
+    parser.add_argument("--max-thread-per-job", type=int, default=None,
+                        help="upper limit of threads given to one sample job")
+    parser.add_argument("--sample-list", default=None,
+                        help="text file of sample names (one per line) to process, e.g. one task of a job array")
+    parser.add_argument("--metrics-log", default=None,
+                        help="JSONL of resource usage of every tool call, default is pipeline_metrics.jsonl in the "
+                             "output directory")
+    parser.add_argument("--resource-history", default=None,
+                        help="JSONL history of tool calls shared by runs, tool calls are appended to it and threads "
+                             "and memory of each sample are planned from it")
+    parser.add_argument("--log-dir", default=None,
+                        help="directory of per-sample tool logs, default is logs in the output directory")
+    parser.add_argument("--timeout-hours", type=float, default=None,
+                        help="time limit of one tool call, default depends on the step")
+    parser.add_argument("--retries", type=int, default=None,
+                        help="extra attempts after a failed tool call, default depends on the step")
+    parser.add_argument("--pilot-reads", type=int, default=None,
+                        help="pilot only: read pairs drawn from each sample, default 100000 if --pilot-fraction is "
+                             "not given")
+    parser.add_argument("--pilot-fraction", type=float, default=None,
+                        help="pilot only: share of read pairs drawn from each sample")
+    parser.add_argument("--pilot-seed", type=int, default=1,
+                        help="pilot only: seed of the read draw")
+    parser.add_argument("--qc-dir", default=None,
+                        help="write one-pass fq statistics (fastq_stats_report_step2) of the input fqs to this directory")
+    parser.add_argument("--fused-qc", action="store_true",
+                        help="kneaddata only: run trim_galore and kneaddata together on raw reads in local scratch")
+    parser.add_argument("--compress-level", type=int, default=6,
+                        help="kneaddata only: gzip level (1-9) of the kept outputs, 0 keeps them uncompressed")
+    parser.add_argument("--dedup-dir", default=None,
+                        help="kneaddata only: also write the kneaddata outputs with duplicate read pairs collapsed "
+                             "to this directory, the input directory of step4 and step5")
+    parser.add_argument("--scratch-dir", default=None,
+                        help="node-local directory for intermediate files, default is $TMPDIR")
+    parser.add_argument("--combine-format", choices=["tsv", "parquet"], default=None,
+                        help="combine the reports of all samples into one table of this format after the step")
+    parser.add_argument("--kraken-batch", action="store_true",
+                        help="Kraken2 only: stage the database once and memory-map it for all samples")
+    parser.add_argument("--kraken-stage-dir", default="/dev/shm",
+                        help="Kraken2 only: where the database is staged in batch mode")
+    parser.add_argument("--reanalyze-confidence", type=float, nargs="+", default=None,
+                        help="Kraken2 only: recount the per-read output of each sample under these confidence "
+                             "thresholds without running Kraken2 again")
+    parser.add_argument("--minimum-hit-groups", type=int, default=1,
+                        help="Kraken2 only: minimum hit groups used by --reanalyze-confidence, 1 (no filter) matches "
+                             "kraken 2.0.8, Kraken2 >= 2.1 uses 2")
+    parser.add_argument("--taxonomy-dir", default=None,
+                        help="Kraken2 only: nodes.dmp and names.dmp for --reanalyze-confidence, default is "
+                             "the taxonomy directory of the database")
+    return parser.parse_args(argv)
+
+
+def node_cpu_count():
+    """
+    :return: cores this job may use: SLURM_CPUS_PER_TASK inside a SLURM job, otherwise the CPU affinity of the process
+    (e.g. taskset or a cgroup cpuset), all cores of the node where the affinity is not available
+    """
+    if os.environ.get("SLURM_CPUS_PER_TASK", "").isdigit():
+        return int(os.environ["SLURM_CPUS_PER_TASK"])
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+
+def node_memory_gb():
+    """
+    :return: memory (GB) of this node, or of the cgroup of the job (e.g. a SLURM allocation) if that is smaller
+    """
+    memory_bytes = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    for cgroup_limit_path in ["/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"]:
+        try:
+            with open(cgroup_limit_path) as limit_f:
+                memory_bytes = min(memory_bytes, int(limit_f.read().strip()))
+        except (OSError, ValueError):
+            # no such cgroup file or "max" (no limit)
+            pass
+    return memory_bytes / 1024 ** 3
+
+
+def allocate_job_resources(sample_number, total_cores, total_mem_gb=None, mem_per_job_gb=0, min_thread=1,
+                           max_thread=None):
+    """
+    Split a core and memory budget across concurrent jobs
+    :param sample_number: number of jobs to run, 500
+    :param total_cores: 64
+    :param total_mem_gb: 256, None means memory is not limited
+    :param mem_per_job_gb: 32
+    :param min_thread: the least threads one job should get
+    :param max_thread: the most threads one job should get, None means no limit
+    :return: (number of concurrent jobs, thread of each job), e.g. (8, 8)
+    """
+    concurrent_job_number = max(1, min(sample_number, total_cores // max(1, min_thread)))
+    if max_thread is not None:
+        # enough jobs to give each one up to max_thread threads
+        concurrent_job_number = max(1, min(concurrent_job_number, total_cores // max_thread))
+    if total_mem_gb is not None and mem_per_job_gb:
+        concurrent_job_number = max(1, min(concurrent_job_number, int(total_mem_gb // mem_per_job_gb)))
+    thread_per_job = max(min_thread, total_cores // concurrent_job_number)
+    if max_thread is not None:
+        thread_per_job = min(thread_per_job, max_thread)
+    return concurrent_job_number, thread_per_job
+
+
+def run_samples_concurrently(sample_job_dict, step_function, total_cores, total_mem_gb=None, mem_per_job_gb=0,
+                             min_thread=1, max_thread=None, step_name=None, input_path_dict=None, min_mem_gb=None):
+    """
+    Run one step function for many samples at once, each call gets a fair share of the core budget
+    With a resource history (set_resource_history) that has enough runs of the step, each sample instead gets the
+    threads and memory planned from its input size (plan_sample_resources), and a sample starts as soon as its cores
+    and memory are free within the budget, largest samples first
+    Jobs are external tools, so a thread pool is enough to keep them running in parallel
+    :param sample_job_dict: {"sample1": (args, kwargs)}, step_function(*args, thread=X, **kwargs) is called per sample
+    :param step_function: e.g. trim_galore_process_step1, it must accept the keyword argument "thread"
+    :param total_cores: core budget of all concurrent jobs
+    :param total_mem_gb: memory budget (GB) of all concurrent jobs, None means not limited
+    :param mem_per_job_gb: memory (GB) needed by one job
+    :param min_thread: the least threads one job should get
+    :param max_thread: the most threads one job should get
+    :param step_name: step of the resource history to plan from, e.g. "humann3", None uses the fair share
+    :param input_path_dict: {"sample1": ["path/XXX_R1.fq.gz", "path/XXX_R2.fq.gz"]}, input files used for planning
+    :param min_mem_gb: planned memory of a job is never below this, e.g. --mem-per-job-gb given by the user
+    :return: {"sample1": return value of step_function}; if any sample failed, PipelineCommandError is raised once
+    all samples are finished
+    """
+    if not sample_job_dict:
+        return {}
+    resource_plan_dict = None
+    if step_name is not None and input_path_dict is not None:
+        resource_plan_dict = plan_sample_resources(step_name, {i: input_path_dict[i] for i in sample_job_dict},
+                                                   min(max_thread or total_cores, total_cores), min_thread,
+                                                   total_mem_gb, min_mem_gb)
+    if resource_plan_dict is None:
+        concurrent_job_number, thread_per_job = allocate_job_resources(len(sample_job_dict), total_cores,
+                                                                       total_mem_gb, mem_per_job_gb, min_thread,
+                                                                       max_thread)
+        print(f"Run {len(sample_job_dict)} samples by {step_function.__name__}: {concurrent_job_number} concurrent "
+              f"jobs, {thread_per_job} threads per job")
+        job_dict = {sample_name: functools.partial(step_function, *args, thread=thread_per_job, **kwargs)
+                    for sample_name, (args, kwargs) in sample_job_dict.items()}
+    else:
+        print(f"Run {len(sample_job_dict)} samples by {step_function.__name__} with planned resources: "
+              f"{min(i['thread'] for i in resource_plan_dict.values())}-"
+              f"{max(i['thread'] for i in resource_plan_dict.values())} threads, "
+              f"{min(i['mem_gb'] for i in resource_plan_dict.values())}-"
+              f"{max(i['mem_gb'] for i in resource_plan_dict.values())} GB per job")
+        free_resource_dict = {"cores": total_cores, "mem_gb": total_mem_gb}
+        resource_condition = threading.Condition()
+
+        def run_with_resources(sample_name, job_function):
+            thread, mem_gb = resource_plan_dict[sample_name]["thread"], resource_plan_dict[sample_name]["mem_gb"]
+            with resource_condition:
+                resource_condition.wait_for(lambda: free_resource_dict["cores"] >= thread and (
+                    total_mem_gb is None or free_resource_dict["mem_gb"] >= mem_gb))
+                free_resource_dict["cores"] -= thread
+                if total_mem_gb is not None:
+                    free_resource_dict["mem_gb"] -= mem_gb
+            try:
+                return job_function()
+            finally:
+                with resource_condition:
+                    free_resource_dict["cores"] += thread
+                    if total_mem_gb is not None:
+                        free_resource_dict["mem_gb"] += mem_gb
+                    resource_condition.notify_all()
+
+        # longest samples first, so that short ones fill the cores at the end
+        sample_name_list = sorted(sample_job_dict, key=lambda x: -resource_plan_dict[x]["hours"])
+        job_dict = {sample_name: functools.partial(run_with_resources, sample_name, functools.partial(
+            step_function, *sample_job_dict[sample_name][0], thread=resource_plan_dict[sample_name]["thread"],
+            **sample_job_dict[sample_name][1])) for sample_name in sample_name_list}
+        concurrent_job_number = min(len(job_dict), total_cores // max(1, min_thread))
+    sample_result_dict, failed_sample_list = run_jobs_async(job_dict, concurrent_job_number)
+    if failed_sample_list:
+        raise PipelineCommandError(f"{len(failed_sample_list)} samples failed in {step_function.__name__}: "
+                                   f"{sorted(failed_sample_list)}")
+    return sample_result_dict
+
+
+def run_jobs_async(job_dict, max_concurrent):
+    """
+    Run blocking jobs (step functions or run_tool_command calls) concurrently under an asyncio event loop, each job
+    runs in a worker thread, at most max_concurrent at a time; a failed job does not stop the others
+    :param job_dict: {"sample1": function without arguments}
+    :param max_concurrent: number of jobs running at the same time
+    :return: {"sample1": return value}, [names of failed jobs]
+    """
+    async def run_all_jobs(loop, executor):
+        job_name_list = list(job_dict.keys())
+        result_list = await asyncio.gather(*[loop.run_in_executor(executor, job_dict[i]) for i in job_name_list],
+                                           return_exceptions=True)
+        return list(zip(job_name_list, result_list))
+
+    loop = asyncio.new_event_loop()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(max_concurrent, 1)) as executor:
+            job_result_list = loop.run_until_complete(run_all_jobs(loop, executor))
+    finally:
+        loop.close()
+    result_dict = {}
+    failed_job_list = []
+    for job_name, result in job_result_list:
+        if isinstance(result, Exception):
+            print(f"Error! {job_name} failed: {result}")
+            failed_job_list.append(job_name)
+        else:
+            result_dict[job_name] = result
+    return result_dict, failed_job_list
+
+
+def run_commands_concurrently(command_job_list, max_concurrent):
+    """
+    :param command_job_list: [(command, step_name, sample_name, thread, input_path_list)], see run_tool_command()
+    :param max_concurrent: number of commands running at the same time
+    :return: names (sample_name) of the failed commands
+    """
+    job_dict = {command_job[2]: functools.partial(run_tool_command, *command_job) for command_job in command_job_list}
+    return run_jobs_async(job_dict, max_concurrent)[1]
+
+
+# JSONL file where every external tool invocation appends its resource usage, see set_metrics_log()
+PIPELINE_METRICS_PATH = os.environ.get("METAGENOMIC_METRICS_LOG")
+_metrics_lock = threading.Lock()
+
+
+def set_metrics_log(metrics_path):
+    """
+    :param metrics_path: "output_dir/pipeline_metrics.jsonl", None stops recording
+    :return:
+    """
+    global PIPELINE_METRICS_PATH
+    PIPELINE_METRICS_PATH = metrics_path
+
+
+def setup_metrics_log(step_options, output_dir):
+    """
+    Start recording tool metrics of a step script
+    :param step_options: result of parse_step_options()
+    :param output_dir: output directory of the step, the default metrics log is written there
+    :return: metrics_path
+    """
+    metrics_path = step_options.metrics_log or os.path.join(output_dir, "pipeline_metrics.jsonl")
+    os.makedirs(os.path.dirname(os.path.abspath(metrics_path)), exist_ok=True)
+    set_metrics_log(metrics_path)
+    if step_options.resource_history is not None:
+        set_resource_history(step_options.resource_history)
+    return metrics_path
+
+
+def _read_proc_io(pid):
+    # /proc/<pid>/io of a finished but not yet reaped child includes the I/O of its reaped descendants (Linux only)
+    try:
+        with open(f"/proc/{pid}/io") as io_f:
+            return {i.split(":")[0]: int(i.split(":")[1]) for i in io_f if ":" in i}
+    except (OSError, ValueError):
+        return {}
+
+
+# seconds between two samples of the memory of a running tool
+RSS_POLL_SECONDS = 1
+
+
+def _session_memory_kb(session_id, skip_cmdline):
+    """
+    Memory of the processes of a session (a tool and its children, see _run_tool_once), from /proc (Linux only)
+    :param session_id: pid of the session leader
+    :param skip_cmdline: command line of the pipeline; a child that has not exec-ed the tool yet is still a copy of
+    the pipeline process and is left out
+    :return: (sum of VmRSS, largest VmHWM) in KB
+    """
+    rss_sum_kb, hwm_max_kb = 0, 0
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f"/proc/{pid}/stat") as stat_f:
+                # fields after the command name: state, ppid, pgrp, session, ...
+                if int(stat_f.read().rsplit(")", 1)[1].split()[3]) != session_id:
+                    continue
+            with open(f"/proc/{pid}/cmdline", "rb") as cmdline_f:
+                if cmdline_f.read() == skip_cmdline:
+                    continue
+            with open(f"/proc/{pid}/status") as status_f:
+                status_dict = {i.split(":")[0]: i.split()[1] for i in status_f if i.startswith(("VmRSS", "VmHWM"))}
+        except (OSError, ValueError, IndexError):
+            continue
+        rss_sum_kb += int(status_dict.get("VmRSS", 0))
+        hwm_max_kb = max(hwm_max_kb, int(status_dict.get("VmHWM", 0)))
+    return rss_sum_kb, hwm_max_kb
+
+
+def _poll_peak_rss(session_id, stop_event, peak_rss_kb_list):
+    """
+    Peak memory of a tool's process tree while it runs: the largest sum of VmRSS over the tree, or the largest VmHWM
+    of one process if that is higher (peaks between two samples)
+    ru_maxrss of wait4() is not used, on Linux it keeps the RSS the child had before exec, i.e. that of the pipeline
+    """
+    with open("/proc/self/cmdline", "rb") as cmdline_f:
+        self_cmdline = cmdline_f.read()
+    while True:
+        peak_rss_kb_list[0] = max(peak_rss_kb_list[0], *_session_memory_kb(session_id, self_cmdline))
+        if stop_event.wait(RSS_POLL_SECONDS):
+            break
+
+
+class PipelineCommandError(RuntimeError):
+    """An external tool failed (non-zero exit code or time limit) in all its attempts"""
+
+
+# time limit (hours) of one tool call of each step and extra attempts after a failed call; timeouts are not retried
+STEP_COMMAND_POLICY = {"trim_galore": {"timeout_hours": 12, "retries": 1},
+                       "fastqc": {"timeout_hours": 6, "retries": 1},
+                       "kneaddata": {"timeout_hours": 48, "retries": 1},
+                       "kraken2": {"timeout_hours": 24, "retries": 1},
+                       "humann3": {"timeout_hours": 120, "retries": 0}}
+# wait before the first retry, doubled for each later one
+RETRY_BACKOFF_SECONDS = 60
+# directory of per-sample tool logs, see setup_command_execution(), None leaves tool output on the console
+PIPELINE_LOG_DIR = None
+
+
+def setup_command_execution(step_options, output_dir):
+    """
+    Per-sample tool logs and limits of the tool calls of a step script
+    :param step_options: result of parse_step_options()
+    :param output_dir: output directory of the step, the default log directory is output_dir/logs
+    :return: log directory
+    """
+    global PIPELINE_LOG_DIR
+    PIPELINE_LOG_DIR = step_options.log_dir or os.path.join(output_dir, "logs")
+    os.makedirs(PIPELINE_LOG_DIR, exist_ok=True)
+    for command_policy in STEP_COMMAND_POLICY.values():
+        if step_options.timeout_hours is not None:
+            command_policy["timeout_hours"] = step_options.timeout_hours
+        if step_options.retries is not None:
+            command_policy["retries"] = step_options.retries
+    return PIPELINE_LOG_DIR
+
+
+def _kill_process_group(pid, timeout_flag_list):
+    timeout_flag_list.append(True)
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+def _run_tool_once(command, step_name, sample_name, thread, input_bytes, log_f, timeout_hours, attempt):
+    """
+    One attempt of run_tool_command(), the tool runs in its own process group so that a timeout kills all its children
+    :return: return code, whether the time limit was hit
+    """
+    start_time = time.time()
+    process = subprocess.Popen(shlex.split(command), stdout=log_f, stderr=subprocess.STDOUT if log_f else None,
+                               start_new_session=True)
+    timeout_flag_list = []
+    peak_rss_kb_list = [0]
+    rss_stop_event = threading.Event()
+    rss_thread = None
+    if os.path.exists("/proc/self/status"):
+        rss_thread = threading.Thread(target=_poll_peak_rss, args=(process.pid, rss_stop_event, peak_rss_kb_list),
+                                      daemon=True)
+        rss_thread.start()
+    timer = None
+    if timeout_hours is not None:
+        timer = threading.Timer(timeout_hours * 3600, _kill_process_group, [process.pid, timeout_flag_list])
+        timer.daemon = True
+        timer.start()
+    proc_io = {}
+    try:
+        if hasattr(os, "waitid"):
+            # wait for the exit without reaping, so that /proc/<pid>/io can still be read
+            os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+            proc_io = _read_proc_io(process.pid)
+    except BaseException:
+        # e.g. KeyboardInterrupt, the tool is not in the process group of the terminal
+        _kill_process_group(process.pid, [])
+        raise
+    finally:
+        if timer is not None:
+            timer.cancel()     # before reaping, the pid cannot be reused until then
+        if rss_thread is not None:
+            rss_stop_event.set()
+            rss_thread.join()
+    _, wait_status, child_usage = os.wait4(process.pid, 0)
+    wall_seconds = time.time() - start_time
+    process.returncode = os.WEXITSTATUS(wait_status) if os.WIFEXITED(wait_status) else -os.WTERMSIG(wait_status)
+    if PIPELINE_METRICS_PATH is not None or PIPELINE_RESOURCE_HISTORY_PATH is not None:
+        # ru_maxrss (KB on Linux) is only used where /proc cannot be polled
+        peak_rss_kb = peak_rss_kb_list[0] if rss_thread is not None else child_usage.ru_maxrss
+        metrics = {"time": datetime.datetime.fromtimestamp(start_time).isoformat(timespec="seconds"),
+                   "step": step_name, "sample": sample_name, "thread": thread, "input_bytes": input_bytes,
+                   "returncode": process.returncode, "attempt": attempt + 1, "timed_out": bool(timeout_flag_list),
+                   "wall_seconds": round(wall_seconds, 3),
+                   "user_cpu_seconds": round(child_usage.ru_utime, 3),
+                   "system_cpu_seconds": round(child_usage.ru_stime, 3),
+                   "peak_rss_mb": round(peak_rss_kb / 1024, 1),
+                   "read_bytes": proc_io.get("read_bytes"), "write_bytes": proc_io.get("write_bytes"),
+                   "rchar": proc_io.get("rchar"), "wchar": proc_io.get("wchar"), "command": command}
+        with _metrics_lock:
+            if PIPELINE_METRICS_PATH is not None:
+                with open(PIPELINE_METRICS_PATH, "a") as metrics_f:
+                    metrics_f.write(json.dumps(metrics) + "\n")
+            if PIPELINE_RESOURCE_HISTORY_PATH is not None:
+                with open(PIPELINE_RESOURCE_HISTORY_PATH, "a") as history_f:
+                    history_f.write(json.dumps({i: metrics[i] for i in RESOURCE_HISTORY_FIELDS}) + "\n")
+    return process.returncode, bool(timeout_flag_list)
+
+
+def run_tool_command(command, step_name, sample_name, thread=None, input_path_list=(), log_path=None,
+                     timeout_hours=None, retries=None, check=True):
+    """
+    Run an external tool: its output is streamed to a per-sample log file, a call over the time limit is killed with
+    its children, a failed call is retried after a backoff; wall time, CPU time, peak RSS and I/O of the process tree
+    of every attempt are recorded to PIPELINE_METRICS_PATH
+    :param command: command line, e.g. "kneaddata --input XXX_R1.fq.gz ..."; quoted parts are kept together
+    :param step_name: "kneaddata"
+    :param sample_name: "sample1"
+    :param thread: thread count given to the tool
+    :param input_path_list: input files, their total size is recorded
+    :param log_path: default PIPELINE_LOG_DIR/sample1.kneaddata.log, output goes to the console if both are None
+    :param timeout_hours: time limit of one attempt, default from STEP_COMMAND_POLICY, None is no limit
+    :param retries: extra attempts after a failed one, default from STEP_COMMAND_POLICY
+    :param check: raise PipelineCommandError if the tool fails in all attempts
+    :return: return code of the tool
+    """
+    command_policy = STEP_COMMAND_POLICY.get(step_name, {})
+    if timeout_hours is None:
+        timeout_hours = command_policy.get("timeout_hours")
+    if retries is None:
+        retries = command_policy.get("retries", 0)
+    if log_path is None and PIPELINE_LOG_DIR is not None:
+        log_path = os.path.join(PIPELINE_LOG_DIR, f"{sample_name}.{step_name}.log")
+    input_bytes = sum(os.path.getsize(i) for i in input_path_list if os.path.isfile(i))
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            backoff_seconds = RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1)
+            print(f"Retry {step_name} of {sample_name} in {backoff_seconds} seconds, attempt {attempt + 1}")
+            time.sleep(backoff_seconds)
+        log_f = None
+        if log_path is not None:
+            log_f = open(log_path, "ab")
+            log_f.write(f"# {datetime.datetime.now().isoformat(timespec='seconds')} attempt {attempt + 1}: "
+                        f"{command}\n".encode())
+            log_f.flush()
+        try:
+            return_code, timed_out = _run_tool_once(command, step_name, sample_name, thread, input_bytes, log_f,
+                                                    timeout_hours, attempt)
+        finally:
+            if log_f is not None:
+                log_f.close()
+        if return_code == 0:
+            return return_code
+        failure = f"hit the time limit of {timeout_hours} hours" if timed_out else f"exited with code {return_code}"
+        log_hint = f" (log: {log_path})" if log_path is not None else ""
+        print(f"Error! {step_name} of {sample_name} {failure}{log_hint}: {command}")
+        if timed_out:
+            break
+    if check:
+        raise PipelineCommandError(f"{step_name} of {sample_name} failed: {command}")
+    return return_code
+
+
+def summarize_metrics(metrics_path, summary_path):
+    """
+    Summary report of a run from the JSONL written by run_tool_command(), one row per step
+    :param metrics_path: "output_dir/pipeline_metrics.jsonl"
+    :param summary_path: "output_dir/pipeline_metrics_summary.tsv"
+    :return: summary DataFrame, None if no tool has been run
+    """
+    if not os.path.exists(metrics_path):
+        return None
+    metrics_df = pd.read_json(metrics_path, lines=True)
+    metrics_df["cpu_seconds"] = metrics_df["user_cpu_seconds"] + metrics_df["system_cpu_seconds"]
+    summary_df = metrics_df.groupby("step").agg(sample_number=("sample", "nunique"),
+                                                failed_number=("returncode", lambda x: int((x != 0).sum())),
+                                                total_wall_hours=("wall_seconds", lambda x: x.sum() / 3600),
+                                                mean_wall_minutes=("wall_seconds", lambda x: x.mean() / 60),
+                                                max_wall_minutes=("wall_seconds", lambda x: x.max() / 60),
+                                                total_cpu_hours=("cpu_seconds", lambda x: x.sum() / 3600),
+                                                max_peak_rss_gb=("peak_rss_mb", lambda x: x.max() / 1024),
+                                                total_input_gb=("input_bytes", lambda x: x.sum() / 1024 ** 3),
+                                                total_read_gb=("rchar", lambda x: x.sum() / 1024 ** 3),
+                                                total_write_gb=("wchar", lambda x: x.sum() / 1024 ** 3))
+    # share of the given threads that were busy on average
+    thread_seconds = (metrics_df["wall_seconds"] * metrics_df["thread"].fillna(1)).groupby(metrics_df["step"]).sum()
+    summary_df["cpu_efficiency"] = metrics_df.groupby("step")["cpu_seconds"].sum() / thread_seconds
+    summary_df.round(3).to_csv(summary_path, sep="\t")
+    return summary_df
+
+
+# JSONL history of tool calls of all runs (e.g. shared by a project), see set_resource_history()
+PIPELINE_RESOURCE_HISTORY_PATH = os.environ.get("METAGENOMIC_RESOURCE_HISTORY")
+# fields of a metrics record that are kept in the history, so pipeline_metrics.jsonl files can be used as history too
+RESOURCE_HISTORY_FIELDS = ["time", "step", "sample", "thread", "input_bytes", "returncode", "timed_out",
+                           "wall_seconds", "user_cpu_seconds", "system_cpu_seconds", "peak_rss_mb"]
+# the latest records of each step used to fit its cost model, and the least needed to trust it
+RESOURCE_HISTORY_RECORDS_PER_STEP = 1000
+RESOURCE_MODEL_MIN_RECORDS = 5
+# a sample gets the most threads that keep (speedup / threads) at least this high
+PLANNER_MIN_EFFICIENCY = 0.5
+# planned memory is the worst fitted peak RSS of the history times this factor
+PLANNER_MEMORY_SAFETY = 1.2
+_resource_model_cache = {}
+
+
+def set_resource_history(history_path):
+    """
+    :param history_path: "project_dir/resource_history.jsonl", tool calls are appended to it and plan_sample_resources()
+    fits its cost models on it; None stops both
+    :return:
+    """
+    global PIPELINE_RESOURCE_HISTORY_PATH
+    PIPELINE_RESOURCE_HISTORY_PATH = history_path
+    if history_path is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(history_path)), exist_ok=True)
+
+
+def load_resource_history(history_path):
+    """
+    :param history_path: resource history or pipeline_metrics.jsonl
+    :return: DataFrame of the successful tool calls, the latest RESOURCE_HISTORY_RECORDS_PER_STEP of each step
+    """
+    if history_path is None or not os.path.exists(history_path) or os.path.getsize(history_path) == 0:
+        return None
+    history_df = pd.read_json(history_path, lines=True)
+    history_df = history_df[(history_df["returncode"] == 0) & ~history_df["timed_out"].fillna(False).astype(bool) &
+                            (history_df["input_bytes"] > 0)]
+    return history_df.groupby("step", sort=False).tail(RESOURCE_HISTORY_RECORDS_PER_STEP)
+
+
+def _fit_nonnegative(feature_array, target_array):
+    """
+    Least squares with non-negative coefficients, by trying every subset of the few features
+    :return: coefficient array, one per column of feature_array
+    """
+    best_coefficient_array, best_residual = np.zeros(feature_array.shape[1]), np.inf
+    for subset_size in range(1, feature_array.shape[1] + 1):
+        for column_subset in itertools.combinations(range(feature_array.shape[1]), subset_size):
+            subset_coefficient_array = np.linalg.lstsq(feature_array[:, column_subset], target_array, rcond=None)[0]
+            if (subset_coefficient_array < 0).any():
+                continue
+            coefficient_array = np.zeros(feature_array.shape[1])
+            coefficient_array[list(column_subset)] = subset_coefficient_array
+            residual = np.sum((feature_array @ coefficient_array - target_array) ** 2)
+            if residual < best_residual:
+                best_coefficient_array, best_residual = coefficient_array, residual
+    return best_coefficient_array
+
+
+def fit_step_cost_model(history_df, step_name):
+    """
+    Cost model of one step from its history
+    Wall time follows Amdahl's law, wall = serial + parallel / thread, where the serial and parallel seconds of each
+    call are recovered from its CPU and wall time (cpu = serial + parallel) and grow linearly with the input GB;
+    peak memory grows linearly with the input GB and the threads, the largest underestimate of the history is added
+    :param history_df: result of load_resource_history()
+    :param step_name: "humann3"
+    :return: {"records": 120, "serial": [seconds, seconds per GB], "parallel": [...] or None if no call used more than
+    one thread, "memory": [GB, GB per input GB, GB per thread], "memory_margin_gb": 1.5}, None without enough records
+    """
+    if history_df is None:
+        return None
+    step_df = history_df[history_df["step"] == step_name]
+    if len(step_df) < RESOURCE_MODEL_MIN_RECORDS:
+        return None
+    input_gb = step_df["input_bytes"].values / 1024 ** 3
+    thread = step_df["thread"].fillna(1).values.astype(float)
+    wall_seconds = step_df["wall_seconds"].values
+    cpu_seconds = (step_df["user_cpu_seconds"] + step_df["system_cpu_seconds"]).values
+    cost_model = {"records": len(step_df), "parallel": None}
+    multi_thread = thread > 1
+    if multi_thread.sum() >= RESOURCE_MODEL_MIN_RECORDS:
+        # cpu - wall = parallel * (thread - 1) / thread; I/O wait counts as serial time
+        parallel_seconds = np.clip((cpu_seconds - wall_seconds) * thread / np.maximum(thread - 1, 1), 0,
+                                   wall_seconds * thread)[multi_thread]
+        serial_seconds = np.maximum(wall_seconds[multi_thread] - parallel_seconds / thread[multi_thread], 0)
+        size_feature_array = np.column_stack([np.ones(multi_thread.sum()), input_gb[multi_thread]])
+        cost_model["serial"] = _fit_nonnegative(size_feature_array, serial_seconds).tolist()
+        cost_model["parallel"] = _fit_nonnegative(size_feature_array, parallel_seconds).tolist()
+    else:
+        size_feature_array = np.column_stack([np.ones(len(step_df)), input_gb])
+        cost_model["serial"] = _fit_nonnegative(size_feature_array, wall_seconds).tolist()
+    memory_feature_array = np.column_stack([np.ones(len(step_df)), input_gb, thread])
+    peak_gb = step_df["peak_rss_mb"].values / 1024
+    memory_coefficient_array = _fit_nonnegative(memory_feature_array, peak_gb)
+    cost_model["memory"] = memory_coefficient_array.tolist()
+    cost_model["memory_margin_gb"] = float(max(0, np.max(peak_gb - memory_feature_array @ memory_coefficient_array)))
+    return cost_model
+
+
+def get_step_cost_model(step_name):
+    """
+    :param step_name: "humann3"
+    :return: fit_step_cost_model() of the current resource history, refitted only when the history has changed
+    """
+    history_path = PIPELINE_RESOURCE_HISTORY_PATH
+    if history_path is None or not os.path.exists(history_path):
+        return None
+    cache_key = (os.path.abspath(history_path), os.path.getmtime(history_path), step_name)
+    if cache_key not in _resource_model_cache:
+        _resource_model_cache[cache_key] = fit_step_cost_model(load_resource_history(history_path), step_name)
+    return _resource_model_cache[cache_key]
+
+
+def predict_step_resources(cost_model, input_gb, thread):
+    """
+    :param cost_model: result of fit_step_cost_model()
+    :param input_gb: input size of the sample
+    :param thread: threads given to the tool
+    :return: (wall hours, memory GB to request)
+    """
+    serial_seconds = cost_model["serial"][0] + cost_model["serial"][1] * input_gb
+    parallel_seconds = 0 if cost_model["parallel"] is None else \
+        cost_model["parallel"][0] + cost_model["parallel"][1] * input_gb
+    memory_gb = (np.dot(cost_model["memory"], [1, input_gb, thread]) + cost_model["memory_margin_gb"]) * \
+        PLANNER_MEMORY_SAFETY
+    return (serial_seconds + parallel_seconds / thread) / 3600, max(0.5, float(memory_gb))
+
+
+def plan_sample_resources(step_name, input_path_dict, max_thread, min_thread=1, max_mem_gb=None, min_mem_gb=None):
+    """
+    Threads and memory of each sample from the cost model of the step, so small samples do not hold cores they
+    cannot use and large ones get the memory they need
+    :param step_name: "humann3"
+    :param input_path_dict: {"sample1": ["path/XXX_R1.fq.gz", "path/XXX_R2.fq.gz"]}
+    :param max_thread: the most threads one sample can get
+    :param min_thread: the least threads one sample gets
+    :param max_mem_gb: memory budget, a sample is never planned above it
+    :param min_mem_gb: a sample is never planned below it, None means no floor
+    :return: {"sample1": {"thread": 6, "mem_gb": 12.5, "hours": 1.2}}, None if the history of the step is too short
+    """
+    cost_model = get_step_cost_model(step_name)
+    if cost_model is None:
+        return None
+    resource_plan_dict = {}
+    for sample_name, input_path_list in input_path_dict.items():
+        input_gb = sum(os.path.getsize(i) for i in input_path_list if os.path.isfile(i)) / 1024 ** 3
+        thread = max_thread
+        if cost_model["parallel"] is not None:
+            serial_seconds = cost_model["serial"][0] + cost_model["serial"][1] * input_gb
+            parallel_seconds = cost_model["parallel"][0] + cost_model["parallel"][1] * input_gb
+            if serial_seconds > 0:
+                # efficiency (serial + parallel) / (thread * serial + parallel) >= PLANNER_MIN_EFFICIENCY
+                thread = int(((serial_seconds + parallel_seconds) / PLANNER_MIN_EFFICIENCY - parallel_seconds) /
+                             serial_seconds)
+        thread = int(min(max_thread, max(min_thread, thread)))
+        hours, mem_gb = predict_step_resources(cost_model, input_gb, thread)
+        if min_mem_gb is not None:
+            mem_gb = max(mem_gb, min_mem_gb)
+        if max_mem_gb is not None and mem_gb > max_mem_gb:
+            print(f"Warning! {sample_name} may need {mem_gb:.1f} GB for {step_name}, more than the budget of "
+                  f"{max_mem_gb} GB")
+            mem_gb = max_mem_gb
+        resource_plan_dict[sample_name] = {"thread": thread, "mem_gb": round(mem_gb, 1), "hours": round(hours, 3)}
+    return resource_plan_dict
+
+
+def planned_thread(step_name, input_path_list, default_thread, max_thread=None):
+    """
+    Threads of one sample run on its own (no --total-cores), from the cost model of the step
+    :param step_name: "trim_galore"
+    :param input_path_list: input files of the sample
+    :param default_thread: used without enough history
+    :param max_thread: the most threads, default is all cores this job may use (node_cpu_count)
+    :return: thread count
+    """
+    resource_plan_dict = plan_sample_resources(step_name, {"sample": input_path_list}, max_thread or node_cpu_count())
+    return default_thread if resource_plan_dict is None else resource_plan_dict["sample"]["thread"]
+
+
+def file_signature(file_path, checksum=False):
+    """
+    :param file_path: "PATH/XXX_R1.fq.gz"
+    :param checksum: also compute md5 of the content, slow for large files
+    :return: {"path": absolute path, "size": bytes, "mtime": modification time (, "md5": md5)}
+    """
+    file_stat = os.stat(file_path)
+    signature = {"path": os.path.abspath(file_path), "size": file_stat.st_size, "mtime": int(file_stat.st_mtime)}
+    if checksum:
+        md5 = hashlib.md5()
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(16 * 1024 * 1024), b""):
+                md5.update(block)
+        signature["md5"] = md5.hexdigest()
+    return signature
+
+
+def database_signature(db_path):
+    """
+    Names and sizes of the files of a database, independent of where the database is (e.g. staged in /dev/shm)
+    :param db_path: a file, a directory (its top-level files; of a Kraken2 database only KRAKEN_DATABASE_FILES, the
+    files kraken2 reads and stage_kraken_database copies) or an index prefix like "PATH/hg38/hg38" (hg38.*.bt2)
+    :return: [["hg38.1.bt2", 1034], ...]
+    """
+    if os.path.isdir(db_path):
+        db_file_name_list = os.listdir(db_path)
+        if all(i in db_file_name_list for i in KRAKEN_DATABASE_FILES):
+            db_file_name_list = KRAKEN_DATABASE_FILES
+        db_file_path_list = [os.path.join(db_path, i) for i in db_file_name_list]
+    elif os.path.isfile(db_path):
+        db_file_path_list = [db_path]
+    else:
+        db_file_path_list = glob.glob(f"{db_path}*")
+    return sorted([os.path.basename(i), os.path.getsize(i)] for i in db_file_path_list if os.path.isfile(i))
+
+
+def database_signature_matches(recorded_signature, db_path):
+    """
+    :param recorded_signature: database signature saved in a step manifest
+    :param db_path: the database used now
+    :return: whether they are the same database; manifests written before Kraken2 databases were signed by
+    KRAKEN_DATABASE_FILES only also list the other files of the directory, which are ignored
+    """
+    current_signature = database_signature(db_path)
+    if recorded_signature == current_signature:
+        return True
+    if [i[0] for i in current_signature] == sorted(KRAKEN_DATABASE_FILES):
+        return [i for i in recorded_signature if i[0] in KRAKEN_DATABASE_FILES] == current_signature
+    return False
+
+
+def normalize_command(command, db_path_list=()):
+    """
+    Command line of a step without the parts that do not change its outputs (threads, database location)
+    Arguments are split as the shell does, so a quoted path with spaces is one argument, and quoted again only if
+    they contain whitespace
+    """
+    command = " ".join("<db>" if i in db_path_list else shlex.quote(i) if re.search(r"\s", i) else i
+                       for i in shlex.split(command))
+    command = re.sub(r"--(threads|cores) \d+ ?", "", command)
+    return command.replace("--memory-mapping ", "").strip()
+
+
+def step_manifest_path(output_dir, step_name, sample_name):
+    """
+    :return: "output_dir/.step_manifest/sample1.kneaddata.json"
+    """
+    return os.path.join(output_dir, ".step_manifest", f"{sample_name}.{step_name}.json")
+
+
+def step_is_complete(manifest_path, input_path_list, command, db_path_list=(), checksum=False):
+    """
+    A step of one sample is complete when its manifest matches the current inputs, command and databases, and all
+    outputs recorded in the manifest still exist with the recorded sizes
+    :param manifest_path: result of step_manifest_path()
+    :param input_path_list: input files of the step
+    :param command: command line of the tool
+    :param db_path_list: databases used by the step
+    :param checksum: compare md5 of inputs instead of size + mtime only
+    :return: True or False
+    """
+    if not os.path.exists(manifest_path):
+        return False
+    try:
+        with open(manifest_path) as manifest_f:
+            manifest = json.load(manifest_f)
+        current_input_list = [file_signature(i, checksum) for i in input_path_list]
+    except (OSError, ValueError):
+        return False
+    if manifest.get("inputs") != current_input_list or \
+            manifest.get("command") != normalize_command(command, db_path_list) or \
+            len(manifest.get("databases", [])) != len(db_path_list) or \
+            not all(database_signature_matches(i, j) for i, j in zip(manifest["databases"], db_path_list)):
+        return False
+    for output_signature in manifest.get("outputs", []):
+        if not os.path.exists(output_signature["path"]) or \
+                os.path.getsize(output_signature["path"]) != output_signature["size"]:
+            return False
+    return True
+
+
+def write_step_manifest(manifest_path, input_path_list, command, output_path_list, db_path_list=(), checksum=False):
+    """
+    Record a finished step of one sample
+    A tool that exits with 0 but leaves an output missing or empty has failed: nothing is recorded and
+    PipelineCommandError is raised
+    :return: True if the manifest is written
+    """
+    missing_output_list = [i for i in output_path_list if not os.path.exists(i) or os.path.getsize(i) == 0]
+    if missing_output_list:
+        raise PipelineCommandError(f"Outputs are missing or empty: {missing_output_list}, the step is not recorded "
+                                   f"as complete")
+    manifest = {"inputs": [file_signature(i, checksum) for i in input_path_list],
+                "command": normalize_command(command, db_path_list),
+                "databases": [database_signature(i) for i in db_path_list],
+                "database_paths": list(db_path_list),
+                "outputs": [file_signature(i) for i in output_path_list],
+                "finished": datetime.datetime.now().isoformat(timespec="seconds")}
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    temp_manifest_path = f"{manifest_path}.tmp"
+    with open(temp_manifest_path, "w") as manifest_f:
+        json.dump(manifest, manifest_f, indent=1)
+    os.replace(temp_manifest_path, manifest_path)
+    return True
+
+
+def remove_partial_outputs(manifest_path, output_path_list):
+    """
+    Before (re)running a step, remove its stale manifest and any outputs left by an interrupted run
+    """
+    for file_path in [manifest_path] + list(output_path_list):
+        if os.path.exists(file_path):
+            print(f"Remove incomplete output {file_path}")
+            os.remove(file_path)
+
+
+def read_feature_report(report_path, sample_name=None, drop_zero=True):
+    """
+    Read a two-column report (feature, value) of one sample, e.g. HUMAnN3 pathabundance/genefamilies or Kraken2 report
+    :param report_path: "XXX_pathabundance.tsv"
+    :param sample_name: column name of this sample, None means the report has a header line that provides it
+    :param drop_zero: only keep features with non-zero value
+    :return: (feature column name, sample name, feature array, value array)
+    """
+    feature_column_name = "feature"
+    header_line_number = 0
+    if sample_name is None:
+        with open(report_path) as report_f:
+            feature_column_name, sample_name = report_f.readline().rstrip("\n").split("\t")[:2]
+        header_line_number = 1
+    report_df = pd.read_csv(report_path, sep="\t", header=None, skiprows=header_line_number, usecols=[0, 1],
+                            quoting=csv.QUOTE_NONE, dtype={0: object, 1: np.float64}, engine="c")
+    feature_array = report_df[0].values
+    value_array = report_df[1].values
+    if drop_zero:
+        non_zero = value_array != 0
+        feature_array, value_array = feature_array[non_zero], value_array[non_zero]
+    return feature_column_name, sample_name, feature_array, value_array
+
+
+def _read_feature_report_args(args):
+    return read_feature_report(*args)
+
+
+def combine_feature_reports(report_path_list, sample_name_list=None, processes=4):
+    """
+    Align per-sample reports into one sparse feature x sample matrix in a single pass, reports are read in parallel
+    Reports are read in batches of a few per process and each report's features are turned into row indexes of a
+    growing vocabulary as soon as it arrives, so only one copy of every distinct feature name is kept in memory
+    :param report_path_list: ["S1_pathabundance.tsv", "S2_pathabundance.tsv"]
+    :param sample_name_list: sample names of reports without a header line, None means names come from the headers
+    :param processes: number of processes reading reports
+    :return: dict with "feature_column_name", "features" (pd.Index), "samples" (list) and the coordinate (COO) arrays
+    "rows", "cols" (int32), "values" of the non-zero entries
+    """
+    if sample_name_list is None:
+        sample_name_list = [None] * len(report_path_list)
+    read_args_list = list(zip(report_path_list, sample_name_list))
+    feature_column_name = None
+    sample_names = []
+    # feature name -> row index, in order of first appearance
+    feature_code_dict = {}
+    row_array_list, value_array_list = [], []
+    executor = None
+    if processes > 1 and len(read_args_list) > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=processes)
+    batch_size = max(1, processes * 4)
+    try:
+        for batch_start in range(0, len(read_args_list), batch_size):
+            batch_args_list = read_args_list[batch_start:batch_start + batch_size]
+            if executor is None:
+                report_iterator = map(_read_feature_report_args, batch_args_list)
+            else:
+                report_iterator = executor.map(_read_feature_report_args, batch_args_list)
+            for report_feature_column_name, sample_name, feature_array, value_array in report_iterator:
+                if feature_column_name is None:
+                    feature_column_name = report_feature_column_name
+                sample_names.append(sample_name)
+                row_array_list.append(np.fromiter(
+                    (feature_code_dict.setdefault(i, len(feature_code_dict)) for i in feature_array),
+                    dtype=np.int32, count=len(feature_array)))
+                value_array_list.append(value_array)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    features = pd.Index(list(feature_code_dict), dtype=object)
+    del feature_code_dict
+    sample_codes = np.repeat(np.arange(len(sample_names), dtype=np.int32), [len(i) for i in row_array_list])
+    rows = np.concatenate(row_array_list) if row_array_list else np.zeros(0, dtype=np.int32)
+    values = np.concatenate(value_array_list) if value_array_list else np.zeros(0)
+    return {"feature_column_name": feature_column_name, "features": features, "samples": sample_names,
+            "rows": rows, "cols": sample_codes, "values": values}
+
+
+def write_feature_matrix(feature_matrix, output_path, output_format="tsv", block_rows=100000):
+    """
+    Write the result of combine_feature_reports()
+    :param feature_matrix: result of combine_feature_reports()
+    :param output_path: "combined_pathabundance.tsv" or "combined_pathabundance.parquet"
+    :param output_format: "tsv" writes a dense table block by block (zeros filled), "parquet" writes the non-zero
+    entries as a long table (feature, sample, value) with dictionary-encoded names, needs pyarrow
+    :param block_rows: number of features per dense block in tsv output
+    :return:
+    """
+    features, samples = feature_matrix["features"], feature_matrix["samples"]
+    rows, cols, values = feature_matrix["rows"], feature_matrix["cols"], feature_matrix["values"]
+    feature_column_name = feature_matrix["feature_column_name"]
+    if output_format == "parquet":
+        long_df = pd.DataFrame({feature_column_name: pd.Categorical.from_codes(rows, features),
+                                "sample": pd.Categorical.from_codes(cols, samples),
+                                "value": values})
+        long_df.to_parquet(output_path, index=False)
+    elif output_format == "tsv":
+        order = np.argsort(rows, kind="stable")
+        rows, cols, values = rows[order], cols[order], values[order]
+        with open(output_path, "w") as output_f:
+            output_f.write("\t".join([feature_column_name] + list(samples)) + "\n")
+            for block_start in range(0, len(features), block_rows):
+                block_end = min(block_start + block_rows, len(features))
+                entry_start, entry_end = np.searchsorted(rows, [block_start, block_end])
+                dense_block = np.zeros((block_end - block_start, len(samples)), dtype=values.dtype)
+                dense_block[rows[entry_start:entry_end] - block_start, cols[entry_start:entry_end]] = \
+                    values[entry_start:entry_end]
+                block_df = pd.DataFrame(dense_block, index=features[block_start:block_end], columns=samples)
+                block_df.to_csv(output_f, sep="\t", header=False)
+    else:
+        print(f"Error! Unknown output format {output_format}, use tsv or parquet.")
+        sys.exit()
+
+
+def subset_feature_matrix(feature_matrix, feature_mask):
+    """
+    Keep some features of the result of combine_feature_reports(), row indexes are renumbered
+    :param feature_matrix: result of combine_feature_reports()
+    :param feature_mask: boolean array with one value per feature
+    :return: a feature matrix dict of the same layout
+    """
+    new_row_index = np.cumsum(feature_mask) - 1
+    entry_mask = feature_mask[feature_matrix["rows"]]
+    subset_matrix = dict(feature_matrix)
+    subset_matrix.update({"features": feature_matrix["features"][feature_mask],
+                          "rows": new_row_index[feature_matrix["rows"][entry_mask]].astype(np.int32),
+                          "cols": feature_matrix["cols"][entry_mask],
+                          "values": feature_matrix["values"][entry_mask]})
+    return subset_matrix
+
+
+def pack_samples_by_size(sample_size_dict, number_of_parts):
+    """
+    Split samples into parts of balanced total size (largest sample first, always to the lightest part)
+    :param sample_size_dict: {"sample1": 3.2e9, "sample2": 1.1e9}, e.g. bytes of the input fqs
+    :param number_of_parts: 3
+    :return: [["sample1"], ["sample2", "sample3"], ...], parts without samples are left out
+    """
+    part_heap = [(0, part_index, []) for part_index in range(number_of_parts)]
+    for sample_name in sorted(sample_size_dict, key=lambda x: (-sample_size_dict[x], x)):
+        part_size, part_index, part_sample_list = heapq.heappop(part_heap)
+        part_sample_list.append(sample_name)
+        heapq.heappush(part_heap, (part_size + sample_size_dict[sample_name], part_index, part_sample_list))
+    return [i[2] for i in sorted(part_heap, key=lambda x: x[1]) if i[2]]
+
+
+def select_samples(sample_fq_dict, sample_list_path=None):
+    """
+    :param sample_fq_dict: {"sample1": ["path/XXX_R1.fq.gz", "path/XXX_R2.fq.gz"]}
+    :param sample_list_path: text file with one sample name per line, None keeps all samples
+    :return: sample_fq_dict restricted to the listed samples
+    """
+    if sample_list_path is None:
+        return sample_fq_dict
+    with open(sample_list_path) as sample_list_f:
+        sample_name_set = {i.strip() for i in sample_list_f if i.strip()}
+    return {i: j for i, j in sample_fq_dict.items() if i in sample_name_set}
+
+
+# script, sample discovery function, modules and SLURM resources of one array task of each step
+# hours_per_gb is the wall time per GB of input fq, used to size --time of each task
+# "options" are appended to the step arguments of every task, the kraken2 tasks classify their samples in one
+# kraken2 process (--kraken-batch), so --mem holds one copy of the database instead of one per concurrent sample
+STEP_SBATCH_DICT = {"trim_galore": {"script": "step1_trim_galore_20240715.py", "builder": "build_sample_dict_under_dir",
+                                    "modules": ["trimgalore/0.6.6"], "options": [],
+                                    "cpus": 8, "mem_gb": 16, "hours_per_gb": 0.2, "min_hours": 2, "max_hours": 72},
+                    "kneaddata": {"script": "step3_kneaddata_20240715.py", "builder": "build_sample_dict_under_dir",
+                                  "modules": ["python/cpu/3.7.2", "bowtie2/2.3.5.1"], "options": [],
+                                  "cpus": 8, "mem_gb": 32, "hours_per_gb": 0.5, "min_hours": 4, "max_hours": 72},
+                    "kraken2": {"script": "step4_kraken2_20240715.py", "builder": "build_sample_dict_under_dir",
+                                "modules": ["kraken/2.0.8", "python/cpu/3.6.5"], "options": ["--kraken-batch"],
+                                "cpus": 16, "mem_gb": 180, "hours_per_gb": 0.1, "min_hours": 2, "max_hours": 72},
+                    "humann3": {"script": "step5_humann3_20240715.py",
+                                "builder": "build_gz_sample_dict_under_kneaddata",
+                                "modules": ["python/cpu/3.7.2"], "options": [],
+                                "cpus": 16, "mem_gb": 64, "hours_per_gb": 2, "min_hours": 8, "max_hours": 168}}
+
+
+def generate_whole_pipeline_sbatch(path_sbatch, step_name, sample_fq_dict, step_arguments, number_of_tasks,
+                                   partition="cpu_medium", step_resource=None):
+    """
+    Plan a SLURM job array for one step: samples are bin-packed by fq size into balanced tasks, each task runs the
+    step script on its own sample list with resources sized for the step
+    With a resource history (set_resource_history) of the step, --mem covers the planned memory of the largest sample
+    and --time the planned hours of the heaviest task, instead of the fixed values of STEP_SBATCH_DICT
+    :param path_sbatch: "sbatch_dir/humann3_array.sh", task sample lists are written next to it
+    :param step_name: "trim_galore", "kneaddata", "kraken2" or "humann3"
+    :param sample_fq_dict: {"sample1": ["path/XXX_R1.fq.gz", "path/XXX_R2.fq.gz"]}, from the step's discovery function
+    :param step_arguments: positional (and optional) arguments of the step script, e.g. "kneaddata_dir humann3_dir ..."
+    :param number_of_tasks: number of array tasks
+    :param partition: SLURM partition
+    :param step_resource: overrides of STEP_SBATCH_DICT[step_name], e.g. {"mem_gb": 120}
+    :return: [["sample1", "sample3"], ["sample2"]], sample list of each task
+    """
+    step_setting = dict(STEP_SBATCH_DICT[step_name])
+    step_setting.update(step_resource or {})
+    sample_size_dict = sample_manifest.sample_fq_size_dict(sample_fq_dict)
+    task_sample_list = pack_samples_by_size(sample_size_dict, number_of_tasks)
+    sbatch_dir = os.path.dirname(os.path.abspath(path_sbatch))
+    os.makedirs(sbatch_dir, exist_ok=True)
+    for task_index, sample_list in enumerate(task_sample_list):
+        with open(os.path.join(sbatch_dir, f"{step_name}_task_{task_index}.txt"), "w") as task_f:
+            task_f.write("\n".join(sample_list) + "\n")
+    # the wall time of the whole array is set by its heaviest task
+    max_task_gb = max(sum(sample_size_dict[i] for i in j) for j in task_sample_list) / 1024 ** 3
+    task_estimate_hours = max_task_gb * step_setting["hours_per_gb"]
+    resource_plan_dict = plan_sample_resources(step_name, sample_fq_dict, step_setting["cpus"])
+    if resource_plan_dict is not None:
+        # samples of a task run within its cores, the task is not shorter than the sum of sample hours / cores
+        task_estimate_hours = max(sum(resource_plan_dict[i]["hours"] * resource_plan_dict[i]["thread"] for i in j) /
+                                  step_setting["cpus"] for j in task_sample_list)
+        if "mem_gb" not in (step_resource or {}):
+            step_setting["mem_gb"] = int(np.ceil(max(i["mem_gb"] for i in resource_plan_dict.values())))
+        print(f"Resources are planned from the history of {step_name}: {step_setting['mem_gb']} GB, "
+              f"{task_estimate_hours:.1f} hours for the heaviest task")
+    task_hours = int(min(step_setting["max_hours"], max(step_setting["min_hours"],
+                                                           np.ceil(task_estimate_hours * 1.5))))
+    print(f"{len(sample_size_dict)} samples are packed into {len(task_sample_list)} tasks, the largest task has "
+          f"{max_task_gb:.1f} GB of fq, time limit is {task_hours} hours")
+    script_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), step_setting["script"])
+    module_lines = "".join(f"module add {i}\n" for i in step_setting["modules"])
+    # every task gets its own sample list and the cores and memory of the allocation appended below, copies of these
+    # options among the step arguments would conflict with them
+    task_argument_list = []
+    step_argument_iter = iter(shlex.split(step_arguments))
+    for argument in step_argument_iter:
+        if argument.split("=")[0] in ["--sample-list", "--total-cores", "--total-mem-gb"]:
+            option_value = argument.split("=", 1)[1] if "=" in argument else next(step_argument_iter, "")
+            print(f"Warning! {argument.split('=')[0]} {option_value} of the step arguments is replaced by the "
+                  f"setting of each task")
+            continue
+        task_argument_list.append(argument)
+    step_arguments = " ".join(shlex.quote(i) for i in task_argument_list)
+    step_arguments += "".join(f" {i}" for i in step_setting["options"] if i not in step_arguments.split())
     with open(path_sbatch, "w") as sbatch_f:
         sbatch_f.write(f"#!/bin/bash\n"
-                       f"#SBATCH --partition=cpu_medium\n"
-                       f"#SBATCH --job-name=metagenomic\n"
-                       f"#SBATCH --mem-per-cpu=20G\n"
-                       f"#SBATCH --time=72:00:00\n"
+                       f"#SBATCH --partition={partition}\n"
+                       f"#SBATCH --job-name=metagenomic_{step_name}\n"
+                       f"#SBATCH --mem={step_setting['mem_gb']}G\n"
+                       f"#SBATCH --time={task_hours}:00:00\n"
                        f"#SBATCH --tasks=1\n"
-                       f"#SBATCH --cpus-per-task=4\n"
-                       f"#SBATCH --nodes=1\n\n")
+                       f"#SBATCH --cpus-per-task={step_setting['cpus']}\n"
+                       f"#SBATCH --nodes=1\n"
+                       f"#SBATCH --array=0-{len(task_sample_list) - 1}\n"
+                       f"#SBATCH --output={sbatch_dir}/{step_name}_task_%a.log\n\n"
+                       f"{module_lines}\n"
+                       f"python {script_path} {step_arguments} "
+                       f"--sample-list {sbatch_dir}/{step_name}_task_${{SLURM_ARRAY_TASK_ID}}.txt "
+                       f"--total-cores ${{SLURM_CPUS_PER_TASK}} --total-mem-gb {step_setting['mem_gb']}\n")
+    return task_sample_list
 
 
 ##########################################################################
@@ -65,22 +1155,46 @@ def generate_whole_pipeline_sbatch(path_sbatch):
 ##########################################################################
 
 
-def trim_galore_process_step1(output_dir, fq_path_list, quality_threshold, thread):
+def get_fq_prefix(fq_path):
+    """
+    :param fq_path: "PATH/XXX_R1.fq.gz" or "PATH/XXX_R1.fastq"
+    :return: "XXX_R1"
+    """
+    fq_name = os.path.split(fq_path)[-1]
+    if fq_name.endswith("gz"):
+        return ".".join(fq_name.split(".")[:-2])
+    # XXX.fq or XXX.fastq
+    return ".".join(fq_name.split(".")[:-1])
+
+
+def trim_galore_process_step1(output_dir, fq_path_list, quality_threshold, thread, gzip_output=True, resume=True):
     """
     trim the low quality bases at 3' reads end of input fq, just paired-end reads of one sample
     :param output_dir:
     :param fq_path_list: [XXX_R1.fq, XXX_R2.fq]
     :param quality_threshold:
-    :return:
+    :param gzip_output: False writes plain fq (XXX_R1_val_1.fq), used when the next step reads them from local scratch
+    :param resume: skip the sample if its step manifest shows it is complete, otherwise clean partial outputs first
+    :return: [XXX_R1_val_1.fq.gz, XXX_R2_val_2.fq.gz]
     """
-    if not os.path.exists(output_dir):
-        os.system(f"mkdir -p {output_dir}")
-    step1a_cmd = f"trim_galore --paired --gzip --output_dir {output_dir} --cores {thread} --clip_R1 1 --clip_R2 1 " \
-                 f"--three_prime_clip_R1 1 --three_prime_clip_R2 1 --quality {quality_threshold} " \
-                 f"{fq_path_list[0]} {fq_path_list[1]} --no_report_file"
-    process = subprocess.Popen(step1a_cmd.split(), stdout=subprocess.PIPE)
-    output, error = process.communicate()
-    print(output, error)
+    os.makedirs(output_dir, exist_ok=True)
+    gzip_option = "--gzip" if gzip_output else "--dont_gzip"
+    step1a_cmd = f"trim_galore --paired {gzip_option} --output_dir {shlex.quote(output_dir)} --cores {thread} " \
+                 f"--clip_R1 1 --clip_R2 1 --three_prime_clip_R1 1 --three_prime_clip_R2 1 " \
+                 f"--quality {quality_threshold} {shlex.quote(fq_path_list[0])} {shlex.quote(fq_path_list[1])} --no_report_file"
+    output_suffix = ".fq.gz" if gzip_output else ".fq"
+    output_path_list = [os.path.join(output_dir, f"{get_fq_prefix(fq_path_list[i])}_val_{i + 1}{output_suffix}")
+                        for i in range(2)]
+    manifest_path = step_manifest_path(output_dir, "trim_galore", get_fq_prefix(fq_path_list[0]))
+    if resume:
+        if step_is_complete(manifest_path, fq_path_list, step1a_cmd):
+            print(f"{fq_path_list} has been trimmed. Skip it!")
+            return output_path_list
+        remove_partial_outputs(manifest_path, output_path_list)
+    run_tool_command(step1a_cmd, "trim_galore", get_fq_prefix(fq_path_list[0]), thread, fq_path_list)
+    if resume:
+        write_step_manifest(manifest_path, fq_path_list, step1a_cmd, output_path_list)
+    return output_path_list
 
 
 def fastqc_report_step2(qc_output_dir, fq_path_list, thread):
@@ -88,44 +1202,365 @@ def fastqc_report_step2(qc_output_dir, fq_path_list, thread):
     optional step, generate quality report for fq file, not really process the fq
     :param qc_output_dir:
     :param fq_path_list:
+    :param thread: number of fq files processed at the same time
+    :return: names of the fq files that failed
+    """
+    os.makedirs(qc_output_dir, exist_ok=True)
+    command_job_list = [(f"fastqc {shlex.quote(fq_path)} -t 1 -o {shlex.quote(qc_output_dir)}", "fastqc",
+                         get_fq_prefix(fq_path), 1, [fq_path]) for fq_path in fq_path_list]
+    return run_commands_concurrently(command_job_list, thread)
+
+
+def open_fq(fq_path):
+    """
+    :param fq_path: "XXX.fq" or "XXX.fq.gz"
+    :return: binary file object
+    """
+    if fq_path.endswith(".gz"):
+        return gzip.open(fq_path, "rb")
+    return open(fq_path, "rb")
+
+
+def count_fq_reads(fq_path, block_size=16 * 1024 * 1024):
+    """
+    :param fq_path: "XXX.fq" or "XXX.fq.gz"
+    :return: number of reads (lines / 4)
+    """
+    line_number = 0
+    with open_fq(fq_path) as fq_f:
+        for block in iter(lambda: fq_f.read(block_size), b""):
+            line_number += block.count(b"\n")
+    return line_number // 4
+
+
+def subsample_read_pairs(fq_path_list, output_path_list, read_number=None, fraction=None, seed=1):
+    """
+    Draw read pairs of one sample in a single pass over its fqs, the mates of a pair are always drawn together
+    A fixed read_number is drawn by reservoir sampling (Algorithm L, only the kept pairs are held in memory) and
+    written in input order; a fraction keeps each pair with that probability
+    :param fq_path_list: ["PATH/XXX_R1.fq.gz", "PATH/XXX_R2.fq.gz"], or one fq of single-end reads
+    :param output_path_list: ["pilot/XXX_R1.fq.gz", "pilot/XXX_R2.fq.gz"], gzipped at level 1
+    :param read_number: number of pairs to draw, all pairs are kept if the sample has fewer
+    :param fraction: share of pairs to draw, used if read_number is None
+    :param seed: seed of the random draw
+    :return: number of read pairs of the input, number of read pairs drawn
+    """
+    random_generator = random.Random(seed)
+    fq_f_list = [open_fq(i) for i in fq_path_list]
+    output_f_list = [gzip.open(i, "wb", compresslevel=1) for i in output_path_list]
+    try:
+        # each read pair is a tuple of the 4 lines of each mate
+        read_pair_iter = zip(*[zip(fq_f, fq_f, fq_f, fq_f) for fq_f in fq_f_list])
+        if read_number is None:
+            total_pair_number, drawn_pair_number = 0, 0
+            for read_pair in read_pair_iter:
+                total_pair_number += 1
+                if random_generator.random() < fraction:
+                    drawn_pair_number += 1
+                    for output_f, read in zip(output_f_list, read_pair):
+                        output_f.writelines(read)
+            return total_pair_number, drawn_pair_number
+        reservoir = list(enumerate(itertools.islice(read_pair_iter, read_number)))
+        total_pair_number = len(reservoir)
+        # Algorithm L: jump straight to the index of the next pair that enters the reservoir
+        weight = math.exp(math.log(random_generator.random()) / read_number)
+        next_index = read_number + int(math.log(random_generator.random()) / math.log(1 - weight))
+        for read_pair in read_pair_iter:
+            if total_pair_number == next_index:
+                reservoir[random_generator.randrange(read_number)] = (total_pair_number, read_pair)
+                weight *= math.exp(math.log(random_generator.random()) / read_number)
+                next_index += int(math.log(random_generator.random()) / math.log(1 - weight)) + 1
+            total_pair_number += 1
+        reservoir.sort(key=lambda x: x[0])
+        for _, read_pair in reservoir:
+            for output_f, read in zip(output_f_list, read_pair):
+                output_f.writelines(read)
+        return total_pair_number, len(reservoir)
+    finally:
+        for fq_f in fq_f_list + output_f_list:
+            fq_f.close()
+
+
+def fastq_file_stats(fq_path, chunk_reads=50000, duplication_reads=1000000, duplication_prefix_length=50):
+    """
+    One-pass statistics of a fq file, reads are processed in chunks by NumPy
+    Per-base arrays are uint8/int32, so a file peaks at about 0.3 GB with the duplication set (150 bp reads)
+    :param fq_path: "PATH/XXX_R1.fq.gz"
+    :param chunk_reads: reads per chunk
+    :param duplication_reads: the duplication rate is estimated from this many reads at the start of the file
+    :param duplication_prefix_length: reads with the same prefix of this length are counted as duplicates (as FastQC)
+    :return: dict of summary values, per-position mean quality, per-position N rate, length histogram and
+    per-read GC histogram (percent)
+    """
+    quality_sum, position_count, position_n_count = np.zeros(0), np.zeros(0), np.zeros(0)
+    length_histogram, gc_histogram = np.zeros(0, dtype=np.int64), np.zeros(101, dtype=np.int64)
+    base_count = np.zeros(256, dtype=np.int64)
+    read_number, q30_base_number = 0, 0
+    seen_prefix_set, duplication_observed = set(), 0
+    with open_fq(fq_path) as fq_f:
+        while True:
+            chunk_lines = list(itertools.islice(fq_f, 4 * chunk_reads))
+            if len(chunk_lines) < 4:
+                break
+            if not chunk_lines[-1].endswith(b"\n"):
+                chunk_lines[-1] += b"\n"     # last line of a file without final newline
+            seq_lines, qual_lines = chunk_lines[1::4], chunk_lines[3::4]
+            # all reads of the chunk in one buffer, newlines included, with the position of each byte in its read
+            seq_buffer = np.frombuffer(b"".join(seq_lines), dtype=np.uint8)
+            qual_buffer = np.frombuffer(b"".join(qual_lines), dtype=np.uint8) - np.uint8(33)
+            position_dtype = np.int32 if len(seq_buffer) < 2 ** 31 else np.int64     # int64 only for huge long reads
+            read_lengths = np.fromiter((len(i) for i in seq_lines), dtype=position_dtype, count=len(seq_lines)) - 1
+            read_starts = np.concatenate(([0], np.cumsum(read_lengths + 1)[:-1])).astype(position_dtype)
+            base_position = np.arange(len(seq_buffer), dtype=position_dtype) - np.repeat(read_starts, read_lengths + 1)
+            is_base = base_position < np.repeat(read_lengths, read_lengths + 1)
+            base_position, seq_bases, qual_values = base_position[is_base], seq_buffer[is_base], qual_buffer[is_base]
+            max_length = int(read_lengths.max()) + 1
+            if max_length > len(quality_sum):
+                quality_sum, position_count, position_n_count = [np.pad(i, (0, max_length - len(i))) for i in
+                                                                 (quality_sum, position_count, position_n_count)]
+            quality_sum[:max_length] += np.bincount(base_position, weights=qual_values, minlength=max_length)
+            position_count[:max_length] += np.bincount(base_position, minlength=max_length)
+            is_n = (seq_bases == ord("N")) | (seq_bases == ord("n"))
+            position_n_count[:max_length] += np.bincount(base_position[is_n], minlength=max_length)
+            q30_base_number += int(np.count_nonzero(qual_values >= 30))
+            base_count += np.bincount(seq_bases, minlength=256)
+            # GC percent of each read
+            is_gc = np.isin(seq_bases, np.frombuffer(b"GCgc", dtype=np.uint8))
+            read_base_starts = np.concatenate(([0], np.cumsum(read_lengths)[:-1]))
+            read_gc_number = np.add.reduceat(is_gc.astype(np.int32), np.minimum(read_base_starts, len(is_gc) - 1)) \
+                if len(is_gc) else np.zeros(len(read_lengths), dtype=np.int32)
+            read_gc_number[read_lengths == 0] = 0
+            read_gc_percent = np.round(100 * read_gc_number / np.maximum(read_lengths, 1)).astype(np.int64)
+            gc_histogram += np.bincount(read_gc_percent, minlength=101)
+            chunk_length_histogram = np.bincount(read_lengths)
+            if len(chunk_length_histogram) > len(length_histogram):
+                length_histogram = np.pad(length_histogram, (0, len(chunk_length_histogram) - len(length_histogram)))
+            length_histogram[:len(chunk_length_histogram)] += chunk_length_histogram
+            if duplication_observed < duplication_reads:
+                for seq_line in seq_lines[:duplication_reads - duplication_observed]:
+                    seen_prefix_set.add(seq_line[:duplication_prefix_length])
+                duplication_observed += min(len(seq_lines), duplication_reads - duplication_observed)
+            read_number += len(seq_lines)
+    total_bases = int(position_count.sum())
+    gc_bases = int(sum(base_count[ord(i)] for i in "GCgc"))
+    n_bases = int(base_count[ord("N")] + base_count[ord("n")])
+    length_values = np.nonzero(length_histogram)[0]
+    summary = {"file": os.path.basename(fq_path), "reads": read_number, "bases": total_bases,
+               "mean_length": round(total_bases / read_number, 2) if read_number else 0,
+               "min_length": int(length_values.min()) if len(length_values) else 0,
+               "max_length": int(length_values.max()) if len(length_values) else 0,
+               "gc_percent": round(100 * gc_bases / max(total_bases - n_bases, 1), 2),
+               "n_percent": round(100 * n_bases / max(total_bases, 1), 4),
+               "mean_quality": round(float(quality_sum.sum()) / max(total_bases, 1), 2),
+               "q30_percent": round(100 * q30_base_number / max(total_bases, 1), 2),
+               "duplication_percent": round(100 * (1 - len(seen_prefix_set) / duplication_observed), 2)
+               if duplication_observed else 0}
+    return {"summary": summary,
+            "per_position_mean_quality": np.round(quality_sum / np.maximum(position_count, 1), 2).tolist(),
+            "per_position_n_percent": np.round(100 * position_n_count / np.maximum(position_count, 1), 4).tolist(),
+            "length_histogram": {int(i): int(length_histogram[i]) for i in length_values},
+            "gc_histogram": gc_histogram.tolist()}
+
+
+# memory of one fastq_file_stats() worker process, interpreter included
+FASTQ_STATS_WORKER_MEMORY_GB = 0.5
+
+
+def summarize_fastq_stats_by_sample(summary_df):
+    """
+    Combine the file summaries of fastq_file_stats() into one row per sample, e.g. R1 and R2 of a read pair
+    :param summary_df: file summaries with a "sample" column
+    :return: DataFrame with one row per sample, percents and mean quality are weighted by bases, the duplication
+    percent by reads
+    """
+    weighted_df = summary_df.assign(
+        gc_bases=summary_df["gc_percent"] * summary_df["bases"], n_bases=summary_df["n_percent"] * summary_df["bases"],
+        quality_bases=summary_df["mean_quality"] * summary_df["bases"],
+        q30_bases=summary_df["q30_percent"] * summary_df["bases"],
+        duplication_reads=summary_df["duplication_percent"] * summary_df["reads"])
+    sample_df = weighted_df.groupby("sample", sort=False).agg(
+        files=("file", "size"), reads=("reads", "sum"), bases=("bases", "sum"), min_length=("min_length", "min"),
+        max_length=("max_length", "max"), gc_bases=("gc_bases", "sum"), n_bases=("n_bases", "sum"),
+        quality_bases=("quality_bases", "sum"), q30_bases=("q30_bases", "sum"),
+        duplication_reads=("duplication_reads", "sum"))
+    base_number, read_number = sample_df["bases"].clip(lower=1), sample_df["reads"].clip(lower=1)
+    sample_df["mean_length"] = (sample_df["bases"] / read_number).round(2)
+    sample_df["gc_percent"] = (sample_df["gc_bases"] / base_number).round(2)
+    sample_df["n_percent"] = (sample_df["n_bases"] / base_number).round(4)
+    sample_df["mean_quality"] = (sample_df["quality_bases"] / base_number).round(2)
+    sample_df["q30_percent"] = (sample_df["q30_bases"] / base_number).round(2)
+    sample_df["duplication_percent"] = (sample_df["duplication_reads"] / read_number).round(2)
+    return sample_df[["files", "reads", "bases", "mean_length", "min_length", "max_length", "gc_percent", "n_percent",
+                      "mean_quality", "q30_percent", "duplication_percent"]].reset_index()
+
+
+def fastq_stats_report_step2(qc_output_dir, sample_fq_dict, thread, total_mem_gb=None):
+    """
+    Native alternative of fastqc_report_step2: each fq is read once and files are processed in parallel
+    :param qc_output_dir:
+    :param sample_fq_dict: {"sample1": ["path/XXX_R1.fq.gz", "path/XXX_R2.fq.gz"]}
+    :param thread: number of files processed at the same time
+    :param total_mem_gb: memory for all workers, caps the number of files processed at the same time
+    (FASTQ_STATS_WORKER_MEMORY_GB each), None means no cap
+    :return: qc_output_dir/XXX_R1_stats.json per file, qc_output_dir/fastq_stats_summary.tsv (one row per file) and
+    qc_output_dir/fastq_stats_sample_summary.tsv (one row per sample) for the cohort
+    """
+    os.makedirs(qc_output_dir, exist_ok=True)
+    fq_path_list = [fq_path for fq_path_list in sample_fq_dict.values() for fq_path in fq_path_list]
+    sample_name_list = [sample for sample, fq_path_list in sample_fq_dict.items() for fq_path in fq_path_list]
+    worker_number = max(1, thread)
+    if total_mem_gb is not None:
+        worker_number = max(1, min(worker_number, int(total_mem_gb / FASTQ_STATS_WORKER_MEMORY_GB)))
+    summary_list = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=worker_number) as executor:
+        for sample, fq_path, fq_stats in zip(sample_name_list, fq_path_list,
+                                             executor.map(fastq_file_stats, fq_path_list)):
+            with open(os.path.join(qc_output_dir, f"{get_fq_prefix(fq_path)}_stats.json"), "w") as stats_f:
+                json.dump(fq_stats, stats_f)
+            summary_list.append(dict(fq_stats["summary"], sample=sample))
+    summary_df = pd.DataFrame(summary_list)
+    summary_df.to_csv(os.path.join(qc_output_dir, "fastq_stats_summary.tsv"), sep="\t", index=False)
+    if len(summary_df):
+        summarize_fastq_stats_by_sample(summary_df).to_csv(
+            os.path.join(qc_output_dir, "fastq_stats_sample_summary.tsv"), sep="\t", index=False)
+    return summary_df
+
+
+def parallel_gzip_file(source_path, target_path, level=6, thread=4, block_size=16 * 1024 * 1024):
+    """
+    Compress a file as a series of gzip members of block_size each, compressed by a thread pool (zlib releases the
+    GIL), gzip readers read the members as one stream; used when neither pigz nor bgzip is installed
+    :param source_path: "PATH/XXX_kneaddata_paired_1.fastq"
+    :param target_path: "PATH/XXX_kneaddata_paired_1.fastq.gz"
+    :param level: compression level 1-9
+    :param thread: number of blocks compressed at the same time
+    :param block_size: bytes of one gzip member
+    :return:
+    """
+    with open(source_path, "rb") as source_f, open(target_path, "wb") as target_f, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=thread) as executor:
+        pending_future_list = []     # blocks are written in order, at most 2 * thread blocks are held in memory
+        for block in iter(lambda: source_f.read(block_size), b""):
+            pending_future_list.append(executor.submit(gzip.compress, block, level))
+            if len(pending_future_list) >= 2 * thread:
+                target_f.write(pending_future_list.pop(0).result())
+        for future in pending_future_list:
+            target_f.write(future.result())
+
+
+def compress_fastq(fq_path, level=6, thread=4, remove_source=True):
+    """
+    Multi-threaded gzip compression of a fq by pigz, bgzip (BGZF) or parallel_gzip_file(), the first one available
+    :param fq_path: "PATH/XXX_kneaddata_paired_1.fastq"
+    :param level: compression level 1-9
     :param thread:
+    :param remove_source: remove fq_path after it is compressed
+    :return: "PATH/XXX_kneaddata_paired_1.fastq.gz"
+    """
+    gz_path = f"{fq_path}.gz"
+    partial_gz_path = f"{gz_path}.partial"
+    if shutil.which("pigz"):
+        compress_cmd = ["pigz", "-c", f"-{level}", "-p", str(thread), fq_path]
+    elif shutil.which("bgzip"):
+        compress_cmd = ["bgzip", "-c", "-l", str(level), "-@", str(thread), fq_path]
+    else:
+        compress_cmd = None
+    if compress_cmd is None:
+        parallel_gzip_file(fq_path, partial_gz_path, level, thread)
+    else:
+        with open(partial_gz_path, "wb") as partial_gz_f:
+            return_code = subprocess.call(compress_cmd, stdout=partial_gz_f)
+        if return_code != 0:
+            os.remove(partial_gz_path)
+            raise PipelineCommandError(f"Failed to compress {fq_path}: {' '.join(compress_cmd)}")
+    os.replace(partial_gz_path, gz_path)
+    if remove_source:
+        os.remove(fq_path)
+    return gz_path
+
+
+def compress_step_outputs(fq_path_list, level, thread, manifest_path=None, input_path_list=(), command="",
+                          db_path_list=()):
+    """
+    Compress the kept fqs of a step of one sample, then record the step as complete; the manifest is only written
+    once all outputs are compressed, so an interrupted compression is redone on resume
+    :return: paths of the compressed fqs
+    """
+    gz_path_list = [compress_fastq(i, level, thread) for i in fq_path_list]
+    if manifest_path is not None:
+        write_step_manifest(manifest_path, input_path_list, command, gz_path_list, db_path_list)
+    return gz_path_list
+
+
+# single worker running jobs (e.g. compression) of finished samples while the next sample is processed
+_background_executor = None
+
+
+def submit_background_job(background_job_list, job_name, job_function, *args):
+    """
+    :param background_job_list: list collecting (job_name, future), see wait_background_jobs()
+    :param job_name: e.g. the sample name
+    :param job_function: compress_step_outputs
+    :param args: arguments of job_function
     :return:
     """
-    if not os.path.exists(qc_output_dir):
-        os.system(f"mkdir -p {qc_output_dir}")
-    for fq_path in fq_path_list:
-        step1b_cmd = f"fastqc {fq_path} -t {thread} -o {qc_output_dir}"
-        os.system(step1b_cmd)
+    global _background_executor
+    if _background_executor is None:
+        _background_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    background_job_list.append((job_name, _background_executor.submit(job_function, *args)))
+
+
+def wait_background_jobs(background_job_list):
+    """
+    Wait for the jobs of submit_background_job() and report the failed ones
+    :return: names of the failed jobs
+    """
+    failed_job_list = []
+    for job_name, future in background_job_list:
+        try:
+            future.result()
+        except Exception as e:
+            print(f"Error! Background job of {job_name} failed: {e}")
+            failed_job_list.append(job_name)
+    return failed_job_list
 
 
-def kneaddata_clean_step3(clean_output_dir, fq_path_list, db_path, thread, remove_temp_files=True):
+def kneaddata_clean_step3(clean_output_dir, fq_path_list, db_path, thread, remove_temp_files=True, resume=True,
+                          compress_level=None, background_job_list=None):
     """
     :param clean_output_dir: the output dir of knead data
     :param fq_path_list: fq_path_list = ["PATH/XXX_R1.fq.gz", "PATH/XXX_R2.fq.gz"]
     :param db_path: path of contamination bowtie2 database, path/ftp.broadinstitute.org/bundle/hg38/hg38
     :param thread:
     :param remove_temp_files: whether remove temp files (only reserve useful final output)
+    :param resume: skip the sample if its step manifest shows it is complete, otherwise clean partial outputs first
+    :param compress_level: gzip the kept outputs at this level (1-9), None keeps them uncompressed
+    :param background_job_list: if a list is given, compression runs in the background (see submit_background_job)
+    while the caller goes on with the next sample, otherwise before returning
     :return: For pair end reads, the useful file names are XXX_R1_kneaddata_paired_1.fastq,
-    XXX_R1_kneaddata_paired_2.fastq
-    """
-    if not os.path.exists(clean_output_dir):
-        os.system(f"mkdir -p {clean_output_dir}")
-    step1c_cmd = f"kneaddata --input {fq_path_list[0]} --input {fq_path_list[1]} " \
-                 f"--reference-db {db_path} --output {clean_output_dir} --threads {thread}"
-    process = subprocess.Popen(step1c_cmd.split(), stdout=subprocess.PIPE)
-    output, error = process.communicate()
-    print(output, error)
+    XXX_R1_kneaddata_paired_2.fastq (.fastq.gz if compress_level is given)
+    """
+    os.makedirs(clean_output_dir, exist_ok=True)
+    step1c_cmd = f"kneaddata --input {shlex.quote(fq_path_list[0])} --input {shlex.quote(fq_path_list[1])} " \
+                 f"--reference-db {shlex.quote(db_path)} --output {shlex.quote(clean_output_dir)} --threads {thread}"
+    prefix_of_all_files = get_fq_prefix(fq_path_list[0])
+    knead_path_list = [os.path.join(clean_output_dir, f"{prefix_of_all_files}_kneaddata_paired_{i}.fastq")
+                       for i in (1, 2)]
+    gz_path_list = [f"{i}.gz" for i in knead_path_list]
+    output_path_list = knead_path_list if compress_level is None else gz_path_list
+    manifest_command = step1c_cmd if compress_level is None else f"{step1c_cmd} | gzip"
+    manifest_path = step_manifest_path(clean_output_dir, "kneaddata", prefix_of_all_files)
+    if resume:
+        if step_is_complete(manifest_path, fq_path_list, manifest_command, [db_path]):
+            print(f"{fq_path_list} has been cleaned by kneaddata. Skip it!")
+            return output_path_list
+        remove_partial_outputs(manifest_path, knead_path_list + gz_path_list)
+    run_tool_command(step1c_cmd, "kneaddata", prefix_of_all_files, thread, fq_path_list)
     # ------------------------------------------------------------------------------------------------------------------
     if remove_temp_files:
         # get the prefix of all files
-        fq_name = os.path.split(fq_path_list[0])[-1]
-        if fq_name.endswith("gz"):
-            prefix_of_all_files = ".".join(fq_name.split(".")[:-2])
-        else:
-            # XXX.fq or XXX.fastq
-            prefix_of_all_files = ".".join(fq_name.split(".")[:-1])
+        prefix_of_all_files = get_fq_prefix(fq_path_list[0])
         print(prefix_of_all_files)
-        os.chdir(clean_output_dir)
         all_output_files = [i for i in os.listdir(clean_output_dir) if i.startswith(prefix_of_all_files)]
         file_to_remove = []
         for file_name in all_output_files:
@@ -145,7 +1580,189 @@ def kneaddata_clean_step3(clean_output_dir, fq_path_list, db_path, thread, remov
                 file_to_remove.append(file_name)
         print(prefix_of_all_files)
         for file_name in file_to_remove:
-            os.system(f"rm {file_name}")
+            os.remove(os.path.join(clean_output_dir, file_name))
+    if compress_level is not None:
+        compress_args = (knead_path_list, compress_level, thread, manifest_path if resume else None, fq_path_list,
+                         manifest_command, [db_path])
+        if background_job_list is not None:
+            submit_background_job(background_job_list, prefix_of_all_files, compress_step_outputs, *compress_args)
+        else:
+            compress_step_outputs(*compress_args)
+    elif resume:
+        write_step_manifest(manifest_path, fq_path_list, step1c_cmd, output_path_list, [db_path])
+    return output_path_list
+
+
+def trim_knead_fused_step3(clean_output_dir, fq_path_list, quality_threshold, db_path, thread, scratch_dir=None,
+                           resume=True, compress_level=None, background_job_list=None):
+    """
+    Fused QC: trim_galore and kneaddata of one sample run back to back in node-local scratch, only the final
+    kneaddata_paired outputs (and the kneaddata log) are written to clean_output_dir
+    trim_galore output stays uncompressed, so there is no gzip/gunzip round trip between the two tools
+    :param clean_output_dir: the output dir of knead data, usually on the shared filesystem
+    :param fq_path_list: raw reads, ["PATH/XXX_R1.fq.gz", "PATH/XXX_R2.fq.gz"]
+    :param quality_threshold: quality threshold of trim_galore, 25
+    :param db_path: path of contamination bowtie2 database, path/ftp.broadinstitute.org/bundle/hg38/hg38
+    :param thread:
+    :param scratch_dir: node-local directory for intermediate files, default is $TMPDIR
+    :param resume: skip the sample if its step manifest shows it is complete, otherwise clean partial outputs first
+    :param compress_level: gzip the kept outputs at this level (1-9), None keeps them uncompressed
+    :param background_job_list: see kneaddata_clean_step3()
+    :return: paths of the kept outputs, [XXX_R1_val_1_kneaddata_paired_1.fastq, XXX_R1_val_1_kneaddata_paired_2.fastq]
+    (.fastq.gz if compress_level is given)
+    """
+    os.makedirs(clean_output_dir, exist_ok=True)
+    # kneaddata names its outputs after the first trimmed file, XXX_R1_val_1
+    knead_prefix = f"{get_fq_prefix(fq_path_list[0])}_val_1"
+    knead_path_list = [os.path.join(clean_output_dir, f"{knead_prefix}_kneaddata_paired_{i}.fastq") for i in (1, 2)]
+    gz_path_list = [f"{i}.gz" for i in knead_path_list]
+    output_path_list = knead_path_list if compress_level is None else gz_path_list
+    fused_command = f"trim_galore --quality {quality_threshold} | kneaddata --reference-db {shlex.quote(db_path)}"
+    if compress_level is not None:
+        fused_command = f"{fused_command} | gzip"
+    manifest_path = step_manifest_path(clean_output_dir, "trim_kneaddata", knead_prefix)
+    if resume:
+        if step_is_complete(manifest_path, fq_path_list, fused_command, [db_path]):
+            print(f"{fq_path_list} has been trimmed and cleaned. Skip it!")
+            return output_path_list
+        remove_partial_outputs(manifest_path, knead_path_list + gz_path_list)
+    sample_scratch_dir = tempfile.mkdtemp(prefix=f"{get_fq_prefix(fq_path_list[0])}_", dir=scratch_dir)
+    try:
+        trim_dir = os.path.join(sample_scratch_dir, "trim_galore")
+        knead_dir = os.path.join(sample_scratch_dir, "kneaddata")
+        trimmed_fq_path_list = trim_galore_process_step1(trim_dir, fq_path_list, quality_threshold, thread,
+                                                         gzip_output=False, resume=False)
+        kneaddata_clean_step3(knead_dir, trimmed_fq_path_list, db_path, thread, remove_temp_files=False, resume=False)
+        for file_name in [os.path.basename(i) for i in knead_path_list] + [f"{knead_prefix}_kneaddata.log"]:
+            if os.path.exists(os.path.join(knead_dir, file_name)):
+                shutil.move(os.path.join(knead_dir, file_name), os.path.join(clean_output_dir, file_name))
+    finally:
+        shutil.rmtree(sample_scratch_dir, ignore_errors=True)
+    if compress_level is not None:
+        compress_args = (knead_path_list, compress_level, thread, manifest_path if resume else None, fq_path_list,
+                         fused_command, [db_path])
+        if background_job_list is not None:
+            submit_background_job(background_job_list, knead_prefix, compress_step_outputs, *compress_args)
+        else:
+            compress_step_outputs(*compress_args)
+    elif resume:
+        write_step_manifest(manifest_path, fq_path_list, fused_command, output_path_list, [db_path])
+    return output_path_list
+
+
+def multiplicity_path_of_fq(fq_path):
+    """
+    :param fq_path: "dedup_dir/XXX_R1_kneaddata_paired_1.fastq.gz"
+    :return: "dedup_dir/XXX_R1_multiplicity.tsv", written by dedup_read_pairs_step3()
+    """
+    prefix = re.sub(r"_(kneaddata_paired|val)_[12]$", "", get_fq_prefix(fq_path))
+    return os.path.join(os.path.dirname(fq_path), f"{prefix}_multiplicity.tsv")
+
+
+def _dedup_read_pairs(read_pair_iter, unique_f_list, read_id_count_dict):
+    """
+    Write the first copy of each read pair, counting later copies by the read ID of the first copy
+    :return: number of read pairs, number of unique read pairs
+    """
+    first_read_id_dict = {}     # 16-byte hash of the sequences of both mates -> read ID of the first copy
+    read_pair_number = 0
+    for read_pair in read_pair_iter:
+        read_pair_number += 1
+        pair_hash = hashlib.blake2b(b"".join(i[1] for i in read_pair), digest_size=16).digest()
+        first_read_id = first_read_id_dict.get(pair_hash)
+        if first_read_id is None:
+            first_read_id_dict[pair_hash] = read_pair[0][0].split()[0][1:]
+            for unique_f, read in zip(unique_f_list, read_pair):
+                unique_f.writelines(read)
+        else:
+            read_id_count_dict[first_read_id] = read_id_count_dict.get(first_read_id, 1) + 1
+    return read_pair_number, len(first_read_id_dict)
+
+
+def dedup_read_pairs_step3(dedup_output_dir, fq_path_list, thread=4, memory_gb=4, compress_level=6, scratch_dir=None,
+                           resume=True):
+    """
+    Collapse read pairs whose mates both have identical sequences (e.g. PCR duplicates), so Kraken2 and HUMAnN3
+    classify each distinct pair once; the outputs keep the input file names, so step4 and step5 read dedup_output_dir
+    in place of the kneaddata directory
+    Pairs are hashed (blake2b) in memory; when the hash table would exceed memory_gb (it takes about twice the size of
+    the gzipped input), pairs are first spilled to hash partitions in scratch and each partition is collapsed alone
+    :param dedup_output_dir: output dir of deduplicated reads
+    :param fq_path_list: ["PATH/XXX_R1_kneaddata_paired_1.fastq.gz", "PATH/XXX_R1_kneaddata_paired_2.fastq.gz"]
+    :param thread: threads of compressing the outputs
+    :param memory_gb: memory of the hash table
+    :param compress_level: gzip level of the outputs (see compress_fastq), None keeps them uncompressed
+    :param scratch_dir: directory of the partitions, default is dedup_output_dir
+    :param resume: skip the sample if its step manifest shows it is complete, otherwise clean partial outputs first
+    :return: paths of the deduplicated fqs; multiplicity_path_of_fq() gives the TSV (read_id, count) of the pairs
+    that had duplicates, read by kraken_reanalysis() to restore the true read counts
+    """
+    os.makedirs(dedup_output_dir, exist_ok=True)
+    unique_path_list = [os.path.join(dedup_output_dir, f"{get_fq_prefix(i)}.fastq") for i in fq_path_list]
+    output_path_list = unique_path_list if compress_level is None else [f"{i}.gz" for i in unique_path_list]
+    multiplicity_path = multiplicity_path_of_fq(unique_path_list[0])
+    dedup_command = "dedup_read_pairs" if compress_level is None else "dedup_read_pairs | gzip"
+    sample_prefix = os.path.basename(multiplicity_path)[:-len("_multiplicity.tsv")]
+    manifest_path = step_manifest_path(dedup_output_dir, "dedup", sample_prefix)
+    if resume:
+        if step_is_complete(manifest_path, fq_path_list, dedup_command):
+            print(f"{fq_path_list} has been deduplicated. Skip it!")
+            return output_path_list
+        remove_partial_outputs(manifest_path, unique_path_list + [f"{i}.gz" for i in unique_path_list] +
+                               [multiplicity_path])
+
+    input_bytes = sum(os.path.getsize(i) * (2 if i.endswith(".gz") else 0.5) for i in fq_path_list)
+    partition_number = int(np.ceil(input_bytes / (memory_gb * 1024 ** 3)))
+    read_id_count_dict = {}
+    fq_f_list = [open_fq(i) for i in fq_path_list]
+    unique_f_list = [open(i, "wb") for i in unique_path_list]
+    try:
+        # each read pair is a tuple of the 4 lines of each mate
+        read_pair_iter = zip(*[zip(fq_f, fq_f, fq_f, fq_f) for fq_f in fq_f_list])
+        if partition_number <= 1:
+            read_pair_number, unique_pair_number = _dedup_read_pairs(read_pair_iter, unique_f_list,
+                                                                     read_id_count_dict)
+        else:
+            print(f"Spill {fq_path_list} to {partition_number} partitions")
+            partition_dir = tempfile.mkdtemp(prefix=f"{sample_prefix}_dedup_", dir=scratch_dir or dedup_output_dir)
+            try:
+                partition_f_list = [[open(os.path.join(partition_dir, f"{i}_{j}.fastq"), "wb")
+                                     for j in range(len(fq_path_list))] for i in range(partition_number)]
+                for read_pair in read_pair_iter:
+                    pair_hash = hashlib.blake2b(b"".join(i[1] for i in read_pair), digest_size=8).digest()
+                    for partition_f, read in zip(partition_f_list[int.from_bytes(pair_hash, "little") %
+                                                                  partition_number], read_pair):
+                        partition_f.writelines(read)
+                for partition_f in itertools.chain(*partition_f_list):
+                    partition_f.close()
+                read_pair_number, unique_pair_number = 0, 0
+                for partition_index in range(partition_number):
+                    part_f_list = [open(os.path.join(partition_dir, f"{partition_index}_{j}.fastq"), "rb")
+                                   for j in range(len(fq_path_list))]
+                    part_pair_iter = zip(*[zip(part_f, part_f, part_f, part_f) for part_f in part_f_list])
+                    part_read_pair_number, part_unique_pair_number = _dedup_read_pairs(part_pair_iter, unique_f_list,
+                                                                                       read_id_count_dict)
+                    read_pair_number += part_read_pair_number
+                    unique_pair_number += part_unique_pair_number
+                    for part_f in part_f_list:
+                        part_f.close()
+            finally:
+                shutil.rmtree(partition_dir, ignore_errors=True)
+    finally:
+        for fq_f in fq_f_list + unique_f_list:
+            fq_f.close()
+    with open(multiplicity_path, "w") as multiplicity_f:
+        multiplicity_f.write("read_id\tcount\n")
+        for read_id, count in read_id_count_dict.items():
+            multiplicity_f.write(f"{read_id.decode()}\t{count}\n")
+    print(f"{fq_path_list}: {unique_pair_number} unique of {read_pair_number} read pairs "
+          f"({100 * (1 - unique_pair_number / max(read_pair_number, 1)):.2f}% duplicates)")
+
+    if compress_level is not None:
+        compress_step_outputs(unique_path_list, compress_level, thread)
+    if resume:
+        write_step_manifest(manifest_path, fq_path_list, dedup_command, output_path_list + [multiplicity_path])
+    return output_path_list
 
 
 ##########################################################################
@@ -156,7 +1773,7 @@ def kneaddata_clean_step3(clean_output_dir, fq_path_list, db_path, thread, remov
 ##########################################################################
 ##########################################################################
 def kraken_process_step4(sample_name_list, all_sample_fq_path_list, sample_output_folder_list, kraken_database_path,
-                         whether_use_mpa_style=True):
+                         whether_use_mpa_style=True, thread=None, memory_mapping=False, resume=True):
     """
     Get processed fq and relative abundance report by Kraken
     :param sample_name_list: ["sample1", "sample2"]
@@ -164,39 +1781,651 @@ def kraken_process_step4(sample_name_list, all_sample_fq_path_list, sample_outpu
     :param sample_output_folder_list: ["output_path/subject1/sample1", "output_path/subject1/sample2"]
     :param kraken_database_path: "user_path/software/kraken2/NCBI_standard"
     :param whether_use_mpa_style: whether output metaphlan style output
+    :param thread: number of threads of kraken2, None uses the kraken2 default
+    :param memory_mapping: read the database through mmap (page cache) instead of loading a private copy
+    :param resume: skip samples whose step manifest shows they are complete, otherwise clean partial outputs first
     :return: sample_output.txt, sample_report.txt, for single,
     """
 
-    use_mpa_style = ""
-    if whether_use_mpa_style:
-        use_mpa_style = "--use-mpa-style "
     for sample_index in range(len(sample_name_list)):
         sample_name = sample_name_list[sample_index]
         sample_fq_path_list = all_sample_fq_path_list[sample_index]
         sample_output_folder = sample_output_folder_list[sample_index]
-        if not os.path.exists(sample_output_folder):
-            os.system(f"mkdir -p {sample_output_folder}")
-
-        # paired-end or single-end
-        if len(sample_fq_path_list) == 1:
-            # single
-            command_kraken2 = f"kraken2 --db {kraken_database_path} --report {sample_output_folder}/{sample_name}_" \
-                              f"report.txt {use_mpa_style}--use-names --report-zero-counts --classified-out " \
-                              f"{sample_output_folder}/{sample_name}_#.fq {sample_fq_path_list[0]} " \
-                              f"--output {sample_output_folder}/{sample_name}_output.txt"
-        elif len(sample_fq_path_list) == 2:
-            # paied
-            command_kraken2 = f"kraken2 --db {kraken_database_path} --report {sample_output_folder}/{sample_name}_" \
-                              f"report.txt {use_mpa_style}--use-names --report-zero-counts --paired --classified-out " \
-                              f"{sample_output_folder}/{sample_name}_#.fq {sample_fq_path_list[0]} " \
-                              f"{sample_fq_path_list[1]} --output {sample_output_folder}/{sample_name}_output.txt"
-        else:
-            print(f"Error! {sample_name} has incorrect number of fqs: {sample_fq_path_list} Terminated.")
-            sys.exit()
-
+        os.makedirs(sample_output_folder, exist_ok=True)
+        command_kraken2 = kraken2_command(sample_name, sample_fq_path_list, sample_output_folder,
+                                          kraken_database_path, whether_use_mpa_style, thread, memory_mapping)
+        output_path_list = [f"{sample_output_folder}/{sample_name}_report.txt",
+                            f"{sample_output_folder}/{sample_name}_output.txt"]
+        manifest_path = step_manifest_path(sample_output_folder, "kraken2", sample_name)
+        if resume:
+            if step_is_complete(manifest_path, sample_fq_path_list, command_kraken2, [kraken_database_path]):
+                print(f"Sample {sample_name} has been processed by Kraken. Skip it!")
+                continue
+            remove_partial_outputs(manifest_path, output_path_list)
         print(f"Processing {sample_name} by Kraken: {command_kraken2}")
         print(command_kraken2)
-        os.system(command_kraken2)
+        run_tool_command(command_kraken2, "kraken2", sample_name, thread, sample_fq_path_list)
+        if resume:
+            write_step_manifest(manifest_path, sample_fq_path_list, command_kraken2, output_path_list,
+                                [kraken_database_path])
+
+
+def kraken2_command(sample_name, sample_fq_path_list, sample_output_folder, kraken_database_path,
+                    whether_use_mpa_style=True, thread=None, memory_mapping=False):
+    """
+    Command line of kraken2 for one sample, see kraken_process_step4()
+    :return: "kraken2 --db ..."
+    """
+    use_mpa_style = ""
+    if whether_use_mpa_style:
+        use_mpa_style = "--use-mpa-style "
+    use_thread = ""
+    if thread is not None:
+        use_thread = f"--threads {thread} "
+    use_memory_mapping = ""
+    if memory_mapping:
+        use_memory_mapping = "--memory-mapping "
+    # paths are quoted, so that a path with spaces stays one argument
+    report_path = shlex.quote(f"{sample_output_folder}/{sample_name}_report.txt")
+    classified_path = shlex.quote(f"{sample_output_folder}/{sample_name}_#.fq")
+    output_path = shlex.quote(f"{sample_output_folder}/{sample_name}_output.txt")
+    # paired-end or single-end
+    if len(sample_fq_path_list) == 1:
+        # single
+        command_kraken2 = f"kraken2 --db {shlex.quote(kraken_database_path)} --report {report_path} " \
+                          f"{use_mpa_style}{use_thread}{use_memory_mapping}--use-names --report-zero-counts --classified-out " \
+                          f"{classified_path} {shlex.quote(sample_fq_path_list[0])} --output {output_path}"
+    elif len(sample_fq_path_list) == 2:
+        # paied
+        command_kraken2 = f"kraken2 --db {shlex.quote(kraken_database_path)} --report {report_path} " \
+                          f"{use_mpa_style}{use_thread}{use_memory_mapping}--use-names --report-zero-counts --paired --classified-out " \
+                          f"{classified_path} {shlex.quote(sample_fq_path_list[0])} " \
+                          f"{shlex.quote(sample_fq_path_list[1])} --output {output_path}"
+    else:
+        print(f"Error! {sample_name} has incorrect number of fqs: {sample_fq_path_list} Terminated.")
+        sys.exit()
+    return command_kraken2
+
+
+KRAKEN_DATABASE_FILES = ["hash.k2d", "opts.k2d", "taxo.k2d"]
+# memory of one kraken2 process besides its database (reads, output buffers)
+KRAKEN_WORKING_MEMORY_GB = 4
+
+
+def kraken_database_memory_gb(kraken_database_path):
+    """
+    Memory of one kraken2 process that loads the database itself (no --memory-mapping)
+    :param kraken_database_path: "user_path/software/kraken2_GTDB_download"
+    :return: size of the .k2d files + KRAKEN_WORKING_MEMORY_GB, None if the database files are missing
+    """
+    db_file_path_list = [os.path.join(kraken_database_path, i) for i in KRAKEN_DATABASE_FILES]
+    if not all(os.path.isfile(i) for i in db_file_path_list):
+        return None
+    return sum(os.path.getsize(i) for i in db_file_path_list) / 1024 ** 3 + KRAKEN_WORKING_MEMORY_GB
+
+
+def warm_page_cache(file_path, block_size=64 * 1024 * 1024):
+    """
+    Read a file once so that it stays in the page cache for later memory-mapped readers
+    :param file_path: e.g. kraken_database_path/hash.k2d
+    :param block_size: bytes read per call
+    :return: number of bytes read
+    """
+    bytes_read = 0
+    with open(file_path, "rb", buffering=0) as f:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            bytes_read += len(block)
+    return bytes_read
+
+
+def _live_kraken_stage_users(user_dir):
+    """
+    :param user_dir: "/dev/shm/kraken2_GTDB.users", one empty file named by the pid of each run using the staged copy
+    :return: pids of the runs that are still alive, files of finished or killed runs are removed
+    """
+    live_pid_list = []
+    for user_file_name in os.listdir(user_dir) if os.path.isdir(user_dir) else []:
+        try:
+            os.kill(int(user_file_name), 0)
+        except ProcessLookupError:
+            os.remove(os.path.join(user_dir, user_file_name))
+            continue
+        except (PermissionError, ValueError):
+            pass
+        live_pid_list.append(user_file_name)
+    return live_pid_list
+
+
+def _lock_kraken_stage(staged_db_path):
+    """
+    :return: open lock file of the staged copy, exclusively locked until it is closed
+    """
+    lock_f = open(f"{staged_db_path}.lock", "w")
+    fcntl.flock(lock_f, fcntl.LOCK_EX)
+    return lock_f
+
+
+def stage_kraken_database(kraken_database_path, stage_root="/dev/shm"):
+    """
+    Put the Kraken2 database in memory once so that every sample of the run can memory-map it
+    The database is copied to stage_root (tmpfs) if there is enough free space, otherwise the files are only read once
+    to warm the page cache and the original path is used
+    Runs on the same node share one staged copy: staging and attaching happen under a file lock, so a second run waits
+    for the copy instead of making its own, and each run registers its pid as a user of the copy until
+    release_kraken_database() is called
+    :param kraken_database_path: "user_path/software/kraken2_GTDB_download"
+    :param stage_root: "/dev/shm"
+    :return: (path of the database to use, whether this run is a registered user of a staged copy)
+    """
+    db_file_path_list = [os.path.join(kraken_database_path, i) for i in KRAKEN_DATABASE_FILES]
+    db_size = sum(os.path.getsize(i) for i in db_file_path_list)
+    staged_db_path = os.path.join(stage_root, f"kraken2_{os.path.basename(os.path.normpath(kraken_database_path))}")
+    user_dir = f"{staged_db_path}.users"
+    if os.path.isdir(stage_root):
+        with _lock_kraken_stage(staged_db_path):
+            _live_kraken_stage_users(user_dir)
+            # a previous or concurrent run on this node has already staged the same database
+            if all(os.path.exists(os.path.join(staged_db_path, i)) and os.path.getsize(os.path.join(staged_db_path, i))
+                   == os.path.getsize(os.path.join(kraken_database_path, i)) for i in KRAKEN_DATABASE_FILES):
+                print(f"Kraken2 database has been staged at {staged_db_path}, reuse it")
+                os.makedirs(user_dir, exist_ok=True)
+                open(os.path.join(user_dir, str(os.getpid())), "w").close()
+                return staged_db_path, True
+            # an incomplete copy is never used, it is left by a run that was killed while staging
+            shutil.rmtree(staged_db_path, ignore_errors=True)
+            if shutil.disk_usage(stage_root).free > db_size * 1.05:
+                print(f"Staging Kraken2 database ({db_size / 1024 ** 3:.1f} GB) to {staged_db_path}")
+                temp_staged_db_path = f"{staged_db_path}.{os.getpid()}.tmp"
+                os.makedirs(temp_staged_db_path, exist_ok=True)
+                try:
+                    for db_file_path in db_file_path_list:
+                        shutil.copyfile(db_file_path, os.path.join(temp_staged_db_path, os.path.basename(db_file_path)))
+                    os.rename(temp_staged_db_path, staged_db_path)
+                except OSError as e:
+                    print(f"Staging Kraken2 database failed ({e}), warm the page cache instead")
+                    shutil.rmtree(temp_staged_db_path, ignore_errors=True)
+                else:
+                    os.makedirs(user_dir, exist_ok=True)
+                    open(os.path.join(user_dir, str(os.getpid())), "w").close()
+                    return staged_db_path, True
+    print(f"Not enough space under {stage_root}, read the Kraken2 database once into the page cache")
+    for db_file_path in db_file_path_list:
+        warm_page_cache(db_file_path)
+    return kraken_database_path, False
+
+
+def release_kraken_database(staged_db_path, keep_staged_database=False):
+    """
+    Unregister this run as a user of a copy made by stage_kraken_database(), the copy is removed by the last run
+    using it
+    :param staged_db_path: "/dev/shm/kraken2_GTDB_download"
+    :param keep_staged_database: keep the copy for later runs on the same node even if no run is using it
+    :return:
+    """
+    user_dir = f"{staged_db_path}.users"
+    with _lock_kraken_stage(staged_db_path):
+        try:
+            os.remove(os.path.join(user_dir, str(os.getpid())))
+        except FileNotFoundError:
+            pass
+        live_pid_list = _live_kraken_stage_users(user_dir)
+        if live_pid_list:
+            print(f"Kraken2 database at {staged_db_path} is still used by {len(live_pid_list)} runs, keep it")
+        elif not keep_staged_database:
+            shutil.rmtree(staged_db_path, ignore_errors=True)
+            shutil.rmtree(user_dir, ignore_errors=True)
+
+
+def kraken_batch_process_step4(sample_name_list, all_sample_fq_path_list, sample_output_folder_list,
+                               kraken_database_path, whether_use_mpa_style=True, thread=None, stage_root="/dev/shm",
+                               keep_staged_database=False, total_cores=None, total_mem_gb=None, mem_per_job_gb=4):
+    """
+    Batch mode of kraken_process_step4: the database is loaded into memory once for the whole cohort and every
+    kraken2 call memory-maps it, instead of reading the database from disk for each sample
+    :param sample_name_list: ["sample1", "sample2"]
+    :param all_sample_fq_path_list: [["path/x.fq"], ["path/x_R1.fq", "path/x_R2.fq"]]
+    :param sample_output_folder_list: ["output_path/subject1/sample1", "output_path/subject1/sample2"]
+    :param kraken_database_path: "user_path/software/kraken2/NCBI_standard"
+    :param whether_use_mpa_style: whether output metaphlan style output
+    :param thread: threads of each kraken2 call when samples run one by one
+    :param stage_root: tmpfs directory where the database is copied, "/dev/shm"
+    :param keep_staged_database: keep the staged copy for later runs on the same node, otherwise it is removed when
+    the last run using it finishes
+    :param total_cores: if given, samples run concurrently within this core budget (see run_samples_concurrently)
+    :param total_mem_gb: memory budget of concurrent jobs, the shared database is not counted per job
+    :param mem_per_job_gb: memory of one kraken2 job besides the shared database
+    :return:
+    """
+    missing_db_file_list = [i for i in KRAKEN_DATABASE_FILES if not os.path.isfile(os.path.join(kraken_database_path, i))]
+    if missing_db_file_list:
+        print(f"Error! {kraken_database_path} is not a Kraken2 database, {missing_db_file_list} are missing. Terminated.")
+        sys.exit(1)
+    # the database is only staged if a sample still needs to be classified
+    pending_index_list = []
+    for sample_index, sample_name in enumerate(sample_name_list):
+        sample_output_folder = sample_output_folder_list[sample_index]
+        command_kraken2 = kraken2_command(sample_name, all_sample_fq_path_list[sample_index], sample_output_folder,
+                                          kraken_database_path, whether_use_mpa_style, thread, memory_mapping=True)
+        if step_is_complete(step_manifest_path(sample_output_folder, "kraken2", sample_name),
+                            all_sample_fq_path_list[sample_index], command_kraken2, [kraken_database_path]):
+            print(f"Sample {sample_name} has been processed by Kraken. Skip it!")
+        else:
+            pending_index_list.append(sample_index)
+    if not pending_index_list:
+        print("All samples have been processed by Kraken, the database is not staged")
+        return
+    sample_name_list = [sample_name_list[i] for i in pending_index_list]
+    all_sample_fq_path_list = [all_sample_fq_path_list[i] for i in pending_index_list]
+    sample_output_folder_list = [sample_output_folder_list[i] for i in pending_index_list]
+    db_path_to_use, using_staged_copy = stage_kraken_database(kraken_database_path, stage_root)
+    try:
+        if total_cores is None:
+            kraken_process_step4(sample_name_list, all_sample_fq_path_list, sample_output_folder_list, db_path_to_use,
+                                 whether_use_mpa_style, thread=thread, memory_mapping=True)
+        else:
+            sample_job_dict = {}
+            for sample_index, sample_name in enumerate(sample_name_list):
+                sample_job_dict[sample_name] = (([sample_name], [all_sample_fq_path_list[sample_index]],
+                                                 [sample_output_folder_list[sample_index]], db_path_to_use),
+                                                {"whether_use_mpa_style": whether_use_mpa_style,
+                                                 "memory_mapping": True})
+            run_samples_concurrently(sample_job_dict, kraken_process_step4, total_cores, total_mem_gb,
+                                     mem_per_job_gb, max_thread=thread)
+    finally:
+        if using_staged_copy:
+            release_kraken_database(db_path_to_use, keep_staged_database)
+
+
+# prefix of the last taxon of a MPA-style lineage and the rank it stands for
+MPA_RANK_DICT = {"d": "Domain", "k": "Kingdom", "p": "Phylum", "c": "Class", "o": "Order", "f": "Family",
+                 "g": "Genus", "s": "Species"}
+
+
+def kraken_report_combine(report_path_list, sample_name_list, output_prefix, output_format="parquet", processes=4):
+    """
+    Combine MPA-style Kraken2 reports (--use-mpa-style --report-zero-counts) of many samples into one sparse
+    taxon x sample count matrix per rank, zero rows are dropped while reading
+    :param report_path_list: ["kraken2_dir/sample1_report.txt", "kraken2_dir/sample2_report.txt"]
+    :param sample_name_list: ["sample1", "sample2"]
+    :param output_prefix: "kraken2_dir/combined_counts", outputs are combined_counts_Species.parquet etc.
+    :param output_format: "parquet" (long table taxon, sample, value) or "tsv" (dense), readable by
+    load_kraken_count_matrix() in the downstream notebook
+    :param processes: number of processes reading reports
+    :return: {"Species": "kraken2_dir/combined_counts_Species.parquet"}
+    """
+    feature_matrix = combine_feature_reports(report_path_list, sample_name_list, processes=processes)
+    feature_matrix["feature_column_name"] = "taxon"
+    feature_matrix["values"] = feature_matrix["values"].astype(np.int64)     # read counts
+    # rank of each lineage from the prefix of its last taxon, e.g. d__Bacteria|...|s__Escherichia coli -> s
+    rank_prefix_array = feature_matrix["features"].str.extract(r"(?:^|\|)([a-z])__[^|]*$", expand=False).values
+    rank_output_dict = {}
+    for rank_prefix, rank_name in MPA_RANK_DICT.items():
+        rank_mask = rank_prefix_array == rank_prefix
+        if not rank_mask.any():
+            continue
+        rank_output_path = f"{output_prefix}_{rank_name}.{output_format}"
+        write_feature_matrix(subset_feature_matrix(feature_matrix, rank_mask), rank_output_path, output_format)
+        rank_output_dict[rank_name] = rank_output_path
+        print(f"{rank_mask.sum()} taxa at {rank_name} level are written to {rank_output_path}")
+    return rank_output_dict
+
+
+# k-mer hits of every read of a Kraken2 --output file, raw uint32 files under the index directory
+KRAKEN_READ_INDEX_FILES = ["hit_number", "total_kmers", "hit_taxid", "hit_count"]
+# rank of the taxonomy and its prefix in MPA-style reports (NCBI renamed superkingdom to domain in 2025)
+KRAKEN_MPA_PREFIX_DICT = {"superkingdom": "d", "domain": "d", "kingdom": "k", "phylum": "p", "class": "c",
+                          "order": "o", "family": "f", "genus": "g", "species": "s"}
+
+
+def load_kraken_taxonomy(taxonomy_dir):
+    """
+    Read the taxonomy a Kraken2 database was built with (kraken2-build keeps nodes.dmp and names.dmp in DB/taxonomy)
+    :param taxonomy_dir: "user_path/software/kraken2/NCBI_standard/taxonomy"
+    :return: {"taxid": taxid of each node, "parent": node index of the parent (the root is its own parent),
+    "depth": 0 for the root, "rank": rank of each node, "name": scientific name of each node,
+    "node_of_taxid": node index of each taxid, -1 for taxids not in the taxonomy}
+    """
+    nodes_df = pd.read_csv(os.path.join(taxonomy_dir, "nodes.dmp"), sep="\t", header=None, usecols=[0, 2, 4],
+                           quoting=csv.QUOTE_NONE, dtype={0: np.int64, 2: np.int64, 4: str})
+    node_taxid = nodes_df[0].values
+    node_of_taxid = np.full(node_taxid.max() + 1, -1, dtype=np.int64)
+    node_of_taxid[node_taxid] = np.arange(len(node_taxid))
+    parent = node_of_taxid[nodes_df[2].values]
+    # depth of each node: number of steps to the root
+    depth = np.zeros(len(parent), dtype=np.int64)
+    current_node = np.arange(len(parent))
+    below_root = parent[current_node] != current_node
+    while below_root.any():
+        depth += below_root
+        current_node = parent[current_node]
+        below_root = parent[current_node] != current_node
+
+    names_df = pd.read_csv(os.path.join(taxonomy_dir, "names.dmp"), sep="\t", header=None, usecols=[0, 2, 6],
+                           quoting=csv.QUOTE_NONE, dtype={0: np.int64, 2: str, 6: str})
+    names_df = names_df[names_df[6] == "scientific name"]
+    name = np.full(len(parent), "", dtype=object)
+    name[node_of_taxid[names_df[0].values]] = names_df[2].values
+    return {"taxid": node_taxid, "parent": parent, "depth": depth, "rank": nodes_df[4].values, "name": name,
+            "node_of_taxid": node_of_taxid}
+
+
+def build_kraken_read_index(kraken_output_path, index_dir=None, chunk_reads=500000):
+    """
+    Convert the per-read output of Kraken2 (--output) into a compact binary index of the k-mer hits of each read,
+    kraken_reanalysis() recomputes the classification from it under other settings without running Kraken2 again
+    Every "taxid:count" run of the k-mer LCA string with taxid > 0 is kept as one hit, unclassified ("0") and
+    ambiguous ("A") k-mers only count towards the total k-mer number of the read, as in Kraken2
+    :param kraken_output_path: "kraken2_dir/sample1_output.txt"
+    :param index_dir: default "kraken2_dir/sample1_output_index"
+    :param chunk_reads: number of reads parsed at a time
+    :return: index_dir, with hit_number and total_kmers of each read, hit_taxid and hit_count of each hit (raw uint32
+    files) and index.json, which is written last and records the output file the index was built from
+    """
+    if index_dir is None:
+        index_dir = re.sub(r"\.txt$", "", kraken_output_path) + "_index"
+    index_meta_path = os.path.join(index_dir, "index.json")
+    source_signature = file_signature(kraken_output_path)
+    if os.path.exists(index_meta_path):
+        with open(index_meta_path) as index_meta_f:
+            if json.load(index_meta_f)["source"] == source_signature:
+                print(f"{index_dir} is up to date with {kraken_output_path}. Skip it!")
+                return index_dir
+        os.remove(index_meta_path)
+    os.makedirs(index_dir, exist_ok=True)
+
+    read_number, hit_number_total = 0, 0
+    index_file_dict = {i: open(os.path.join(index_dir, f"{i}.bin"), "wb") for i in KRAKEN_READ_INDEX_FILES}
+    try:
+        # column 5 is the LCA string, e.g. "562:13 561:4 A:31 |:| 0:1 562:100"
+        for chunk_df in pd.read_csv(kraken_output_path, sep="\t", header=None, usecols=[4], dtype=str,
+                                    keep_default_na=False, quoting=csv.QUOTE_NONE, chunksize=chunk_reads):
+            lca_series = chunk_df[4]
+            run_number = (lca_series.str.count(":") - lca_series.str.count(r"\|:\|")).values
+            lca_text = " ".join(lca_series.values).replace("|:|", " ").replace("A:", "0:").replace(":", " ")
+            run_array = np.array(lca_text.split(), dtype=np.int64).reshape(-1, 2)
+            run_read = np.repeat(np.arange(len(lca_series)), run_number)
+            is_hit = run_array[:, 0] > 0
+            chunk_array_dict = {"hit_number": np.bincount(run_read[is_hit], minlength=len(lca_series)),
+                                "total_kmers": np.bincount(run_read, weights=run_array[:, 1],
+                                                           minlength=len(lca_series)),
+                                "hit_taxid": run_array[is_hit, 0],
+                                "hit_count": run_array[is_hit, 1]}
+            for index_name, index_f in index_file_dict.items():
+                chunk_array_dict[index_name].astype(np.uint32).tofile(index_f)
+            read_number += len(lca_series)
+            hit_number_total += int(is_hit.sum())
+    finally:
+        for index_f in index_file_dict.values():
+            index_f.close()
+    with open(index_meta_path, "w") as index_meta_f:
+        json.dump({"source": source_signature, "read_number": read_number, "hit_number": hit_number_total},
+                  index_meta_f, indent=1)
+    print(f"{read_number} reads with {hit_number_total} k-mer hits of {kraken_output_path} are indexed in {index_dir}")
+    return index_dir
+
+
+def build_kraken_read_weight(kraken_output_path, multiplicity_path, index_dir=None, chunk_reads=500000):
+    """
+    Number of original read pairs behind each read of a Kraken2 --output file run on deduplicated reads, aligned with
+    the index of build_kraken_read_index()
+    :param kraken_output_path: "kraken2_dir/sample1_output.txt"
+    :param multiplicity_path: written by dedup_read_pairs_step3(), reads not in it have no duplicates
+    :param index_dir: default "kraken2_dir/sample1_output_index"
+    :param chunk_reads: number of reads read at a time
+    :return: path of read_weight.bin (uint32 per read) in index_dir
+    """
+    if index_dir is None:
+        index_dir = re.sub(r"\.txt$", "", kraken_output_path) + "_index"
+    weight_path = os.path.join(index_dir, "read_weight.bin")
+    weight_meta_path = os.path.join(index_dir, "read_weight.json")
+    weight_signature = {"source": file_signature(kraken_output_path), "multiplicity": file_signature(multiplicity_path)}
+    if os.path.exists(weight_meta_path):
+        with open(weight_meta_path) as weight_meta_f:
+            if json.load(weight_meta_f) == weight_signature:
+                return weight_path
+        os.remove(weight_meta_path)
+    os.makedirs(index_dir, exist_ok=True)
+    multiplicity_series = pd.read_csv(multiplicity_path, sep="\t", index_col=0, dtype={"read_id": str},
+                                      quoting=csv.QUOTE_NONE)["count"]
+    multiplicity_series.index = multiplicity_series.index.str.replace(r"/1$", "", regex=True)
+    with open(weight_path, "wb") as weight_f:
+        for chunk_df in pd.read_csv(kraken_output_path, sep="\t", header=None, usecols=[1], dtype=str,
+                                    keep_default_na=False, quoting=csv.QUOTE_NONE, chunksize=chunk_reads):
+            read_id_series = chunk_df[1].str.replace(r"/1$", "", regex=True)
+            read_id_series.map(multiplicity_series).fillna(1).values.astype(np.uint32).tofile(weight_f)
+    with open(weight_meta_path, "w") as weight_meta_f:
+        json.dump(weight_signature, weight_meta_f, indent=1)
+    return weight_path
+
+
+def iter_kraken_read_index(index_dir, chunk_reads=1000000):
+    """
+    :param index_dir: output of build_kraken_read_index()
+    :param chunk_reads: number of reads loaded at a time
+    :return: generator of (hit_number, total_kmers, hit_taxid, hit_count) of chunk_reads reads at a time
+    """
+    index_file_dict = {i: open(os.path.join(index_dir, f"{i}.bin"), "rb") for i in KRAKEN_READ_INDEX_FILES}
+    try:
+        while True:
+            hit_number = np.fromfile(index_file_dict["hit_number"], dtype=np.uint32, count=chunk_reads)
+            if len(hit_number) == 0:
+                break
+            total_kmers = np.fromfile(index_file_dict["total_kmers"], dtype=np.uint32, count=len(hit_number))
+            chunk_hit_number = int(hit_number.sum())
+            hit_taxid = np.fromfile(index_file_dict["hit_taxid"], dtype=np.uint32, count=chunk_hit_number)
+            hit_count = np.fromfile(index_file_dict["hit_count"], dtype=np.uint32, count=chunk_hit_number)
+            yield hit_number.astype(np.int64), total_kmers.astype(np.int64), hit_taxid.astype(np.int64), \
+                hit_count.astype(np.int64)
+    finally:
+        for index_f in index_file_dict.values():
+            index_f.close()
+
+
+def _lowest_common_ancestor(taxonomy, node_a, node_b):
+    parent, depth = taxonomy["parent"], taxonomy["depth"]
+    node_a, node_b = node_a.copy(), node_b.copy()
+    differ = node_a != node_b
+    while differ.any():
+        move_a = differ & (depth[node_a] >= depth[node_b])
+        move_b = differ & (depth[node_b] >= depth[node_a])
+        node_a[move_a] = parent[node_a[move_a]]
+        node_b[move_b] = parent[node_b[move_b]]
+        differ = node_a != node_b
+    return node_a
+
+
+def _ancestor_at_depth(taxonomy, node, target_depth):
+    parent, depth = taxonomy["parent"], taxonomy["depth"]
+    node = node.copy()
+    above = depth[node] > target_depth
+    while above.any():
+        node[above] = parent[node[above]]
+        above = depth[node] > target_depth
+    return node
+
+
+def resolve_kraken_reads(taxonomy, hit_number, total_kmers, hit_taxid, hit_count, confidence_list=(0.0,),
+                         minimum_hit_groups=1):
+    """
+    Classify reads from their k-mer hits the way Kraken2 does (ResolveTree of classify.cc): the taxon whose
+    root-to-leaf path has the most hits is called (ties resolve to their LCA), then the call moves up until the hits
+    within its clade reach confidence * total k-mers of the read
+    Kraken2 counts minimizer hit groups, which the LCA string does not keep, so the number of hit runs of a read (a
+    lower bound of its hit groups) is compared with minimum_hit_groups instead; a few reads with more hit groups than
+    runs can therefore become unclassified when minimum_hit_groups > 1
+    :param taxonomy: output of load_kraken_taxonomy()
+    :param hit_number, total_kmers, hit_taxid, hit_count: one chunk of iter_kraken_read_index()
+    :param confidence_list: [0.0, 0.1, 0.5], every confidence threshold is resolved in the same pass
+    :param minimum_hit_groups: 1 disables the filter as in kraken 2.0.8 (loaded by STEP_SBATCH_DICT), Kraken2 >= 2.1
+    uses 2 by default
+    :return: {confidence: node index called for each read, -1 for unclassified reads}
+    """
+    read_number = len(hit_number)
+    node_number = len(taxonomy["parent"])
+    parent, depth = taxonomy["parent"], taxonomy["depth"]
+    hit_read = np.repeat(np.arange(read_number), hit_number)
+    hit_node = taxonomy["node_of_taxid"][np.minimum(hit_taxid, len(taxonomy["node_of_taxid"]) - 1)]
+    known_taxon = (hit_node >= 0) & (hit_taxid < len(taxonomy["node_of_taxid"]))
+    if not known_taxon.all():
+        print(f"Warning! {np.unique(hit_taxid[~known_taxon])[:10]} are not in the taxonomy, their hits are ignored.")
+        hit_read, hit_node, hit_count = hit_read[known_taxon], hit_node[known_taxon], hit_count[known_taxon]
+
+    # hit count of each distinct (read, taxon), sorted by read then taxon
+    hit_key, key_inverse = np.unique(hit_read * node_number + hit_node, return_inverse=True)
+    key_count = np.bincount(key_inverse, weights=hit_count).astype(np.int64)
+    key_read, key_node = hit_key // node_number, hit_key % node_number
+
+    # score of each taxon: hits of the taxon and all its ancestors in the same read
+    key_score = key_count.copy()
+    walk_index = np.flatnonzero(depth[key_node] > 0)
+    walk_node = key_node[walk_index]
+    while len(walk_index):
+        walk_node = parent[walk_node]
+        lookup_key = key_read[walk_index] * node_number + walk_node
+        lookup_position = np.minimum(np.searchsorted(hit_key, lookup_key), len(hit_key) - 1)
+        found = hit_key[lookup_position] == lookup_key
+        key_score[walk_index[found]] += key_count[lookup_position[found]]
+        below_root = depth[walk_node] > 0
+        walk_index, walk_node = walk_index[below_root], walk_node[below_root]
+
+    read_call_dict = {i: np.full(read_number, -1, dtype=np.int64) for i in confidence_list}
+    if len(hit_key) == 0:
+        return read_call_dict
+    # reads with hits, each is a group of consecutive keys
+    group_start = np.flatnonzero(np.r_[True, key_read[1:] != key_read[:-1]])
+    group_size = np.diff(np.r_[group_start, len(key_read)])
+    group_read = key_read[group_start]
+    key_group = np.repeat(np.arange(len(group_start)), group_size)
+    # highest scoring taxon of each read, LCA of all taxa sharing the highest score
+    tied_index = np.flatnonzero(key_score == np.repeat(np.maximum.reduceat(key_score, group_start), group_size))
+    tied_group = key_group[tied_index]
+    tied_start = np.flatnonzero(np.r_[True, tied_group[1:] != tied_group[:-1]])
+    tied_rank = np.arange(len(tied_index)) - np.repeat(tied_start, np.diff(np.r_[tied_start, len(tied_index)]))
+    max_node = key_node[tied_index[tied_start]]
+    for rank in range(1, tied_rank.max() + 1):
+        rank_mask = tied_rank == rank
+        rank_group = tied_group[rank_mask]
+        max_node[rank_group] = _lowest_common_ancestor(taxonomy, max_node[rank_group],
+                                                       key_node[tied_index[rank_mask]])
+
+    # hits within the clade of an ancestor of max_node at depth d: keys whose LCA with max_node is at depth >= d
+    # sorting keys by that depth (descending) in each read, the call is at the depth where the hits add up to the
+    # required score
+    lca_depth = depth[_lowest_common_ancestor(taxonomy, key_node, max_node[key_group])]
+    key_order = np.lexsort((-lca_depth, key_group))
+    ordered_depth = lca_depth[key_order]
+    ordered_cumsum = np.cumsum(key_count[key_order])
+    ordered_cumsum -= np.repeat(ordered_cumsum[group_start] - key_count[key_order][group_start], group_size)
+    enough_groups = hit_number[group_read] >= minimum_hit_groups
+    for confidence in confidence_list:
+        required_score = np.ceil(confidence * total_kmers[group_read]).astype(np.int64)
+        below_required = ordered_cumsum < np.repeat(required_score, group_size)
+        first_enough = group_start + np.add.reduceat(below_required.astype(np.int64), group_start)
+        classified = (first_enough < group_start + group_size) & enough_groups
+        call_depth = np.where(required_score > 0, ordered_depth[np.minimum(first_enough, len(key_order) - 1)],
+                              depth[max_node])
+        call_node = _ancestor_at_depth(taxonomy, max_node, call_depth)
+        read_call_dict[confidence][group_read[classified]] = call_node[classified]
+    return read_call_dict
+
+
+def write_kraken_mpa_report(taxonomy, clade_reads, report_path):
+    """
+    Write clade read counts as a MPA-style report like kraken2 --use-mpa-style --use-names, which
+    kraken_report_combine() reads, taxa without reads are left out
+    :param taxonomy: output of load_kraken_taxonomy()
+    :param clade_reads: reads assigned to each node and its descendants
+    :param report_path: "kraken2_dir/sample1_conf0.1_mhg1_report.txt"
+    :return:
+    """
+    parent, rank = taxonomy["parent"], taxonomy["rank"]
+    mpa_node_array = np.flatnonzero(np.isin(rank, list(KRAKEN_MPA_PREFIX_DICT.keys())) & (clade_reads > 0))
+    lineage_list = []
+    for node in mpa_node_array:
+        lineage = []
+        current_node = node
+        while True:
+            if rank[current_node] in KRAKEN_MPA_PREFIX_DICT:
+                lineage.append(f"{KRAKEN_MPA_PREFIX_DICT[rank[current_node]]}__{taxonomy['name'][current_node]}")
+            if parent[current_node] == current_node:
+                break
+            current_node = parent[current_node]
+        lineage_list.append("|".join(lineage[::-1]))
+    report_df = pd.DataFrame({"lineage": lineage_list, "reads": clade_reads[mpa_node_array]})
+    report_df.sort_values("lineage").to_csv(report_path, sep="\t", header=False, index=False,
+                                            quoting=csv.QUOTE_NONE)
+
+
+def kraken_reanalysis(kraken_output_path, taxonomy, output_prefix, confidence_list=(0.0,), minimum_hit_groups=1,
+                      chunk_reads=1000000, multiplicity_path=None):
+    """
+    Recount the reads of a Kraken2 --output file under new confidence thresholds without running Kraken2 again, the
+    output is indexed once by build_kraken_read_index() and later calls only read the index
+    :param kraken_output_path: "kraken2_dir/sample1_output.txt"
+    :param taxonomy: output of load_kraken_taxonomy() of the database Kraken2 was run with
+    :param output_prefix: "kraken2_dir/sample1", outputs are sample1_conf0.1_mhg1_report.txt (MPA-style clade counts)
+    and sample1_conf0.1_mhg1_taxa.tsv (clade and direct counts of every taxon of any rank)
+    :param confidence_list: [0.0, 0.1, 0.5], all are computed in one pass over the index
+    :param minimum_hit_groups: see resolve_kraken_reads()
+    :param chunk_reads: number of reads resolved at a time
+    :param multiplicity_path: if Kraken2 was run on deduplicated reads (dedup_read_pairs_step3), each read is counted
+    as many times as it occurred before deduplication
+    :return: {confidence: MPA-style report path}
+    """
+    index_dir = build_kraken_read_index(kraken_output_path)
+    weight_f = None
+    if multiplicity_path is not None:
+        weight_f = open(build_kraken_read_weight(kraken_output_path, multiplicity_path, index_dir), "rb")
+    node_number = len(taxonomy["parent"])
+    direct_reads_dict = {i: np.zeros(node_number, dtype=np.int64) for i in confidence_list}
+    read_number = 0
+    try:
+        for chunk in iter_kraken_read_index(index_dir, chunk_reads):
+            read_weight = np.ones(len(chunk[0]), dtype=np.int64) if weight_f is None else \
+                np.fromfile(weight_f, dtype=np.uint32, count=len(chunk[0])).astype(np.int64)
+            read_call_dict = resolve_kraken_reads(taxonomy, *chunk, confidence_list=confidence_list,
+                                                  minimum_hit_groups=minimum_hit_groups)
+            for confidence, read_call in read_call_dict.items():
+                classified = read_call >= 0
+                direct_reads_dict[confidence] += np.bincount(read_call[classified], weights=read_weight[classified],
+                                                             minlength=node_number).astype(np.int64)
+            read_number += int(read_weight.sum())
+    finally:
+        if weight_f is not None:
+            weight_f.close()
+
+    # clade counts, adding each level to its parents from the deepest level up
+    depth_order = np.argsort(-taxonomy["depth"], kind="stable")
+    level_start = np.flatnonzero(np.r_[True, np.diff(taxonomy["depth"][depth_order]) != 0])
+    level_node_list = np.split(depth_order, level_start[1:])
+    report_path_dict = {}
+    for confidence, direct_reads in direct_reads_dict.items():
+        clade_reads = direct_reads.copy()
+        for level_node in level_node_list:
+            level_node = level_node[taxonomy["depth"][level_node] > 0]
+            np.add.at(clade_reads, taxonomy["parent"][level_node], clade_reads[level_node])
+        setting_prefix = f"{output_prefix}_conf{confidence:g}_mhg{minimum_hit_groups}"
+        report_path_dict[confidence] = f"{setting_prefix}_report.txt"
+        write_kraken_mpa_report(taxonomy, clade_reads, report_path_dict[confidence])
+        taxon_node = np.flatnonzero(clade_reads > 0)
+        taxa_df = pd.DataFrame({"taxid": taxonomy["taxid"][taxon_node], "name": taxonomy["name"][taxon_node],
+                                "rank": taxonomy["rank"][taxon_node], "clade_reads": clade_reads[taxon_node],
+                                "direct_reads": direct_reads[taxon_node]})
+        taxa_df["clade_percent"] = (100 * taxa_df["clade_reads"] / max(read_number, 1)).round(4)
+        unclassified_reads = read_number - direct_reads.sum()
+        taxa_df = pd.concat([pd.DataFrame({"taxid": [0], "name": ["unclassified"], "rank": ["no rank"],
+                                           "clade_reads": [unclassified_reads], "direct_reads": [unclassified_reads],
+                                           "clade_percent": [round(100 * unclassified_reads / max(read_number, 1), 4)]}),
+                             taxa_df.sort_values("clade_reads", ascending=False)])
+        taxa_df.to_csv(f"{setting_prefix}_taxa.tsv", sep="\t", index=False)
+        print(f"Confidence {confidence:g}: {read_number - unclassified_reads} of {read_number} reads of "
+              f"{kraken_output_path} are classified, written to {setting_prefix}_report.txt")
+    return report_path_dict
 
 
 ##########################################################################
@@ -206,7 +2435,32 @@ def kraken_process_step4(sample_name_list, all_sample_fq_path_list, sample_outpu
 # #                                                                    # #
 ##########################################################################
 ##########################################################################
-def humann_analysis_step5(input_fq_path, humann_output_dir, output_basename, metaphlan_dir, metaphlan_index, chocophlan_dir, uniref_dir, thread=16):
+def write_humann_input_fastq(fq_path_list, combined_fq_path):
+    """
+    Decompress and concatenate paired reads into the plain fastq read by HUMAnN3, spaces are removed as HUMAnN3 does
+    HUMAnN3 requires a regular input file and makes its own decompressed (and space-free) copy of gzipped input, so a
+    plain combined file written once replaces both the combined .gz copy and the copies HUMAnN3 would make of it
+    :param fq_path_list: ["XXX_kneaddata_paired_1.fastq.gz", "XXX_kneaddata_paired_2.fastq.gz"]
+    :param combined_fq_path: "sample_dir/XXX_kneaddata_combined.fastq"
+    :return: combined_fq_path
+    """
+    if all(i.endswith(".gz") for i in fq_path_list):
+        read_cmd = ["gzip", "-dc"] + list(fq_path_list)
+    else:
+        read_cmd = ["cat"] + list(fq_path_list)
+    with open(combined_fq_path, "wb") as combined_f:
+        read_process = subprocess.Popen(read_cmd, stdout=subprocess.PIPE)
+        strip_process = subprocess.Popen(["tr", "-d", " "], stdin=read_process.stdout, stdout=combined_f)
+        read_process.stdout.close()     # strip_process owns the pipe now
+        strip_process.wait()
+        read_process.wait()
+    if read_process.returncode != 0 or strip_process.returncode != 0:
+        raise PipelineCommandError(f"Failed to combine {fq_path_list} into {combined_fq_path}")
+    return combined_fq_path
+
+
+def humann_analysis_step5(input_fq_path, humann_output_dir, output_basename, metaphlan_dir, metaphlan_index, chocophlan_dir, uniref_dir, thread=16, input_format=None,
+                          input_path_list=None):
     """
     HUMAnN3 analysis command
     Module required: module add python/cpu/3.7.2
@@ -219,24 +2473,36 @@ def humann_analysis_step5(input_fq_path, humann_output_dir, output_basename, met
     user_path/software/HUMAnN3_database/chocophlan
     :param uniref_dir: protein-database, user_path/software/HUMAnN3_database/uniref
     :param thread: Ze used 16
+    :param input_format: e.g. "fastq", None lets HUMAnN3 detect it from the input file
+    :param input_path_list: input size recorded in the metrics, default [input_fq_path]; the kneaddata fqs of the
+    sample, so that the resource history of HUMAnN3 is in the same units as its planning
     :return:
     """
-    command_humann3 = f"humann --input {input_fq_path} --output {humann_output_dir} -" \
-                      f"-output-basename {output_basename} --metaphlan-options '--bowtie2db {metaphlan_dir} --index {metaphlan_index} --read_min_len 10 -t marker_ab_table --add_viruses' " \
-                      f"--nucleotide-database {chocophlan_dir} --protein-database {uniref_dir} " \
+    metaphlan_options = f"--bowtie2db {shlex.quote(metaphlan_dir)} --index {metaphlan_index} --read_min_len 10 " \
+                        f"-t marker_ab_table --add_viruses"
+    command_humann3 = f"humann --input {shlex.quote(input_fq_path)} --output {shlex.quote(humann_output_dir)} -" \
+                      f"-output-basename {output_basename} --metaphlan-options {shlex.quote(metaphlan_options)} " \
+                      f"--nucleotide-database {shlex.quote(chocophlan_dir)} " \
+                      f"--protein-database {shlex.quote(uniref_dir)} " \
                       f"--prescreen-threshold 0.001 --threads {thread} --verbose"
+    if input_format is not None:
+        command_humann3 += f" --input-format {input_format}"
     print(f"The command of HUMAnN3 is {command_humann3}")
-    os.system(command_humann3)
+    run_tool_command(command_humann3, "humann3", output_basename, thread, input_path_list or [input_fq_path])
 
 
-def humann_pathway_report_combine(humann_pathway_report_path_list, combined_report_path):
-    df0 = pd.read_table(humann_pathway_report_path_list[0])
-    for humann_pathway_report_path in humann_pathway_report_path_list[1:]:
-        df_add = pd.read_table(humann_pathway_report_path)
-        df0 = pd.merge(df0, df_add, on='# Pathway', how="outer")
-    df0.fillna(0)
-    df0.to_csv(combined_report_path, sep="\t", index=False)
-    # return df0
+def humann_pathway_report_combine(humann_pathway_report_path_list, combined_report_path, output_format="tsv",
+                                  processes=4):
+    """
+    Combine HUMAnN3 reports (pathabundance, pathcoverage or genefamilies) of many samples, missing values are 0
+    :param humann_pathway_report_path_list: ["S1_pathabundance.tsv", "S2_pathabundance.tsv"]
+    :param combined_report_path: "combined_pathabundance.tsv"
+    :param output_format: "tsv" (dense) or "parquet" (sparse long table)
+    :param processes: number of processes reading reports
+    :return:
+    """
+    feature_matrix = combine_feature_reports(humann_pathway_report_path_list, processes=processes)
+    write_feature_matrix(feature_matrix, combined_report_path, output_format)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,152 @@
+"""
+Sample manifest shared by all step scripts: an index of sample -> fq files of a directory, with stat metadata
+The index is cached in the directory (.sample_manifest.json) and updated incrementally, so a directory with many files
+is only fully scanned once
+
+Sample names are parsed from the end of the file name, so names containing "_" are kept whole:
+S_01_combined_R1.fastq.gz                              -> S_01 (mate 1)
+S_01_combined_R1_val_1.fq.gz                           -> S_01 (mate 1), trim_galore output
+S_01_combined_R1_val_1_kneaddata_paired_2.fastq.gz     -> S_01 (mate 2), kneaddata output
+"""
+
+
+import json
+import os
+import re
+import time
+
+
+MANIFEST_FILE_NAME = ".sample_manifest.json"
+FQ_EXTENSION_PATTERN = re.compile(r"\.(fastq|fq)(\.gz)?$")
+# suffixes added by trim_galore / kneaddata, the last one gives the read mate
+PIPELINE_SUFFIX_PATTERN = re.compile(r"_(kneaddata_paired|val)_([12])$")
+# read mate marker of raw files, e.g. _R1, _R2_001, _1
+READ_MATE_PATTERN = re.compile(r"[._]R?([12])(_\d{3})?$")
+# parts of raw file names that are not part of the sample name
+SAMPLE_NAME_SUFFIX_LIST = ["_combined"]
+# files used as input of each step
+FILE_KIND_DICT = {"raw": lambda x: x.endswith(".gz") and "combined" in x,
+                  "trim_galore": lambda x: x.endswith(".gz"),
+                  "kneaddata": lambda x: x.endswith("kneaddata_paired_1.fastq.gz") or
+                  x.endswith("kneaddata_paired_2.fastq.gz")}
+# files modified this recently (seconds) when the index was saved may still be growing, they are stat-ed again
+RECENT_FILE_SECONDS = 120
+
+
+def parse_fq_file_name(file_name):
+    """
+    :param file_name: "S_01_combined_R1_val_1_kneaddata_paired_2.fastq.gz"
+    :return: ("S_01", 2), None if it is not a fq file
+    """
+    extension_match = FQ_EXTENSION_PATTERN.search(file_name)
+    if extension_match is None:
+        return None
+    name = file_name[:extension_match.start()]
+    mate = None
+    suffix_match = PIPELINE_SUFFIX_PATTERN.search(name)
+    while suffix_match is not None:
+        if mate is None:
+            mate = int(suffix_match.group(2))
+        name = name[:suffix_match.start()]
+        suffix_match = PIPELINE_SUFFIX_PATTERN.search(name)
+    mate_match = READ_MATE_PATTERN.search(name)
+    if mate_match is not None:
+        if mate is None:
+            mate = int(mate_match.group(1))
+        name = name[:mate_match.start()]
+    for sample_name_suffix in SAMPLE_NAME_SUFFIX_LIST:
+        if name.endswith(sample_name_suffix):
+            name = name[:-len(sample_name_suffix)]
+    return name, mate
+
+
+def scan_directory(data_dir, use_cache=True):
+    """
+    Index of all files of a directory, read from the cache when the directory has not changed since it was saved
+    :param data_dir: "XXX/kneaddata"
+    :param use_cache: False ignores the saved index and scans everything again
+    :return: {"S_01_combined_R1.fastq.gz": {"size": 1034, "mtime": 1721000000.0}}
+    """
+    manifest_path = os.path.join(data_dir, MANIFEST_FILE_NAME)
+    dir_mtime = os.stat(data_dir).st_mtime
+    cached_manifest = {}
+    if use_cache and os.path.exists(manifest_path):
+        try:
+            with open(manifest_path) as manifest_f:
+                cached_manifest = json.load(manifest_f)
+        except (OSError, ValueError):
+            cached_manifest = {}
+    cached_file_dict = cached_manifest.get("files", {})
+    if cached_manifest.get("dir_mtime") == dir_mtime and \
+            all(j["mtime"] < cached_manifest.get("saved", 0) - RECENT_FILE_SECONDS for j in cached_file_dict.values()):
+        return cached_file_dict
+    # incremental update: only new files and files that were still recent at the last scan are stat-ed
+    stat_before = cached_manifest.get("saved", 0) - RECENT_FILE_SECONDS
+    file_dict = {}
+    with os.scandir(data_dir) as entry_iterator:
+        for entry in entry_iterator:
+            if entry.name == MANIFEST_FILE_NAME or not entry.is_file():
+                continue
+            cached_file = cached_file_dict.get(entry.name)
+            if cached_file is not None and cached_file["mtime"] < stat_before:
+                file_dict[entry.name] = cached_file
+            else:
+                entry_stat = entry.stat()
+                file_dict[entry.name] = {"size": entry_stat.st_size, "mtime": entry_stat.st_mtime}
+    try:
+        manifest = {"dir_mtime": dir_mtime, "saved": time.time(), "files": file_dict}
+        unchanged_while_scanning = os.stat(data_dir).st_mtime == dir_mtime
+        temp_manifest_path = f"{manifest_path}.{os.getpid()}.tmp"
+        with open(temp_manifest_path, "w") as manifest_f:
+            json.dump(manifest, manifest_f)
+        os.replace(temp_manifest_path, manifest_path)
+        if unchanged_while_scanning:
+            # replacing the index changes the mtime of data_dir, record the mtime after it so the next call hits the
+            # cache; rewriting the existing file in place leaves the mtime of data_dir as it is
+            manifest["dir_mtime"] = os.stat(data_dir).st_mtime
+            with open(manifest_path, "r+") as manifest_f:
+                json.dump(manifest, manifest_f)
+                manifest_f.truncate()
+    except OSError:
+        # read-only directory, the index is simply not saved
+        pass
+    return file_dict
+
+
+def build_sample_fq_dict(data_dir, file_kind, use_cache=True):
+    """
+    :param data_dir: "XXX/raw_data"
+    :param file_kind: "raw", "trim_galore" or "kneaddata", see FILE_KIND_DICT
+    :param use_cache: use the saved index of data_dir
+    :return: {"sample1": ["path/XXX_R1.fq.gz", "path/XXX_R2.fq.gz"]}, fqs of a sample are ordered by read mate
+    """
+    file_filter = FILE_KIND_DICT[file_kind]
+    sample_file_dict = {}
+    for file_name in scan_directory(data_dir, use_cache):
+        if not file_filter(file_name):
+            continue
+        parsed_name = parse_fq_file_name(file_name)
+        if parsed_name is None:
+            continue
+        sample_name, mate = parsed_name
+        sample_file_dict.setdefault(sample_name, []).append((mate or 0, file_name))
+    sample_name_fq_dict = {}
+    for sample_name in sorted(sample_file_dict):
+        sample_name_fq_dict[sample_name] = [os.path.join(data_dir, i[1]) for i in sorted(sample_file_dict[sample_name])]
+    for sample_name, fqs in sample_name_fq_dict.items():
+        print(f"The number of fqs for {sample_name} is {len(fqs)}")
+    return sample_name_fq_dict
+
+
+def sample_fq_size_dict(sample_name_fq_dict):
+    """
+    :param sample_name_fq_dict: {"sample1": ["path/XXX_R1.fq.gz", "path/XXX_R2.fq.gz"]}
+    :return: {"sample1": total bytes of its fqs}, sizes come from the index of each directory instead of stat calls
+    """
+    dir_file_dict = {}
+    for fq_path in [k for j in sample_name_fq_dict.values() for k in j]:
+        fq_dir = os.path.dirname(fq_path) or "."
+        if fq_dir not in dir_file_dict:
+            dir_file_dict[fq_dir] = scan_directory(fq_dir)
+    return {i: sum(dir_file_dict[os.path.dirname(k) or "."][os.path.basename(k)]["size"] for k in j)
+            for i, j in sample_name_fq_dict.items()}
@@ -4,34 +4,49 @@ module add trimgalore/0.6.6 (include python/cpu/3.6.5)
 
 command line example:
 python step1_trim_galore_20240715.py input_directory_path output_directory_path
+run samples concurrently within a core/memory budget:
+python step1_trim_galore_20240715.py input_directory_path output_directory_path --total-cores 64 --total-mem-gb 256
+with one-pass fq statistics of the input (replaces fastqc):
+python step1_trim_galore_20240715.py input_directory_path output_directory_path --qc-dir qc_directory_path
 """
 
 
-import os
 import pipeline_metagenomic as pipe_meta
+import sample_manifest
 import sys
 
 
 def build_sample_dict_under_dir(data_dir):
-    # all paired gz files, data_dir = "XXX/raw_data"
-    all_gz_list = [i for i in os.listdir(data_dir) if i.endswith(".gz")]
-    all_gz_list = [i for i in all_gz_list if "combined" in i]   # only used combined
-    all_gz_list = sorted(all_gz_list)
-    sample_name_fq_dict = {}
-    # must be sorted file
-    for gz_file in sorted(all_gz_list):
-        sample_name = gz_file.split("_")[0]
-        if sample_name not in sample_name_fq_dict:
-            sample_name_fq_dict.update({sample_name: [os.path.join(data_dir, gz_file)]})
-        else:
-            sample_name_fq_dict[sample_name].append(os.path.join(data_dir, gz_file))
-    for sample_name, fqs in sample_name_fq_dict.items():
-        print(f"The number of fqs for {sample_name} is {len(fqs)}")
-    return sample_name_fq_dict
+    # all paired gz files, data_dir = "XXX/raw_data", only "combined" files are used
+    return sample_manifest.build_sample_fq_dict(data_dir, "raw")
 
 
 if __name__ == "__main__":
     gz_file_dir, output_dir = sys.argv[1:3]
+    step_options = pipe_meta.parse_step_options(sys.argv[3:])
+    metrics_path = pipe_meta.setup_metrics_log(step_options, output_dir)
+    pipe_meta.setup_command_execution(step_options, output_dir)
     sample_fq_dict = build_sample_dict_under_dir(gz_file_dir)  # {"sample1": ["path/XXX_R1.fq.gz", "path/XXX_R2.fq.gz"]}
-    for sample, fq_path_list in sample_fq_dict.items():
-        pipe_meta.trim_galore_process_step1(output_dir, fq_path_list, quality_threshold=25, thread=8)
+    sample_fq_dict = pipe_meta.select_samples(sample_fq_dict, step_options.sample_list)
+    if step_options.qc_dir is not None:
+        # one-pass statistics of the raw fqs, a single table instead of one fastqc report per file
+        pipe_meta.fastq_stats_report_step2(step_options.qc_dir, sample_fq_dict, thread=step_options.total_cores or 4,
+                                           total_mem_gb=step_options.total_mem_gb or
+                                           pipe_meta.node_memory_gb())
+    if step_options.total_cores is None:
+        for sample, fq_path_list in sample_fq_dict.items():
+            # 8 threads unless --resource-history has enough trim_galore runs to plan them from the input size
+            thread = pipe_meta.planned_thread("trim_galore", fq_path_list, 8, step_options.max_thread_per_job)
+            pipe_meta.trim_galore_process_step1(output_dir, fq_path_list, quality_threshold=25, thread=thread)
+    else:
+        step_resource = pipe_meta.STEP_RESOURCE_DEFAULTS["trim_galore"]
+        sample_job_dict = {sample: ((output_dir, fq_path_list), {"quality_threshold": 25})
+                           for sample, fq_path_list in sample_fq_dict.items()}
+        pipe_meta.run_samples_concurrently(sample_job_dict, pipe_meta.trim_galore_process_step1,
+                                           step_options.total_cores,
+                                           step_options.total_mem_gb or pipe_meta.node_memory_gb(),
+                                           step_options.mem_per_job_gb or step_resource["mem_gb"],
+                                           max_thread=step_options.max_thread_per_job or step_resource["thread"],
+                                           step_name="trim_galore", input_path_dict=sample_fq_dict,
+                                           min_mem_gb=step_options.mem_per_job_gb)
+    pipe_meta.summarize_metrics(metrics_path, metrics_path.replace(".jsonl", "_summary.tsv"))
@@ -2,45 +2,102 @@
 This script removes potential host reads, given the directory of sequencing files after Trim Galore
 
 module add python/cpu/3.7.2
+
+fused QC (trim_galore + kneaddata in local scratch, only kneaddata_paired outputs are written), the input is raw reads:
+python step3_kneaddata_20240715.py raw_data_dir kneaddata_dir host_bowtie_ref --fused-qc --scratch-dir /tmp
+the kept outputs are gzipped at level 6 (pigz or bgzip if available), change it by --compress-level 1-9 (0: no gzip)
+
+collapse duplicate read pairs after kneaddata, then give dedup_dir to step4 and step5 instead of kneaddata_dir:
+python step3_kneaddata_20240715.py trim_galore_dir kneaddata_dir host_bowtie_ref --dedup-dir dedup_dir
+step4 restores the read counts from before deduplication (XXX_multiplicity.tsv) in the reports it combines, step5 only
+warns: HUMAnN3 outputs of dedup_dir are abundances of unique read pairs
 """
 
 
-import os
 import pipeline_metagenomic as pipe_meta
+import sample_manifest
 import sys
 
 
-def build_sample_dict_under_dir(data_after_trim_galore_dir):
+def build_sample_dict_under_dir(data_after_trim_galore_dir, fused_qc=False):
     """
     The input directory is the output directory of trim_galore in Step1
     :param data_after_trim_galore_dir:
+    :param fused_qc: the input directory holds raw reads (--fused-qc), found as in Step1
     :return:
     """
-    all_gz_list = [i for i in os.listdir(data_after_trim_galore_dir) if i.endswith(".gz")]
-    sample_name_fq_dict = {}
-    # must be sorted file
-    for gz_file in sorted(all_gz_list):
-        sample_name = gz_file.split("_")[0]
-        if sample_name not in sample_name_fq_dict:
-            sample_name_fq_dict.update({sample_name: [os.path.join(data_after_trim_galore_dir, gz_file)]})
-        else:
-            sample_name_fq_dict[sample_name].append(os.path.join(data_after_trim_galore_dir, gz_file))
-    for sample_name, fqs in sample_name_fq_dict.items():
-        print(f"The number of fqs for {sample_name} is {len(fqs)}")
-    return sample_name_fq_dict
+    return sample_manifest.build_sample_fq_dict(data_after_trim_galore_dir, "raw" if fused_qc else "trim_galore")
 
 
 # main function: Kneaddata
-def knead_process(sample_fq_dict, output_knead_dir, bowtie_ref):
+def knead_process(sample_fq_dict, output_knead_dir, bowtie_ref, step_options=None):
     """
     :param sample_fq_dict: result of build_sample_dict_under_dir()
     :param output_knead_dir: output directory
     :param bowtie_ref: the bowtie ref (built from genome .fas) of host (e.g. human, mouse)
+    :param step_options: result of pipe_meta.parse_step_options(), samples run concurrently if total_cores is given
+    :return:
+    """
+    # the kept outputs are gzipped (kneaddata_paired_1.fastq.gz), as expected by step4 and step5
+    compress_level = 6 if step_options is None else step_options.compress_level or None
+    if step_options is not None and step_options.fused_qc:
+        # the input fqs are raw reads, trim_galore runs first in local scratch
+        step_function = pipe_meta.trim_knead_fused_step3
+        sample_job_dict = {sample_id: ((output_knead_dir, fq_path_list, 25, bowtie_ref),
+                                       {"scratch_dir": step_options.scratch_dir, "compress_level": compress_level})
+                           for sample_id, fq_path_list in sample_fq_dict.items()}
+    else:
+        step_function = pipe_meta.kneaddata_clean_step3
+        sample_job_dict = {sample_id: ((output_knead_dir, fq_path_list, bowtie_ref), {"compress_level": compress_level})
+                           for sample_id, fq_path_list in sample_fq_dict.items()}
+    if step_options is None or step_options.total_cores is None:
+        # outputs of a sample are compressed in the background while the next sample is cleaned
+        background_job_list = []
+        for sample_id, (args, kwargs) in sample_job_dict.items():
+            thread = pipe_meta.planned_thread("kneaddata", sample_fq_dict[sample_id], 4,
+                                              None if step_options is None else step_options.max_thread_per_job)
+            step_function(*args, thread=thread, background_job_list=background_job_list, **kwargs)
+        failed_sample_list = pipe_meta.wait_background_jobs(background_job_list)
+        if failed_sample_list:
+            raise pipe_meta.PipelineCommandError(f"Compressing the outputs of {len(failed_sample_list)} samples "
+                                                 f"failed: {sorted(failed_sample_list)}")
+    else:
+        step_resource = pipe_meta.STEP_RESOURCE_DEFAULTS["kneaddata"]
+        pipe_meta.run_samples_concurrently(sample_job_dict, step_function,
+                                           step_options.total_cores,
+                                           step_options.total_mem_gb or pipe_meta.node_memory_gb(),
+                                           step_options.mem_per_job_gb or step_resource["mem_gb"],
+                                           max_thread=step_options.max_thread_per_job or step_resource["thread"],
+                                           step_name="kneaddata", input_path_dict=sample_fq_dict,
+                                           min_mem_gb=step_options.mem_per_job_gb)
+
+
+def dedup_process(sample_fq_dict, dedup_dir, step_options=None):
+    """
+    :param sample_fq_dict: kneaddata outputs, {"sample1": ["XXX_kneaddata_paired_1.fastq.gz", "XXX_kneaddata_paired_2.fastq.gz"]}
+    :param dedup_dir: output directory
+    :param step_options: result of pipe_meta.parse_step_options(), samples run concurrently if total_cores is given
     :return:
     """
-    for sample_id in sample_fq_dict.keys():
-        fq_path_list = sample_fq_dict[sample_id]
-        pipe_meta.kneaddata_clean_step3(output_knead_dir, fq_path_list, bowtie_ref, thread=4)
+    step_resource = pipe_meta.STEP_RESOURCE_DEFAULTS["dedup"]
+    memory_gb = step_resource["mem_gb"]
+    compress_level = 6
+    if step_options is not None:
+        memory_gb = step_options.mem_per_job_gb or memory_gb
+        compress_level = step_options.compress_level or None
+    sample_job_dict = {sample_id: ((dedup_dir, fq_path_list),
+                                   {"memory_gb": memory_gb, "compress_level": compress_level,
+                                    "scratch_dir": None if step_options is None else step_options.scratch_dir})
+                       for sample_id, fq_path_list in sample_fq_dict.items()}
+    if step_options is None or step_options.total_cores is None:
+        for sample_id, (args, kwargs) in sample_job_dict.items():
+            pipe_meta.dedup_read_pairs_step3(*args, thread=step_resource["thread"], **kwargs)
+    else:
+        pipe_meta.run_samples_concurrently(sample_job_dict, pipe_meta.dedup_read_pairs_step3,
+                                           step_options.total_cores,
+                                           step_options.total_mem_gb or pipe_meta.node_memory_gb(),
+                                           memory_gb,
+                                           max_thread=step_options.max_thread_per_job or step_resource["thread"])
 
 
 if __name__ == "__main__":
@@ -53,5 +110,14 @@ if __name__ == "__main__":
     human_bowtie_ref = "user/software/human_database/ftp.broadinstitute.org/bundle/hg38/hg38"
     """
     trim_galore_dir, knead_dir, host_bowtie_ref = sys.argv[1:4]
-    sample_name_fq_dict1 = build_sample_dict_under_dir(trim_galore_dir)
-    knead_process(sample_name_fq_dict1, knead_dir, host_bowtie_ref)
+    step_options = pipe_meta.parse_step_options(sys.argv[4:])   # e.g. --total-cores 64 --total-mem-gb 256
+    metrics_path = pipe_meta.setup_metrics_log(step_options, knead_dir)
+    pipe_meta.setup_command_execution(step_options, knead_dir)
+    sample_name_fq_dict1 = build_sample_dict_under_dir(trim_galore_dir, step_options.fused_qc)
+    sample_name_fq_dict1 = pipe_meta.select_samples(sample_name_fq_dict1, step_options.sample_list)
+    knead_process(sample_name_fq_dict1, knead_dir, host_bowtie_ref, step_options)
+    if step_options.dedup_dir is not None:
+        knead_sample_fq_dict = sample_manifest.build_sample_fq_dict(knead_dir, "kneaddata")
+        knead_sample_fq_dict = pipe_meta.select_samples(knead_sample_fq_dict, step_options.sample_list)
+        dedup_process(knead_sample_fq_dict, step_options.dedup_dir, step_options)
+    pipe_meta.summarize_metrics(metrics_path, metrics_path.replace(".jsonl", "_summary.tsv"))
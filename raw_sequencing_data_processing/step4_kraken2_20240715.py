@@ -3,11 +3,18 @@ This script generates the taxonomic profiling by Kraken2: can use either NCBI or
 
 module add kraken/2.0.8
 module add python/cpu/3.6.5
+
+recount finished samples under other confidence thresholds from their per-read output, without running Kraken2 again:
+python step4_kraken2_20240715.py kneaddata_dir kraken2_dir kraken2_db_dir --reanalyze-confidence 0.1 0.5 --combine-format parquet
+
+input deduplicated by step3 --dedup-dir: {sample}_report.txt counts each unique read pair once, the counts before
+deduplication are in {sample}_conf0_mhg1_report.txt, which is also what --combine-format combines
 """
 
 
 import os
 import pipeline_metagenomic as pipe_meta
+import sample_manifest
 import sys
 
 
@@ -17,23 +24,46 @@ def build_sample_dict_under_dir(data_after_knead_dir):
     :param data_after_knead_dir:
     :return:
     """
-    # all fq file, data_dir = "/gpfs/data/lilab/home/zhoub03/Lama_oxalate/Lama_three_studies/processed_data/kneaddata"
-    all_fq_list = [i for i in os.listdir(data_after_knead_dir) if i.endswith("kneaddata_paired_1.fastq.gz") or i.endswith("kneaddata_paired_2.fastq.gz")]
-    sample_name_fq_dict = {}
-    # must be sorted file
-    for gz_file in sorted(all_fq_list):
-        sample_name = gz_file.split("_")[0]
-        if sample_name not in sample_name_fq_dict:
-            sample_name_fq_dict.update({sample_name: [os.path.join(data_after_knead_dir, gz_file)]})
-        else:
-            sample_name_fq_dict[sample_name].append(os.path.join(data_after_knead_dir, gz_file))
-    for sample_name, fqs in sample_name_fq_dict.items():
-        print(f"The number of fqs for {sample_name} is {len(fqs)}")
-    return sample_name_fq_dict
+    return sample_manifest.build_sample_fq_dict(data_after_knead_dir, "kneaddata")
 
 
 # main function: Kraken2 process
-def kraken2_process(sample_fq_dict, kraken2_output_dir, kraken2_db_dir):
+def kraken2_process(sample_fq_dict, kraken2_output_dir, kraken2_db_dir, step_options=None):
+    if step_options is not None and step_options.kraken_batch:
+        # load the database into memory once and memory-map it for all samples
+        sample_id_list = list(sample_fq_dict.keys())
+        pipe_meta.kraken_batch_process_step4(sample_id_list, [sample_fq_dict[i] for i in sample_id_list],
+                                             [kraken2_output_dir for i in sample_id_list], kraken2_db_dir,
+                                             whether_use_mpa_style=True,
+                                             thread=step_options.max_thread_per_job or pipe_meta.STEP_RESOURCE_DEFAULTS["kraken2"]["thread"],
+                                             stage_root=step_options.kraken_stage_dir,
+                                             total_cores=step_options.total_cores,
+                                             total_mem_gb=step_options.total_mem_gb,
+                                             mem_per_job_gb=step_options.mem_per_job_gb or 4)
+        return
+    if step_options is not None and step_options.total_cores is not None:
+        step_resource = pipe_meta.STEP_RESOURCE_DEFAULTS["kraken2"]
+        # each kraken2 process loads its own copy of the database, concurrent jobs must fit in memory together
+        mem_per_job_gb = step_options.mem_per_job_gb or \
+            max(step_resource["mem_gb"], pipe_meta.kraken_database_memory_gb(kraken2_db_dir) or 0)
+        sample_job_dict = {sample_id: (([sample_id], [fq_path_list], [kraken2_output_dir], kraken2_db_dir),
+                                       {"whether_use_mpa_style": True})
+                           for sample_id, fq_path_list in sample_fq_dict.items()}
+        pipe_meta.run_samples_concurrently(sample_job_dict, pipe_meta.kraken_process_step4,
+                                           step_options.total_cores,
+                                           step_options.total_mem_gb or pipe_meta.node_memory_gb(), mem_per_job_gb,
+                                           max_thread=step_options.max_thread_per_job or step_resource["thread"],
+                                           step_name="kraken2", input_path_dict=sample_fq_dict,
+                                           min_mem_gb=mem_per_job_gb)
+        return
+    if pipe_meta.get_step_cost_model("kraken2") is not None:
+        # threads of each sample planned from the --resource-history
+        for sample_id, fq_path_list in sample_fq_dict.items():
+            thread = pipe_meta.planned_thread("kraken2", fq_path_list, None,
+                                              None if step_options is None else step_options.max_thread_per_job)
+            pipe_meta.kraken_process_step4([sample_id], [fq_path_list], [kraken2_output_dir], kraken2_db_dir,
+                                           whether_use_mpa_style=True, thread=thread)
+        return
     sample_id_list = list(sample_fq_dict.keys())
     all_sample_fq_path_list = [sample_fq_dict[i] for i in sample_id_list]
     sample_output_folder_list = [kraken2_output_dir for i in sample_id_list]    # all sample to the same folder
@@ -45,6 +75,43 @@ def kraken2_process(sample_fq_dict, kraken2_output_dir, kraken2_db_dir):
                                    kraken2_db_dir, whether_use_mpa_style=True)
 
 
+def kraken2_combine(sample_id_list, kraken2_output_dir, output_format="parquet", processes=4,
+                    report_suffix="_report.txt", combined_name="combined_counts"):
+    """
+    Combine {sample}_report.txt of all samples into one count matrix per rank
+    :param report_suffix: e.g. "_conf0.1_mhg1_report.txt" for the reports of kraken2_reanalyze()
+    :return: combined_counts_Species.parquet etc. under kraken2_output_dir
+    """
+    report_path_list = [os.path.join(kraken2_output_dir, f"{i}{report_suffix}") for i in sample_id_list]
+    sample_id_list = [i for i, j in zip(sample_id_list, report_path_list) if os.path.exists(j)]
+    report_path_list = [i for i in report_path_list if os.path.exists(i)]
+    return pipe_meta.kraken_report_combine(report_path_list, sample_id_list,
+                                           os.path.join(kraken2_output_dir, combined_name), output_format,
+                                           processes)
+
+
+def kraken2_reanalyze(sample_id_list, kraken2_output_dir, taxonomy_dir, confidence_list, minimum_hit_groups=1,
+                      multiplicity_path_dict=None):
+    """
+    Recount {sample}_output.txt of all samples under other confidence thresholds, without running Kraken2 again
+    :param multiplicity_path_dict: {"sample1": "dedup_dir/XXX_multiplicity.tsv"} of samples whose input reads were
+    deduplicated, their reads are counted as many times as they occurred before deduplication
+    :return: {confidence: report suffix}, reports are {sample}_conf0.1_mhg1_report.txt etc. under kraken2_output_dir
+    """
+    if multiplicity_path_dict is None:
+        multiplicity_path_dict = {}
+    taxonomy = pipe_meta.load_kraken_taxonomy(taxonomy_dir)
+    for sample_id in sample_id_list:
+        kraken_output_path = os.path.join(kraken2_output_dir, f"{sample_id}_output.txt")
+        if not os.path.exists(kraken_output_path):
+            print(f"Warning! {kraken_output_path} does not exist. Skip it!")
+            continue
+        pipe_meta.kraken_reanalysis(kraken_output_path, taxonomy, os.path.join(kraken2_output_dir, sample_id),
+                                    confidence_list, minimum_hit_groups,
+                                    multiplicity_path=multiplicity_path_dict.get(sample_id))
+    return {i: f"_conf{i:g}_mhg{minimum_hit_groups}_report.txt" for i in confidence_list}
+
+
 if __name__ == "__main__":
     """
     # fq_data_dir = "user/raw_data"
@@ -58,7 +125,51 @@ if __name__ == "__main__":
     kraken2_ncbi_dir = "user/software/kraken2/NCBI_standard"
     """
     kneaddata_dir_as_input, kraken2_dir_as_output, kraken2_database_dir = sys.argv[1:4]
+    step_options = pipe_meta.parse_step_options(sys.argv[4:])   # e.g. --total-cores 64 --total-mem-gb 512 --kraken-batch
+    metrics_path = pipe_meta.setup_metrics_log(step_options, kraken2_dir_as_output)
+    pipe_meta.setup_command_execution(step_options, kraken2_dir_as_output)
     # build dict of sample ID and fastq files
     sample_fq_dict = build_sample_dict_under_dir(kneaddata_dir_as_input)  # {"sample1": ["path/XXX_R1.fastq.gz", "path/XXX_R2.fastq.gz"]}
+    sample_fq_dict = pipe_meta.select_samples(sample_fq_dict, step_options.sample_list)
 
-    kraken2_process(sample_fq_dict, kraken2_dir_as_output, kraken2_database_dir)
+    classify_fq_dict = sample_fq_dict
+    if step_options.reanalyze_confidence is not None:
+        # reanalysis only recounts samples that already have their per-read output; they are not classified again,
+        # also when they were classified before step manifests existed
+        classify_fq_dict = {sample_id: fq_path_list for sample_id, fq_path_list in sample_fq_dict.items()
+                            if not all(os.path.exists(os.path.join(kraken2_dir_as_output, f"{sample_id}{i}"))
+                                       for i in ["_output.txt", "_report.txt"])}
+        print(f"{len(sample_fq_dict) - len(classify_fq_dict)} samples with Kraken2 output are only reanalyzed")
+    if classify_fq_dict:
+        kraken2_process(classify_fq_dict, kraken2_dir_as_output, kraken2_database_dir, step_options)
+    # input from step3 --dedup-dir: restore the read counts from before deduplication
+    multiplicity_path_dict = {sample_id: pipe_meta.multiplicity_path_of_fq(fq_path_list[0])
+                              for sample_id, fq_path_list in sample_fq_dict.items()}
+    multiplicity_path_dict = {i: j for i, j in multiplicity_path_dict.items() if os.path.exists(j)}
+    taxonomy_dir = step_options.taxonomy_dir or os.path.join(kraken2_database_dir, "taxonomy")
+    report_suffix = "_report.txt"
+    if multiplicity_path_dict:
+        if os.path.exists(os.path.join(taxonomy_dir, "nodes.dmp")):
+            # {sample}_report.txt counts each unique read pair once; the same settings as the kraken2 run (confidence
+            # 0, no hit-group filter) recounted with the multiplicities give the reports that are combined
+            print(f"{len(multiplicity_path_dict)} samples were deduplicated in step3, their read counts are restored "
+                  f"from the multiplicity files")
+            report_suffix = kraken2_reanalyze(list(sample_fq_dict.keys()), kraken2_dir_as_output, taxonomy_dir,
+                                              [0.0], 1, multiplicity_path_dict)[0.0]
+        else:
+            print(f"Warning! {len(multiplicity_path_dict)} samples were deduplicated in step3, but {taxonomy_dir} has "
+                  f"no nodes.dmp (--taxonomy-dir) to restore their read counts; reports hold deduplicated counts")
+    if step_options.combine_format is not None:
+        kraken2_combine(list(sample_fq_dict.keys()), kraken2_dir_as_output, step_options.combine_format,
+                        processes=step_options.total_cores or 4, report_suffix=report_suffix)
+    if step_options.reanalyze_confidence is not None:
+        # e.g. --reanalyze-confidence 0.1 0.2 0.5, samples with Kraken2 output were not classified again above
+        confidence_suffix_dict = kraken2_reanalyze(list(sample_fq_dict.keys()), kraken2_dir_as_output, taxonomy_dir,
+                                                   step_options.reanalyze_confidence, step_options.minimum_hit_groups,
+                                                   multiplicity_path_dict)
+        if step_options.combine_format is not None:
+            for confidence, report_suffix in confidence_suffix_dict.items():
+                kraken2_combine(list(sample_fq_dict.keys()), kraken2_dir_as_output, step_options.combine_format,
+                                processes=step_options.total_cores or 4, report_suffix=report_suffix,
+                                combined_name=f"combined_counts{report_suffix[:-len('_report.txt')]}")
+    pipe_meta.summarize_metrics(metrics_path, metrics_path.replace(".jsonl", "_summary.tsv"))
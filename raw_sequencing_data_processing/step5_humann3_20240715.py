@@ -7,6 +7,8 @@ module add python/cpu/3.7.2
 
 import os
 import pipeline_metagenomic as pipe_meta
+import sample_manifest
+import shutil
 import sys
 
 
@@ -16,42 +18,96 @@ def build_gz_sample_dict_under_kneaddata(data_kneaddata_dir):
     :param data_kneaddata_dir:
     :return:
     """
-    all_fq_list = [i for i in os.listdir(data_kneaddata_dir) if i.endswith("kneaddata_paired_1.fastq.gz") or i.endswith("kneaddata_paired_2.fastq.gz")]
-    sample_name_fq_dict = {}
-    # must be sorted file
-    for gz_file in sorted(all_fq_list):
-        sample_name = gz_file.split("_")[0]
-        if sample_name not in sample_name_fq_dict:
-            sample_name_fq_dict.update({sample_name: [os.path.join(data_kneaddata_dir, gz_file)]})
-        else:
-            sample_name_fq_dict[sample_name].append(os.path.join(data_kneaddata_dir, gz_file))
-    for sample_name, fqs in sample_name_fq_dict.items():
-        print(f"The number of fqs for {sample_name} is {len(fqs)}")
-    return sample_name_fq_dict
+    return sample_manifest.build_sample_fq_dict(data_kneaddata_dir, "kneaddata")
+
+
+def humann3_sample_process(sample_id, fq_path_list, sample_dir, metaphlan_dir, metaphlan_index, humann3_nucleotide_db, humann3_protein_db, thread=16, plain_input=True):
+    """
+    :param plain_input: write the combined reads once as plain fastq that HUMAnN3 uses directly; False keeps the old
+    combined .fastq.gz, which HUMAnN3 then decompresses into a second copy in its temp folder
+    """
+    # a sample is skipped only if its manifest matches the inputs, databases and complete outputs
+    output_path_list = [os.path.join(sample_dir, f"{sample_id}_{i}.tsv") for i in ["genefamilies", "pathabundance", "pathcoverage"]]
+    db_path_list = [metaphlan_dir, humann3_nucleotide_db, humann3_protein_db]
+    humann3_signature = f"humann --metaphlan-index {metaphlan_index} --plain-input {plain_input}"
+    manifest_path = pipe_meta.step_manifest_path(sample_dir, "humann3", sample_id)
+    if pipe_meta.step_is_complete(manifest_path, fq_path_list, humann3_signature, db_path_list):
+        print(f"Sample {sample_id} has been processed. Skip this one!")
+        return output_path_list
+    if not os.path.exists(manifest_path) and \
+            all(os.path.exists(i) and os.path.getsize(i) > 0 for i in output_path_list):
+        # finished before step manifests existed: HUMAnN3 writes the three tables only at the end of a run, they are
+        # recorded as complete instead of being removed and computed again
+        print(f"Warning! Sample {sample_id} has all HUMAnN3 outputs but no manifest, they are kept as complete")
+        pipe_meta.write_step_manifest(manifest_path, fq_path_list, humann3_signature, output_path_list, db_path_list)
+        return output_path_list
+    pipe_meta.remove_partial_outputs(manifest_path, output_path_list)
+    shutil.rmtree(os.path.join(sample_dir, f"{sample_id}_humann_temp"), ignore_errors=True)
+    # combine previous pair reads
+    if plain_input:
+        combined_fq_path = os.path.join(sample_dir, f"{sample_id}_kneaddata_combined.fastq")
+        pipe_meta.write_humann_input_fastq(fq_path_list, combined_fq_path)
+        pipe_meta.humann_analysis_step5(combined_fq_path, sample_dir, sample_id, metaphlan_dir, metaphlan_index, humann3_nucleotide_db, humann3_protein_db, thread=thread, input_format="fastq",
+                                        input_path_list=fq_path_list)
+    else:
+        combined_fq_path = os.path.join(sample_dir, f"{sample_id}_kneaddata_combined.fastq.gz")
+        with open(combined_fq_path, "wb") as combined_f:
+            for fq_path in fq_path_list:
+                with open(fq_path, "rb") as fq_f:
+                    shutil.copyfileobj(fq_f, combined_f, 16 * 1024 * 1024)
+        pipe_meta.humann_analysis_step5(combined_fq_path, sample_dir, sample_id, metaphlan_dir, metaphlan_index, humann3_nucleotide_db, humann3_protein_db, thread=thread,
+                                        input_path_list=fq_path_list)
+    os.remove(combined_fq_path)
+    pipe_meta.write_step_manifest(manifest_path, fq_path_list, humann3_signature, output_path_list, db_path_list)
+    return output_path_list
 
 
 # main function: humann3
-def humann3_process(sample_fq_gz_dict, total_output_dir, metaphlan_dir, metaphlan_index, humann3_nucleotide_db, humann3_protein_db):
+def humann3_process(sample_fq_gz_dict, total_output_dir, metaphlan_dir, metaphlan_index, humann3_nucleotide_db, humann3_protein_db, step_options=None):
     # create folder under the total output folder for each sample
+    sample_job_dict = {}
     for sample_id in list(sample_fq_gz_dict.keys()):
         sample_dir = os.path.join(total_output_dir, sample_id)
-        if not os.path.exists(sample_dir):
-            os.system(f"mkdir -p {sample_dir}")
+        os.makedirs(sample_dir, exist_ok=True)
+        fq_path_list = sample_fq_gz_dict[sample_id]     # [1.fastq.gz, 2.fastq.gz]
+        if step_options is None or step_options.total_cores is None:
+            # 16 threads unless --resource-history has enough HUMAnN3 runs to plan them from the input size
+            thread = pipe_meta.planned_thread("humann3", fq_path_list, 16,
+                                              None if step_options is None else step_options.max_thread_per_job)
+            humann3_sample_process(sample_id, fq_path_list, sample_dir, metaphlan_dir, metaphlan_index, humann3_nucleotide_db, humann3_protein_db, thread=thread)
         else:
-            # sample result directory exist, do not over write
-            print(f"Sample {sample_id} has been processed. Skip this one!")
+            sample_job_dict[sample_id] = ((sample_id, fq_path_list, sample_dir, metaphlan_dir, metaphlan_index, humann3_nucleotide_db, humann3_protein_db), {})
+    if sample_job_dict:
+        step_resource = pipe_meta.STEP_RESOURCE_DEFAULTS["humann3"]
+        pipe_meta.run_samples_concurrently(sample_job_dict, humann3_sample_process,
+                                           step_options.total_cores,
+                                           step_options.total_mem_gb or pipe_meta.node_memory_gb(),
+                                           step_options.mem_per_job_gb or step_resource["mem_gb"],
+                                           max_thread=step_options.max_thread_per_job or step_resource["thread"],
+                                           step_name="humann3", input_path_dict=sample_fq_gz_dict,
+                                           min_mem_gb=step_options.mem_per_job_gb)
+
+
+def humann3_combine(sample_id_list, total_output_dir, output_format="tsv", processes=4):
+    """
+    Combine the genefamilies, pathabundance and pathcoverage reports of all samples under total_output_dir
+    :return: combined_genefamilies.tsv, combined_pathabundance.tsv, combined_pathcoverage.tsv (or .parquet)
+    """
+    for report_type in ["genefamilies", "pathabundance", "pathcoverage"]:
+        report_path_list = [os.path.join(total_output_dir, i, f"{i}_{report_type}.tsv") for i in sample_id_list]
+        report_path_list = [i for i in report_path_list if os.path.exists(i)]
+        if not report_path_list:
             continue
-        # combine previous pair reads
-        os.chdir(sample_dir)
-        fq_path_list = sample_fq_gz_dict[sample_id]     # [1.fastq.gz, 2.fastq.gz]
-        combined_fq_path = os.path.join(sample_dir, f"{sample_id}_kneaddata_combined.fastq.gz")
-        os.system(f"cat {fq_path_list[0]} {fq_path_list[1]} > {combined_fq_path}")
-        pipe_meta.humann_analysis_step5(combined_fq_path, sample_dir, sample_id, metaphlan_dir, metaphlan_index, humann3_nucleotide_db, humann3_protein_db)
-        os.system(f"rm {combined_fq_path}")
+        combined_report_path = os.path.join(total_output_dir, f"combined_{report_type}.{output_format}")
+        print(f"Combine {len(report_path_list)} {report_type} reports into {combined_report_path}")
+        pipe_meta.humann_pathway_report_combine(report_path_list, combined_report_path, output_format, processes)
 
 
 if __name__ == "__main__":
     kneaddata_dir_as_input, humann3_dir_as_output, metaphlan_dir, metaphlan_index, humann3_nucleotide_db, humann3_protein_db = sys.argv[1:7]
+    step_options = pipe_meta.parse_step_options(sys.argv[7:])   # e.g. --total-cores 64 --total-mem-gb 256
+    metrics_path = pipe_meta.setup_metrics_log(step_options, humann3_dir_as_output)
+    pipe_meta.setup_command_execution(step_options, humann3_dir_as_output)
     """
     kneaddata_dir = "user_path/processed_data/kneaddata"
     humann3_output_dir = "user_path/processed_data/humann3_result"
@@ -60,5 +116,15 @@ if __name__ == "__main__":
     """
     # build dict of sample ID and fastq files
     sample_fq_gz_dict = build_gz_sample_dict_under_kneaddata(kneaddata_dir_as_input)  # {"sample1": [fastq.gz, fastq.gz]}
-    humann3_process(sample_fq_gz_dict, humann3_dir_as_output, metaphlan_dir, metaphlan_index, humann3_nucleotide_db, humann3_protein_db)
-
+    sample_fq_gz_dict = pipe_meta.select_samples(sample_fq_gz_dict, step_options.sample_list)
+    dedup_sample_list = [sample_id for sample_id, fq_path_list in sample_fq_gz_dict.items()
+                         if os.path.exists(pipe_meta.multiplicity_path_of_fq(fq_path_list[0]))]
+    if dedup_sample_list:
+        print(f"Warning! {len(dedup_sample_list)} samples were deduplicated in step3 (e.g. {dedup_sample_list[0]}), "
+              f"their HUMAnN3 outputs are abundances of unique read pairs and are not corrected to the read counts "
+              f"before deduplication")
+    humann3_process(sample_fq_gz_dict, humann3_dir_as_output, metaphlan_dir, metaphlan_index, humann3_nucleotide_db, humann3_protein_db, step_options)
+    if step_options.combine_format is not None:
+        humann3_combine(list(sample_fq_gz_dict.keys()), humann3_dir_as_output, step_options.combine_format,
+                        processes=step_options.total_cores or 4)
+    pipe_meta.summarize_metrics(metrics_path, metrics_path.replace(".jsonl", "_summary.tsv"))
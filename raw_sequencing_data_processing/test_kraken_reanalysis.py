@@ -0,0 +1,105 @@
+"""
+Check resolve_kraken_reads() against a read-by-read port of ResolveTree (classify.cc of Kraken2) on a random taxonomy
+
+python -m pytest test_kraken_reanalysis.py
+"""
+
+
+import math
+import os
+import random
+import numpy as np
+import pipeline_metagenomic as pipe_meta
+
+
+def write_random_taxonomy(taxonomy_dir, node_number=60, seed=7):
+    """
+    :return: {taxid: parent taxid}, taxid 1 is the root and its own parent, as in nodes.dmp of NCBI
+    """
+    taxonomy_rng = random.Random(seed)
+    rank_list = ["no rank", "superkingdom", "phylum", "class", "order", "family", "genus", "species"]
+    parent_dict = {1: 1}
+    depth_dict = {1: 0}
+    for taxid in range(2, node_number + 1):
+        parent_taxid = taxonomy_rng.choice([i for i in parent_dict if depth_dict[i] < len(rank_list) - 1])
+        parent_dict[taxid] = parent_taxid
+        depth_dict[taxid] = depth_dict[parent_taxid] + 1
+    os.makedirs(taxonomy_dir, exist_ok=True)
+    with open(os.path.join(taxonomy_dir, "nodes.dmp"), "w") as nodes_f:
+        for taxid, parent_taxid in parent_dict.items():
+            nodes_f.write(f"{taxid}\t|\t{parent_taxid}\t|\t{rank_list[depth_dict[taxid]]}\t|\n")
+    with open(os.path.join(taxonomy_dir, "names.dmp"), "w") as names_f:
+        for taxid in parent_dict:
+            names_f.write(f"{taxid}\t|\tTaxon{taxid}\t|\t\t|\tscientific name\t|\n")
+    return parent_dict
+
+
+def brute_force_resolve_tree(parent_dict, hit_run_list, total_kmers, confidence, minimum_hit_groups):
+    """
+    ResolveTree of Kraken2 for one read, with the hit runs of the read standing in for its hit groups
+    :param hit_run_list: [(taxid, count)] in the order of the k-mer LCA string
+    :return: called taxid, 0 for unclassified
+    """
+    def lineage(taxid):
+        taxid_list = [taxid]
+        while parent_dict[taxid_list[-1]] != taxid_list[-1]:
+            taxid_list.append(parent_dict[taxid_list[-1]])
+        return taxid_list
+
+    def is_ancestor(ancestor_taxid, taxid):
+        return ancestor_taxid in lineage(taxid)
+
+    def lowest_common_ancestor(taxid_a, taxid_b):
+        return next(i for i in lineage(taxid_a) if i in lineage(taxid_b))
+
+    hit_counts = {}
+    for taxid, count in hit_run_list:
+        hit_counts[taxid] = hit_counts.get(taxid, 0) + count
+    if not hit_counts:
+        return 0
+    max_taxon, max_score = 0, 0
+    for taxid in hit_counts:
+        score = sum(j for i, j in hit_counts.items() if is_ancestor(i, taxid))
+        if score > max_score:
+            max_taxon, max_score = taxid, score
+        elif score == max_score:
+            max_taxon = lowest_common_ancestor(max_taxon, taxid)
+    required_score = math.ceil(confidence * total_kmers)
+    max_score = hit_counts.get(max_taxon, 0)
+    while max_taxon and max_score < required_score:
+        max_score = sum(j for i, j in hit_counts.items() if is_ancestor(max_taxon, i))
+        if max_score >= required_score:
+            break
+        # the parent of the root is 0 (unclassified) in Kraken2
+        max_taxon = 0 if parent_dict[max_taxon] == max_taxon else parent_dict[max_taxon]
+    if len(hit_run_list) < minimum_hit_groups:
+        return 0
+    return max_taxon
+
+
+def test_resolve_kraken_reads_matches_resolve_tree(tmp_path):
+    parent_dict = write_random_taxonomy(str(tmp_path / "taxonomy"))
+    taxonomy = pipe_meta.load_kraken_taxonomy(str(tmp_path / "taxonomy"))
+    read_rng = random.Random(11)
+    taxid_list = list(parent_dict)
+    read_hit_run_list, total_kmer_list = [], []
+    for read_index in range(3000):
+        # a few taxa per read, so ties and shared lineages are common
+        read_taxid_list = read_rng.sample(taxid_list, read_rng.randint(1, 4))
+        hit_run_list = [(read_rng.choice(read_taxid_list), read_rng.randint(1, 6))
+                        for i in range(read_rng.randint(0, 6))]
+        read_hit_run_list.append(hit_run_list)
+        total_kmer_list.append(sum(i[1] for i in hit_run_list) + read_rng.randint(0, 20))
+    hit_number = np.array([len(i) for i in read_hit_run_list], dtype=np.int64)
+    total_kmers = np.array(total_kmer_list, dtype=np.int64)
+    hit_taxid = np.array([i[0] for j in read_hit_run_list for i in j], dtype=np.int64)
+    hit_count = np.array([i[1] for j in read_hit_run_list for i in j], dtype=np.int64)
+    confidence_list = [0.0, 0.1, 0.3, 0.5, 0.8, 1.0]
+    for minimum_hit_groups in [1, 2, 3]:
+        read_call_dict = pipe_meta.resolve_kraken_reads(taxonomy, hit_number, total_kmers, hit_taxid, hit_count,
+                                                        confidence_list, minimum_hit_groups)
+        for confidence, read_call in read_call_dict.items():
+            called_taxid = np.where(read_call >= 0, taxonomy["taxid"][read_call], 0)
+            expected_taxid = [brute_force_resolve_tree(parent_dict, i, j, confidence, minimum_hit_groups)
+                              for i, j in zip(read_hit_run_list, total_kmer_list)]
+            assert called_taxid.tolist() == expected_taxid, (confidence, minimum_hit_groups)